@@ -0,0 +1,323 @@
+import itertools
+import os
+import random
+import sys
+
+# the lambda directories use flat imports, so put them on the path like their zip roots
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(REPO, "visitor_matching"), os.path.join(REPO, "model_serving")]
+
+import numpy as np  # noqa: E402
+
+import synthetic  # noqa: E402
+from harness import Curve, compare_results, load_results, run_curve, save_results  # noqa: E402
+
+MODEL_FILES = {
+    "bot_fraud": os.path.join(REPO, "bot_fraud_inference", "app", "bot_fraud_model.txt"),
+    "manual_fraud": os.path.join(REPO, "model_serving", "manual_fraud_model.txt"),
+}
+NUM_INPUTS = 50  # distinct inputs cycled through per point, so caches don't see one pair only
+
+
+def cycle_call(function, inputs):
+    """
+    :return: Function calling function(*input) for the next input on every call
+    """
+    inputs = itertools.cycle(inputs)
+    return lambda: function(*next(inputs))
+
+
+def random_string_pairs(length, seed=0):
+    """
+    Random lowercase strings of a given length, each paired with a copy carrying a few typos
+    """
+    rng = random.Random(seed)
+    pairs = []
+    for _ in range(NUM_INPUTS):
+        value = "".join(rng.choice("abcdefghijklmnopqrstuvwxyz ") for _ in range(length))
+        changed = value
+        for _ in range(max(1, length // 16)):
+            changed = synthetic._typo(rng, changed)
+        pairs.append((value, changed))
+    return pairs
+
+
+def utils_curves(seed):
+    from utils import haversine_distance, haversine_distances, levenshtein, match_set
+
+    def levenshtein_setup(max_distance):
+        def setup(length):
+            pairs = random_string_pairs(length, seed)
+            return cycle_call(lambda a, b: levenshtein(a, b, max_distance), pairs), 1
+
+        return setup
+
+    def match_set_setup(num_fonts):
+        rng = random.Random(seed)
+        fonts = [synthetic.generate_fingerprint(rng, num_fonts) for _ in range(NUM_INPUTS)]
+        pairs = [
+            (fingerprint["fonts"], synthetic.mutate_fingerprint(rng, fingerprint)["fonts"])
+            for fingerprint in fonts
+        ]
+        return cycle_call(match_set, pairs), 1
+
+    def haversine_setup(num_points):
+        rng = np.random.default_rng(seed)
+        latitude, longitude = rng.uniform(-80, 80, (2, num_points))
+        if num_points == 1:
+            props = {"latitude": float(latitude[0]), "longitude": float(longitude[0])}
+            return lambda: haversine_distance(props, props), 1
+        latitude, longitude = latitude[:, None], longitude[:, None]
+        return lambda: haversine_distances(latitude, longitude, 10.0, 20.0), num_points
+
+    return [
+        Curve("utils", "levenshtein", "length", [8, 32, 128, 512], levenshtein_setup(None)),
+        Curve(
+            "utils",
+            "levenshtein(max_distance=3)",
+            "length",
+            [8, 32, 128, 512],
+            levenshtein_setup(3),
+        ),
+        Curve("utils", "match_set(fonts)", "fonts", [10, 40, 150], match_set_setup),
+        Curve("utils", "haversine_distance(s)", "points", [1, 100, 10000], haversine_setup),
+    ]
+
+
+def fingerprint_curves(seed):
+    from fingerprint_batch import FingerprintBatchCompare
+    from fingerprint_compare import FingerprintCompare
+    from lambda_function import lambda_handler
+
+    def compare_setup(cls, num_fonts=None):
+        def setup(num_fingerprints):
+            event = synthetic.generate_fingerprint_event(num_fingerprints, seed, num_fonts)
+            comparer = cls(event["previous_fingerprints"], event["new_fingerprint"])
+            return comparer.identify_top_fingerprint_match, 1
+
+        return setup
+
+    def fonts_setup(num_fonts):
+        return compare_setup(FingerprintCompare, num_fonts)(100)
+
+    def batch_setup(batch_size):
+        event = synthetic.generate_fingerprint_event(100, seed)
+        rng = random.Random(seed)
+        event["new_fingerprints"] = [
+            synthetic.mutate_fingerprint(rng, rng.choice(event["previous_fingerprints"]))
+            for _ in range(batch_size)
+        ]
+        return lambda: lambda_handler(event, None), batch_size
+
+    return [
+        Curve(
+            "fingerprint",
+            "FingerprintCompare",
+            "candidates",
+            [10, 100, 1000],
+            compare_setup(FingerprintCompare),
+        ),
+        Curve(
+            "fingerprint",
+            "FingerprintCompare",
+            "fonts",
+            [10, 40, 150],
+            fonts_setup,
+            {"candidates": 100},
+        ),
+        Curve(
+            "fingerprint",
+            "FingerprintBatchCompare",
+            "candidates",
+            [10, 100, 1000, 10000],
+            compare_setup(FingerprintBatchCompare),
+        ),
+        Curve(
+            "fingerprint",
+            "lambda_handler(new_fingerprints)",
+            "batch_size",
+            [1, 10, 100],
+            batch_setup,
+            {"candidates": 100},
+        ),
+    ]
+
+
+def visitor_curves(seed):
+    from visitor_attribute_compare import VisitorAttributeCompare
+    from visitor_attribute_lambda_function import lambda_handler
+
+    def compare_setup(method, num_visitors=None):
+        def setup(value):
+            event = (
+                synthetic.generate_visitor_event(value, 2, seed)
+                if num_visitors is None
+                else synthetic.generate_visitor_event(num_visitors, value, seed)
+            )
+            comparer = VisitorAttributeCompare(
+                event["previous_visitors"], event["new_visitor"], event["weights"]
+            )
+            return getattr(comparer, method), 1
+
+        return setup
+
+    def batch_setup(batch_size):
+        event = synthetic.generate_visitor_event(20, 2, seed)
+        rng = random.Random(seed)
+        event["new_visitors"] = [
+            synthetic.mutate_visitor(rng, rng.choice(event["previous_visitors"]))
+            for _ in range(batch_size)
+        ]
+        return lambda: lambda_handler(event, None), batch_size
+
+    return [
+        Curve(
+            "visitor",
+            "VisitorAttributeCompare",
+            "candidates",
+            [10, 100, 1000],
+            compare_setup("estimate_visitor_match"),
+        ),
+        Curve(
+            "visitor",
+            "VisitorAttributeCompare",
+            "ips",
+            [1, 10, 100],
+            compare_setup("estimate_visitor_match", num_visitors=20),
+            {"candidates": 20},
+        ),
+        Curve(
+            "visitor",
+            "VisitorAttributeCompare(scalar)",
+            "candidates",
+            [10, 100, 1000],
+            compare_setup("estimate_visitor_match_scalar"),
+        ),
+        Curve(
+            "visitor",
+            "lambda_handler(new_visitors)",
+            "batch_size",
+            [1, 10, 100],
+            batch_setup,
+            {"candidates": 20},
+        ),
+    ]
+
+
+def inference_curves(seed):
+    """
+    The handlers read their models from /opt/ml/model at import, so the predictor
+    configurations they choose between are benchmarked directly: FraudPredictor over a
+    Booster (no artifacts), over a FlatTreeModel (.npz present) and LookupTablePredictor
+    (table present). Batch size 1 is the per-request handler path (predict), larger
+    batches go through predict_many.
+    """
+    import lightgbm as lgb
+
+    from flat_trees import FlatTreeModel
+    from fraud_inference import FraudPredictor, random_events
+    from lookup_table import LookupTablePredictor, compile_table
+
+    curves = []
+    for label, model_file in MODEL_FILES.items():
+        booster = lgb.Booster(model_file=model_file)
+        predictors = {
+            "booster": lambda booster=booster: FraudPredictor(booster),
+            "flat_trees": lambda model_file=model_file: FraudPredictor(
+                FlatTreeModel.from_model_file(model_file)
+            ),
+            "lookup_table": lambda booster=booster: LookupTablePredictor(
+                booster, compile_table(booster)
+            ),
+        }
+        for name, build in predictors.items():
+            built = {}
+
+            def setup(batch_size, build=build, built=built):
+                if "predictor" not in built:
+                    built["predictor"] = build()
+                predictor = built["predictor"]
+                events = random_events(predictor.feature_names, NUM_INPUTS * batch_size, seed)
+                if batch_size == 1:
+                    return cycle_call(predictor.predict, [(event,) for event in events]), 1
+                batches = [
+                    (events[start : start + batch_size],)
+                    for start in range(0, len(events), batch_size)
+                ]
+                return cycle_call(predictor.predict_many, batches), batch_size
+
+            curves.append(Curve("inference", f"{label}/{name}", "batch_size", [1, 32, 1024], setup))
+    return curves
+
+
+SUITES = {
+    "utils": utils_curves,
+    "fingerprint": fingerprint_curves,
+    "visitor": visitor_curves,
+    "inference": inference_curves,
+}
+
+
+def run(suites, output, seed=0, quick=False):
+    results, scaling = [], []
+    for suite in suites:
+        for curve in SUITES[suite](seed):
+            curve_results, curve_scaling = run_curve(curve, quick)
+            results.extend(curve_results)
+            scaling.append(curve_scaling)
+    print("\nscaling exponents (log best p50 latency vs log parameter):")
+    for summary in scaling:
+        exponent = summary["exponent"]
+        print(
+            f"  {summary['suite']:<12} {summary['case']:<36} {summary['parameter']:<10} "
+            f"{'-' if exponent is None else f'{exponent:.2f}'}"
+        )
+    save_results(output, results, scaling, {"suites": suites, "seed": seed, "quick": quick})
+    print(f"saved {len(results)} results to {output}")
+
+
+def compare(baseline_file, current_file, metric, threshold, min_difference):
+    """
+    :return: Number of regressions
+    """
+    rows, unmatched = compare_results(
+        load_results(baseline_file), load_results(current_file), metric, threshold, min_difference
+    )
+    for (suite, case, parameter, value), old, new, ratio, regressed in rows:
+        flag = "REGRESSION" if regressed else ("improved" if ratio < 1 - threshold else "")
+        print(
+            f"{suite:<12} {case:<36} {f'{parameter}={value}':<17} "
+            f"{old:10.1f} -> {new:10.1f} us  x{ratio:5.2f}  {flag}"
+        )
+    for key in unmatched:
+        print(f"only in one file: {key}")
+    regressions = sum(row[4] for row in rows)
+    print(f"{regressions} regressions ({metric} up by more than {threshold:.0%})")
+    return regressions
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Latency and scaling benchmarks")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="run benchmarks and save the results as JSON")
+    run_parser.add_argument("--suite", action="append", choices=list(SUITES), dest="suites")
+    run_parser.add_argument("--output", default="benchmark_results.json")
+    run_parser.add_argument("--seed", type=int, default=0)
+    run_parser.add_argument("--quick", action="store_true", help="first two points per curve")
+    compare_parser = commands.add_parser("compare", help="flag regressions between two runs")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--metric", default="best_p50_us")
+    compare_parser.add_argument("--threshold", type=float, default=0.2)
+    compare_parser.add_argument("--min-difference-us", type=float, default=1.0)
+    args = parser.parse_args()
+
+    if args.command == "run":
+        run(args.suites or list(SUITES), args.output, args.seed, args.quick)
+    else:
+        regressions = compare(
+            args.baseline, args.current, args.metric, args.threshold, args.min_difference_us
+        )
+        sys.exit(1 if regressions else 0)
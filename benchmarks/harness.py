@@ -0,0 +1,183 @@
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+PERCENTILES = [50, 90, 99]
+
+
+class Curve:
+    """
+    One benchmarked function measured at several values of one parameter (candidate count,
+    font-list size, batch size, ...). setup(value) builds the inputs for a value outside the
+    timed region and returns the function to time and the number of items one call handles
+    (for throughput).
+    """
+
+    def __init__(self, suite, case, parameter, values, setup, fixed=None):
+        self.suite = suite
+        self.case = case
+        self.parameter = parameter
+        self.values = list(values)
+        self.setup = setup
+        self.fixed = fixed or {}  # parameters held constant along the curve, for the report
+
+
+def measure(function, rounds=5, min_calls=3, max_calls=1000, min_seconds=0.05, warmup=2):
+    """
+    Time individual calls in several rounds, each running until min_seconds have passed (at
+    least min_calls, at most max_calls calls)
+    :return: List of arrays of call times in microseconds, one per round
+    """
+    for _ in range(warmup):
+        function()
+    all_times = []
+    for _ in range(rounds):
+        times = []
+        start = time.perf_counter()
+        while len(times) < max_calls and (
+            len(times) < min_calls or time.perf_counter() - start < min_seconds
+        ):
+            call_start = time.perf_counter_ns()
+            function()
+            times.append(time.perf_counter_ns() - call_start)
+        all_times.append(np.array(times) / 1000)
+    return all_times
+
+
+def summarize(rounds, items=1):
+    """
+    :return: Dictionary of call count, mean and percentile latencies over every call (us),
+             the lowest median of a single round (us) and throughput (items per second)
+    """
+    times = np.concatenate(rounds)
+    mean = float(times.mean())
+    stats = {"calls": len(times), "mean_us": mean}
+    for percentile, value in zip(PERCENTILES, np.percentile(times, PERCENTILES)):
+        stats[f"p{percentile}_us"] = float(value)
+    # other load on the machine slows whole rounds down; the best round is the most stable
+    # number to compare between runs (like timeit's min of repeats)
+    stats["best_p50_us"] = float(min(np.median(round_times) for round_times in rounds))
+    stats["throughput"] = items * 1e6 / mean
+    return stats
+
+
+def scaling_exponent(values, latencies):
+    """
+    Slope of log(latency) against log(parameter value): about 1 for linear growth, 0 for
+    constant time
+    :return: Exponent, or None with fewer than two positive points
+    """
+    points = [(v, t) for v, t in zip(values, latencies) if v and v > 0 and t > 0]
+    if len(points) < 2:
+        return None
+    x, y = np.log([point[0] for point in points]), np.log([point[1] for point in points])
+    return float(np.polyfit(x, y, 1)[0])
+
+
+def run_curve(curve, quick=False, log=print):
+    """
+    Measure every point of a curve (only the first two values if quick)
+    :return: List of result dictionaries and the curve's scaling summary
+    """
+    results = []
+    for value in curve.values[:2] if quick else curve.values:
+        function, items = curve.setup(value)
+        stats = summarize(measure(function, rounds=3 if quick else 5), items)
+        results.append(
+            {
+                "suite": curve.suite,
+                "case": curve.case,
+                "parameter": curve.parameter,
+                "value": value,
+                "fixed": curve.fixed,
+                "items": items,
+                "stats": stats,
+            }
+        )
+        log(
+            f"{curve.suite:<12} {curve.case:<36} {f'{curve.parameter}={value}':<17} "
+            f"p50 {stats['p50_us']:10.1f} us  p99 {stats['p99_us']:10.1f} us  "
+            f"{stats['throughput']:10.0f} items/s"
+        )
+    scaling = {
+        "suite": curve.suite,
+        "case": curve.case,
+        "parameter": curve.parameter,
+        "exponent": scaling_exponent(
+            [result["value"] for result in results],
+            [result["stats"]["best_p50_us"] for result in results],
+        ),
+    }
+    return results, scaling
+
+
+def environment():
+    """
+    :return: Dictionary describing where the results were produced
+    """
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": commit or None,
+        "python": sys.version.split()[0],
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def save_results(path, results, scaling, settings):
+    with open(path, "w") as fp:
+        json.dump(
+            {
+                "environment": environment(),
+                "settings": settings,
+                "results": results,
+                "scaling": scaling,
+            },
+            fp,
+            indent=2,
+        )
+
+
+def load_results(path):
+    with open(path) as fp:
+        return json.load(fp)
+
+
+def result_key(result):
+    return (result["suite"], result["case"], result["parameter"], result["value"])
+
+
+def compare_results(baseline, current, metric="best_p50_us", threshold=0.2, min_difference=1.0):
+    """
+    Match the points of two result files and flag every point whose metric grew by more
+    than threshold (relative) and more than min_difference microseconds (absolute, so
+    sub-microsecond noise on the fastest primitives isn't reported)
+    :return: List of (key, baseline value, current value, ratio, regressed) and the keys
+             present in only one of the files
+    """
+    before = {result_key(result): result["stats"][metric] for result in baseline["results"]}
+    after = {result_key(result): result["stats"][metric] for result in current["results"]}
+    rows = []
+    for key in before.keys() & after.keys():
+        old, new = before[key], after[key]
+        ratio = new / old if old else float("inf")
+        regressed = ratio > 1 + threshold and new - old > min_difference
+        rows.append((key, old, new, ratio, regressed))
+    rows.sort(key=lambda row: tuple(str(part) for part in row[0]))
+    unmatched = sorted(before.keys() ^ after.keys(), key=lambda key: tuple(map(str, key)))
+    return rows, unmatched
@@ -1,14 +1,34 @@
-import lightgbm as lgb
-import pandas as pd
+import os
 
-model = lgb.Booster(model_file="/opt/ml/model/bot_fraud_model.txt")
+from flat_trees import ColdStartModel, FlatTreeModel
+from fraud_inference import FraudPredictor
+from instrumentation import INSTRUMENTATION
+from lookup_table import LookupTablePredictor
 
+# both compiled from the text model when the image is built
+FLAT_MODEL_FILE = "/opt/ml/model/bot_fraud_model.npz"
+TABLE_FILE = "/opt/ml/model/bot_fraud_table.npy"
 
-def lambda_handler(event, context):
+MODEL_FILE = "/opt/ml/model/bot_fraud_model.txt"
+
+if os.path.exists(FLAT_MODEL_FILE):
+    # no lightgbm import or text parse before the first prediction; the Booster, faster
+    # once loaded, replaces the flat arrays when its background load finishes
+    model = ColdStartModel(FlatTreeModel.load(FLAT_MODEL_FILE), MODEL_FILE)
+else:
+    import lightgbm as lgb
+
+    model = lgb.Booster(model_file=MODEL_FILE)
+if os.path.exists(TABLE_FILE):
+    predictor = LookupTablePredictor.load(model, TABLE_FILE)
+else:
+    predictor = FraudPredictor(model)
 
-    data_df = pd.DataFrame(event, index=[0])
 
-    result = model.predict(data_df)[0]
+def lambda_handler(event, context):
+
+    with INSTRUMENTATION.request("bot_fraud"), INSTRUMENTATION.stage("bot_fraud.predict"):
+        result = predictor.predict(event)
 
     return {
         "statusCode": 200,
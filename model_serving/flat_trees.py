@@ -0,0 +1,315 @@
+import threading
+
+import numpy as np
+
+ZERO_THRESHOLD = 1e-35  # LightGBM's kZeroThreshold: |x| at most this counts as zero
+MISSING_ZERO, MISSING_NAN = 1, 2  # missing types, bits 2-3 of a LightGBM decision_type
+DEFAULT_LEFT = 2  # bit 1 of a LightGBM decision_type
+# arrays of a FlatTreeModel, as saved in its .npz
+ARRAYS = [
+    "split_feature",
+    "threshold",
+    "default_left",
+    "missing_type",
+    "left_child",
+    "right_child",
+    "leaf_value",
+    "roots",
+]
+
+
+def parse_model_text(text):
+    """
+    Parse a LightGBM text model (Booster.save_model)
+    :return: Dictionary of header fields and a list of tree dictionaries (field -> string)
+    """
+    header = {}
+    current, trees = header, []
+    for line in text.splitlines():
+        if line.startswith("Tree="):
+            current = {}
+            trees.append(current)
+        elif line == "end of trees":
+            break
+        elif "=" in line:
+            key, value = line.split("=", 1)
+            current[key] = value
+    return header, trees
+
+
+def flatten_trees(trees):
+    """
+    Concatenate the nodes and leaves of every tree into flat arrays. Child pointers index
+    the flat node arrays; a negative child c is the flat leaf ~c. A tree with a single leaf
+    has root ~leaf
+    :return: Dictionary of arrays
+    """
+    columns = {
+        key: []
+        for key in ["split_feature", "threshold", "decision_type", "left_child", "right_child"]
+    }
+    roots, leaf_values = [], []
+    num_nodes, num_leaves = 0, 0
+    for tree in trees:
+        values = [float(value) for value in tree["leaf_value"].split()]
+        if int(tree["num_leaves"]) == 1:
+            roots.append(~num_leaves)
+        else:
+            if int(tree.get("num_cat", 0)):
+                raise ValueError("cannot convert a model with categorical splits")
+            roots.append(num_nodes)
+            for key in ["split_feature", "decision_type"]:
+                columns[key].extend(int(value) for value in tree[key].split())
+            columns["threshold"].extend(float(value) for value in tree["threshold"].split())
+            for key in ["left_child", "right_child"]:
+                for child in (int(value) for value in tree[key].split()):
+                    # leaves are stored as ~leaf index within the tree, nodes as node index
+                    columns[key].append(child + num_nodes if child >= 0 else ~(~child + num_leaves))
+            num_nodes += len(tree["split_feature"].split())
+        leaf_values.extend(values)
+        num_leaves += len(values)
+
+    decision_type = np.array(columns["decision_type"], dtype=np.int8)
+    return {
+        "split_feature": np.array(columns["split_feature"], dtype=np.int32),
+        "threshold": np.array(columns["threshold"], dtype=np.float64),
+        "default_left": (decision_type & DEFAULT_LEFT).astype(bool),
+        "missing_type": (decision_type >> 2) & 3,
+        "left_child": np.array(columns["left_child"], dtype=np.int32),
+        "right_child": np.array(columns["right_child"], dtype=np.int32),
+        "leaf_value": np.array(leaf_values, dtype=np.float64),
+        "roots": np.array(roots, dtype=np.int32),
+    }
+
+
+class FlatTreeModel:
+    """
+    A LightGBM model as flat NumPy arrays (split feature, threshold, default direction,
+    missing type, children, leaf values), evaluated for a batch of rows with only NumPy:
+    every (row, tree) pair walks down one level per step, all pairs at once. Implements the
+    parts of the Booster interface FraudPredictor uses (feature_name, num_feature, predict),
+    so inference doesn't need to import lightgbm or parse the text model at startup.
+
+    Numerical splits follow LightGBM's NumericalDecision: NaN is treated as 0 unless the
+    missing type is NaN; missing values (NaN, or zero for missing type zero) take the default
+    direction, anything else goes left if value <= threshold.
+    """
+
+    def __init__(self, arrays, feature_names, sigmoid=None):
+        for key, value in arrays.items():
+            setattr(self, key, value)
+        self.feature_names = list(feature_names)
+        self.sigmoid = sigmoid  # binary objective: probability = 1 / (1 + exp(-sigmoid * raw))
+
+    @classmethod
+    def from_model_file(cls, path):
+        """
+        Convert a LightGBM text model
+        """
+        with open(path) as model_file:
+            header, trees = parse_model_text(model_file.read())
+        sigmoid = None
+        objective = header.get("objective", "").split()
+        if objective and objective[0] == "binary":
+            sigmoid = float(dict(part.split(":") for part in objective[1:]).get("sigmoid", 1))
+        return cls(flatten_trees(trees), header["feature_names"].split(), sigmoid)
+
+    def save(self, path):
+        """
+        Save as a single uncompressed .npz
+        """
+        arrays = {key: getattr(self, key) for key in ARRAYS}
+        np.savez(
+            path,
+            feature_names=np.array(self.feature_names),
+            sigmoid=np.array(np.nan if self.sigmoid is None else self.sigmoid),
+            **arrays,
+        )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as artifact:
+            sigmoid = float(artifact["sigmoid"])
+            return cls(
+                {key: artifact[key] for key in ARRAYS},
+                artifact["feature_names"].tolist(),
+                None if np.isnan(sigmoid) else sigmoid,
+            )
+
+    def feature_name(self):
+        return self.feature_names
+
+    def num_feature(self):
+        return len(self.feature_names)
+
+    def num_trees(self):
+        return len(self.roots)
+
+    def leaves(self, rows):
+        """
+        :param rows: array of shape (number of rows, number of features)
+        :return: Flat leaf index of every (row, tree) pair, shape (number of rows, trees)
+        """
+        rows = np.asarray(rows, dtype=np.float64)
+        state = np.repeat(self.roots[None, :], len(rows), axis=0).ravel()
+        active = np.flatnonzero(state >= 0)
+        while len(active):
+            nodes = state[active]
+            values = rows[active // len(self.roots), self.split_feature[nodes]]
+            missing_type = self.missing_type[nodes]
+            nan = np.isnan(values)
+            values = np.where(nan & (missing_type != MISSING_NAN), 0.0, values)
+            missing = ((missing_type == MISSING_ZERO) & (np.abs(values) <= ZERO_THRESHOLD)) | (
+                (missing_type == MISSING_NAN) & nan
+            )
+            left = np.where(missing, self.default_left[nodes], values <= self.threshold[nodes])
+            state[active] = np.where(left, self.left_child[nodes], self.right_child[nodes])
+            active = active[state[active] >= 0]
+        return ~state.reshape(len(rows), len(self.roots))
+
+    def predict(self, rows, raw_score=False):
+        """
+        :return: Array of predictions (probabilities for a binary model), like Booster.predict
+        """
+        raw = self.leaf_value[self.leaves(rows)].sum(axis=1)
+        if raw_score or self.sigmoid is None:
+            return raw
+        return 1.0 / (1.0 + np.exp(-self.sigmoid * raw))
+
+
+class ColdStartModel:
+    """
+    Serve predictions from a FlatTreeModel while the Booster of the same text model loads in
+    a background thread, then from the Booster. The flat arrays only save the lightgbm import
+    and text parse at cold start: warm, NumPy's per-level overhead makes them about 7x slower
+    than Booster.predict (about 390 us against 50 us for one row).
+
+    Implements the same parts of the Booster interface as FlatTreeModel.
+    """
+
+    def __init__(self, flat_model, model_file):
+        self.flat_model = flat_model
+        self.booster = None
+        self.loader = threading.Thread(target=self.load_booster, args=(model_file,), daemon=True)
+        self.loader.start()
+
+    def load_booster(self, model_file):
+        import lightgbm as lgb
+
+        self.booster = lgb.Booster(model_file=model_file)
+
+    def feature_name(self):
+        return self.flat_model.feature_name()
+
+    def num_feature(self):
+        return self.flat_model.num_feature()
+
+    def num_trees(self):
+        return self.flat_model.num_trees()
+
+    def predict(self, rows, raw_score=False):
+        model = self.flat_model if self.booster is None else self.booster
+        return model.predict(rows, raw_score=raw_score)
+
+
+def check_model(booster, model, num_rows=20000, seed=0):
+    """
+    Verify FlatTreeModel against Booster.predict on random 0/1 rows with missing values
+    :return: Largest absolute difference
+    """
+    rng = np.random.default_rng(seed)
+    rows = rng.integers(0, 2, (num_rows, model.num_feature())).astype(np.float32)
+    rows[rng.random(rows.shape) < 0.1] = np.nan
+    expected, actual = booster.predict(rows), model.predict(rows)
+    assert np.allclose(expected, actual, rtol=0, atol=1e-12)
+    assert np.allclose(booster.predict(rows, raw_score=True), model.predict(rows, raw_score=True))
+    return float(np.abs(expected - actual).max())
+
+
+STARTUP_SCRIPTS = {
+    "lightgbm + pandas": """
+import lightgbm as lgb
+import pandas as pd
+model = lgb.Booster(model_file="{model_file}")
+model.predict(pd.DataFrame(event, index=[0]))[0]
+""",
+    "flat arrays": """
+from fraud_inference import FraudPredictor
+from flat_trees import FlatTreeModel
+FraudPredictor(FlatTreeModel.load("{npz_file}")).predict(event)
+""",
+    "flat arrays, Booster loading in the background": """
+from fraud_inference import FraudPredictor
+from flat_trees import ColdStartModel, FlatTreeModel
+FraudPredictor(ColdStartModel(FlatTreeModel.load("{npz_file}"), "{model_file}")).predict(event)
+""",
+}
+
+
+def startup_seconds(script, model_file, npz_file, feature_names, repeat=5):
+    """
+    Time a fresh interpreter importing, loading a model and making a first prediction
+    :return: Best wall time of repeat runs, minus the time of an empty interpreter
+    """
+    import os
+    import subprocess
+    import sys
+    import time
+
+    event = {name: 1 for name in feature_names}
+    code = f"event = {event!r}\n" + script.format(model_file=model_file, npz_file=npz_file)
+    directory = os.path.dirname(os.path.abspath(__file__))
+
+    def best(code):
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, "-c", code], check=True, cwd=directory)
+            times.append(time.perf_counter() - start)
+        return min(times)
+
+    return best(code) - best("pass")
+
+
+if __name__ == "__main__":
+    # python flat_trees.py manual_fraud_model.txt manual_fraud_model.npz [--check]
+    import os
+    import sys
+    import time
+
+    model_file, npz_file = sys.argv[1:3]
+    start = time.perf_counter()
+    model = FlatTreeModel.from_model_file(model_file)
+    model.save(npz_file)
+    print(
+        f"converted {model.num_trees()} trees, {len(model.split_feature)} splits in "
+        f"{time.perf_counter() - start:.2f} s: {os.path.getsize(model_file) / 2**20:.2f} MB text, "
+        f"{os.path.getsize(npz_file) / 2**20:.2f} MB npz"
+    )
+
+    if "--check" in sys.argv:
+        import timeit
+
+        import lightgbm as lgb
+
+        booster = lgb.Booster(model_file=model_file)
+        loaded = FlatTreeModel.load(npz_file)
+        print(f"max difference against Booster.predict: {check_model(booster, loaded):.2e}")
+
+        rows = np.ones((1000, loaded.num_feature()), dtype=np.float32)
+        cold_start = ColdStartModel(loaded, model_file)
+        check_model(booster, cold_start)  # flat arrays, or the Booster if already loaded
+        cold_start.loader.join()
+        check_model(booster, cold_start)
+        for name, predict in [("lightgbm", booster.predict), ("flat arrays", loaded.predict)]:
+            single = timeit.timeit(lambda: predict(rows[:1]), number=200) / 200
+            batch = timeit.timeit(lambda: predict(rows), number=5) / 5
+            print(
+                f"{name}: {single * 1e6:.0f} us for one row, "
+                f"{batch / len(rows) * 1e6:.1f} us per row in batches of {len(rows)}"
+            )
+        for name, script in STARTUP_SCRIPTS.items():
+            seconds = startup_seconds(
+                script, os.path.abspath(model_file), os.path.abspath(npz_file), loaded.feature_names
+            )
+            print(f"startup (imports, model load, first prediction), {name}: {seconds:.2f} s")
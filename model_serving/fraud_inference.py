@@ -0,0 +1,110 @@
+import numpy as np
+
+
+class FraudPredictor:
+    """
+    Score fraud model events without building a pandas DataFrame per request. The feature
+    order is read from the Booster once, and every event dictionary is written into a reused
+    float32 buffer in that order: the event's key order doesn't matter, keys the model doesn't
+    know are ignored, and missing or None features become NaN (LightGBM's missing value).
+
+    The buffer is reused between calls, so a predictor must not be shared between threads
+    (a Lambda container handles one request at a time).
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.feature_names = model.feature_name()
+        self.feature_index = {name: index for index, name in enumerate(self.feature_names)}
+        self.buffer = np.empty((1, len(self.feature_names)), dtype=np.float32)
+
+    def vectorize(self, event, out):
+        """
+        Write an event into a row of feature values in model order
+        :param out: float32 array of length len(feature_names), overwritten
+        """
+        out.fill(np.nan)
+        for name, value in event.items():
+            index = self.feature_index.get(name)
+            if index is not None and value is not None:
+                out[index] = value
+        return out
+
+    def predict(self, event):
+        """
+        :return: Model prediction (fraud probability) for a single event dictionary
+        """
+        self.vectorize(event, self.buffer[0])
+        return float(self.model.predict(self.buffer)[0])
+
+    def predict_many(self, events):
+        """
+        Score a batch of event dictionaries with a single call into the model
+        :return: Array of predictions, one per event
+        """
+        rows = np.empty((len(events), len(self.feature_names)), dtype=np.float32)
+        for event, row in zip(events, rows):
+            self.vectorize(event, row)
+        return self.model.predict(rows)
+
+
+def random_events(feature_names, num_events, seed=0, missing_rate=0.0):
+    """
+    Random 0/1 flag events in shuffled key order, optionally with missing flags
+    :return: List of event dictionaries
+    """
+    rng = np.random.default_rng(seed)
+    events = []
+    for _ in range(num_events):
+        names = rng.permutation(feature_names)
+        values = rng.integers(0, 2, len(names))
+        missing = rng.random(len(names)) < missing_rate
+        events.append(
+            {name: int(value) for name, value, gone in zip(names, values, missing) if not gone}
+        )
+    return events
+
+
+def check_predictions(model, events):
+    """
+    Verify FraudPredictor against Booster.predict on a DataFrame with the columns in model
+    order (the order the current handlers silently rely on)
+    :return: Largest absolute difference
+    """
+    import pandas as pd
+
+    predictor = FraudPredictor(model)
+    frame = pd.DataFrame(events, columns=predictor.feature_names, dtype=np.float64)
+    expected = model.predict(frame)
+    single = np.array([predictor.predict(event) for event in events])
+    batch = predictor.predict_many(events)
+    assert np.allclose(expected, single, rtol=0, atol=1e-12)
+    assert np.allclose(expected, batch, rtol=0, atol=1e-12)
+    return float(np.abs(expected - single).max())
+
+
+if __name__ == "__main__":
+    import sys
+    import timeit
+
+    import lightgbm as lgb
+    import pandas as pd
+
+    for model_file in sys.argv[1:] or ["manual_fraud_model.txt"]:
+        model = lgb.Booster(model_file=model_file)
+        predictor = FraudPredictor(model)
+        events = random_events(predictor.feature_names, 1000, missing_rate=0.05)
+        print(f"{model_file}: max difference {check_predictions(model, events):.2e}")
+
+        event = {name: 1 for name in predictor.feature_names}
+        number = 2000
+        dataframe = timeit.timeit(
+            lambda: model.predict(pd.DataFrame(event, index=[0]))[0], number=number
+        )
+        buffer = timeit.timeit(lambda: predictor.predict(event), number=number)
+        batch = timeit.timeit(lambda: predictor.predict_many(events), number=5)
+        print(
+            f"  per request: DataFrame {dataframe / number * 1e6:.0f} us, "
+            f"float32 buffer {buffer / number * 1e6:.0f} us; "
+            f"predict_many {batch / 5 / len(events) * 1e6:.1f} us per event"
+        )
@@ -0,0 +1,200 @@
+import json
+
+import numpy as np
+
+from fraud_inference import FraudPredictor
+
+MAX_TABLE_FEATURES = 24  # 2^24 float32 predictions are 64 MB, larger tables aren't worth it
+
+
+def table_rows(num_features, start=0, stop=None):
+    """
+    Every 0/1 combination of num_features flags, row i holding the bits of i (feature j is
+    bit j)
+    :return: float32 array of shape (stop - start, num_features)
+    """
+    stop = 2**num_features if stop is None else stop
+    codes = np.arange(start, stop, dtype=np.int64)
+    return ((codes[:, None] >> np.arange(num_features)) & 1).astype(np.float32)
+
+
+def compile_table(model, chunk_size=2**16, dtype=np.float32):
+    """
+    Predict every 0/1 combination of the model's features with the Booster
+    :return: Array of 2^num_features predictions indexed by the packed bit pattern
+    """
+    num_features = model.num_feature()
+    if num_features > MAX_TABLE_FEATURES:
+        raise ValueError(f"{num_features} features is too many for a lookup table")
+    size = 2**num_features
+    table = np.empty(size, dtype=dtype)
+    for start in range(0, size, chunk_size):
+        stop = min(start + chunk_size, size)
+        table[start:stop] = model.predict(table_rows(num_features, start, stop))
+    return table
+
+
+def save_table(path, table, feature_names):
+    """
+    Save a table as .npy (memory-mappable) plus a .json sidecar with its feature (bit) order
+    """
+    np.save(path, table)
+    with open(metadata_path(path), "w") as metadata:
+        json.dump({"feature_names": list(feature_names), "dtype": table.dtype.name}, metadata)
+
+
+def load_table(path):
+    """
+    :return: Memory-mapped table and its feature names
+    """
+    with open(metadata_path(path)) as metadata:
+        feature_names = json.load(metadata)["feature_names"]
+    return np.load(path, mmap_mode="r"), feature_names
+
+
+def metadata_path(path):
+    return str(path)[: -len(".npy")] + ".json" if str(path).endswith(".npy") else f"{path}.json"
+
+
+class LookupTablePredictor(FraudPredictor):
+    """
+    FraudPredictor that answers events whose features are all present and 0/1 with one read
+    from a precompiled table of every flag combination (compile_table); any other event
+    (a missing flag, or a value other than 0/1) is scored by the tree model.
+    """
+
+    def __init__(self, model, table, feature_names=None):
+        super().__init__(model)
+        if feature_names is not None and list(feature_names) != self.feature_names:
+            raise ValueError("lookup table was compiled for a different feature order")
+        if len(table) != 2 ** len(self.feature_names):
+            raise ValueError("lookup table size doesn't match the number of features")
+        self.table = table
+        self.bit_values = 1 << np.arange(len(self.feature_names), dtype=np.int64)
+        self.lookups, self.fallbacks = 0, 0
+
+    @classmethod
+    def load(cls, model, path):
+        """
+        Predictor for a model and the table saved at path (see save_table)
+        """
+        table, feature_names = load_table(path)
+        return cls(model, table, feature_names)
+
+    def table_index(self, event):
+        """
+        :return: Packed bit pattern of an event, or None if it isn't a complete 0/1 event
+        """
+        index, seen = 0, 0
+        for name, value in event.items():
+            position = self.feature_index.get(name)
+            if position is None:
+                continue
+            if value == 1:
+                index |= 1 << position
+            elif value != 0:  # includes None
+                return None
+            seen += 1
+        return index if seen == len(self.feature_names) else None
+
+    def predict(self, event):
+        """
+        :return: Model prediction (fraud probability) for a single event dictionary
+        """
+        index = self.table_index(event)
+        if index is None:
+            self.fallbacks += 1
+            return super().predict(event)
+        self.lookups += 1
+        return float(self.table[index])
+
+    def predict_many(self, events):
+        """
+        Score a batch of event dictionaries: complete 0/1 rows from the table, the rest with
+        a single call into the model
+        :return: Array of predictions, one per event
+        """
+        rows = np.empty((len(events), len(self.feature_names)), dtype=np.float32)
+        for event, row in zip(events, rows):
+            self.vectorize(event, row)
+        complete = ((rows == 0) | (rows == 1)).all(axis=1)
+        predictions = np.empty(len(events), dtype=np.float64)
+        predictions[complete] = self.table[rows[complete].astype(np.int64) @ self.bit_values]
+        if not complete.all():
+            predictions[~complete] = self.model.predict(rows[~complete])
+        self.lookups += int(complete.sum())
+        self.fallbacks += int((~complete).sum())
+        return predictions
+
+
+def check_table(model, table, chunk_size=2**15):
+    """
+    Verify a table against Booster.predict over every row, predicted again in chunks of a
+    different size than compile_table's
+    :return: Largest absolute difference
+    """
+    num_features = model.num_feature()
+    largest = 0.0
+    for start in range(0, len(table), chunk_size):
+        stop = min(start + chunk_size, len(table))
+        expected = model.predict(table_rows(num_features, start, stop))
+        largest = max(largest, float(np.abs(expected - table[start:stop]).max()))
+    assert largest <= np.finfo(table.dtype).eps, largest
+    return largest
+
+
+def check_predictor(model, predictor, events):
+    """
+    Verify LookupTablePredictor.predict and predict_many against the tree model
+    :return: Largest absolute difference
+    """
+    expected = FraudPredictor(model).predict_many(events)
+    single = np.array([predictor.predict(event) for event in events])
+    batch = predictor.predict_many(events)
+    tolerance = np.finfo(predictor.table.dtype).eps
+    assert np.allclose(expected, single, rtol=0, atol=tolerance)
+    assert np.allclose(expected, batch, rtol=0, atol=tolerance)
+    return float(np.abs(expected - single).max())
+
+
+if __name__ == "__main__":
+    # python lookup_table.py bot_fraud_model.txt bot_fraud_table.npy [--check]
+    import sys
+    import time
+    import timeit
+
+    import lightgbm as lgb
+
+    from fraud_inference import random_events
+
+    model_file, table_file = sys.argv[1:3]
+    model = lgb.Booster(model_file=model_file)
+    start = time.perf_counter()
+    table = compile_table(model)
+    save_table(table_file, table, model.feature_name())
+    print(
+        f"compiled {len(table)} predictions ({table.nbytes / 2**20:.1f} MB) "
+        f"in {time.perf_counter() - start:.1f} s"
+    )
+
+    if "--check" in sys.argv:
+        predictor = LookupTablePredictor.load(model, table_file)
+        print(f"table: max difference {check_table(model, predictor.table):.2e} over all rows")
+        events = random_events(predictor.feature_names, 2000) + random_events(
+            predictor.feature_names, 500, seed=1, missing_rate=0.05
+        )
+        difference = check_predictor(model, predictor, events)
+        print(
+            f"predictor: max difference {difference:.2e}, "
+            f"{predictor.lookups} lookups, {predictor.fallbacks} model fallbacks"
+        )
+
+        event = {name: 1 for name in predictor.feature_names}
+        tree = FraudPredictor(model)
+        number = 5000
+        lookup_time = timeit.timeit(lambda: predictor.predict(event), number=number)
+        tree_time = timeit.timeit(lambda: tree.predict(event), number=number)
+        print(
+            f"per request: lookup table {lookup_time / number * 1e6:.1f} us, "
+            f"tree model {tree_time / number * 1e6:.1f} us"
+        )
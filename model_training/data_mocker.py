@@ -1,13 +1,31 @@
 import pandas as pd
 import numpy as np
 import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+MISSING = -1  # int8 value of an attribute whose probability is null for the row's profile
 
 
 class DataMocker:
+    """
+    Synthetic visitor data: every profile of the parameter file gets int(traffic_pct *
+    num_samples) rows (in the file's order), with labels and has* attributes drawn as
+    Bernoulli variables of the profile's probabilities.
+
+    Rows are generated in fixed-size chunks into preallocated int8 columns, one vectorised
+    draw per profile slice and column. Chunk i draws from its own stream spawned from
+    SeedSequence(seed), so the data depends on the seed and chunk size only, not on the order
+    or the process the chunks are generated in. iter_chunks() yields chunks (optionally from a
+    process pool), write_chunks() streams them to .npy or Parquet files and generate_data()
+    returns an in-memory DataFrame.
+    """
+
     def __init__(
         self,
         num_samples=1000,
         params_loc="/Users/tillman/dodgeball/dodgeball-analysis/notebooks/sample_parameters.json",
+        seed=None,
     ):
         self.num_samples = num_samples
         with open(params_loc, "r") as fp:
@@ -17,72 +35,406 @@ class DataMocker:
         self.profile_distribution = {
             key: self.sample_params[key]["traffic_pct"] for key in self.sample_params
         }
+        self.profiles = list(self.sample_params)
+        self.seed = seed  # None: drawn from np.random, so np.random.seed() makes runs repeatable
+        # first row of every profile (and the total number of rows at the end)
+        self.bounds = np.cumsum(
+            [0] + [int(pct * num_samples) for pct in self.profile_distribution.values()]
+        )
+        # probability of a 1 per profile and drawn column, NaN where the parameter is null
+        self.drawn_columns = ["manual_fraud", "bot_fraud"] + self.attributes
+        self.probabilities = np.array(
+            [
+                [self.sample_params[key][label] for label in ["manual_fraud", "bot_fraud"]]
+                + [self.sample_params[key]["attributes"][a] for a in self.attributes]
+                for key in self.profiles
+            ],
+            dtype=float,
+        )
+
+    @property
+    def num_rows(self):
+        return int(self.bounds[-1])
+
+    @property
+    def columns(self):
+        return self.labels + self.attributes
+
+    def resolve_seed(self):
+        """Seed of the chunk streams"""
+        if self.seed is None:
+            self.seed = int(np.random.randint(0, 2**31 - 1))
+        return self.seed
+
+    def chunk_ranges(self, chunk_size):
+        """(start, stop) row range of every chunk"""
+        return [
+            (start, min(start + chunk_size, self.num_rows))
+            for start in range(0, self.num_rows, chunk_size)
+        ]
+
+    def generate_chunk(self, start, stop, chunk_index, seed):
+        """
+        Generate rows start to stop into int8 columns: labels and attributes are 0/1 (MISSING
+        for null attribute probabilities), visitor_profile is the index into self.profiles
+        :return: Dictionary of column name -> int8 array of stop - start rows
+        """
+        rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(chunk_index,)))
+        num_rows = stop - start
+        chunk = {column: np.empty(num_rows, dtype=np.int8) for column in self.columns}
+        uniform = np.empty(num_rows, dtype=np.float32)
+        for code, key in enumerate(self.profiles):
+            low = max(start, int(self.bounds[code])) - start
+            high = min(stop, int(self.bounds[code + 1])) - start
+            if low >= high:
+                continue
+            chunk["visitor_profile"][low:high] = code
+            draws = uniform[: high - low]
+            for column, probability in zip(self.drawn_columns, self.probabilities[code]):
+                if np.isnan(probability):
+                    chunk[column][low:high] = MISSING
+                    continue
+                rng.random(dtype=np.float32, out=draws)
+                np.less(draws, probability, out=chunk[column][low:high], casting="unsafe")
+        return chunk
+
+    def iter_chunks(self, chunk_size=1000000, processes=1):
+        """
+        Yield (start row, chunk) in row order. With processes > 1 the chunks are generated in
+        a process pool, at most 2 * processes ahead of the consumer to bound memory
+        """
+        seed = self.resolve_seed()
+        ranges = self.chunk_ranges(chunk_size)
+        if processes <= 1:
+            for index, (start, stop) in enumerate(ranges):
+                yield start, self.generate_chunk(start, stop, index, seed)
+            return
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            pending = []
+            for index, (start, stop) in enumerate(ranges):
+                pending.append(
+                    (start, executor.submit(self.generate_chunk, start, stop, index, seed))
+                )
+                if len(pending) >= 2 * processes:
+                    start, future = pending.pop(0)
+                    yield start, future.result()
+            for start, future in pending:
+                yield start, future.result()
+
+    def chunk_frame(self, chunk):
+        """
+        DataFrame of a chunk: visitor_profile as a categorical of profile names, attributes
+        with missing values as nullable Int8 columns, everything else int8
+        """
+        frame = {}
+        for column in self.columns:
+            values = chunk[column]
+            if column == "visitor_profile":
+                frame[column] = pd.Categorical.from_codes(values, categories=self.profiles)
+            elif column in self.attributes:
+                frame[column] = nullable_column(values)
+            else:
+                frame[column] = values
+        return pd.DataFrame(frame)
+
+    def generate_data(self, chunk_size=1000000, processes=1):
+        """Generate a sample dataset based on the rules/probabilities encoded into the self.sample_params json file"""
+        columns = {column: np.empty(self.num_rows, dtype=np.int8) for column in self.columns}
+        for start, chunk in self.iter_chunks(chunk_size, processes):
+            for column, values in chunk.items():
+                columns[column][start : start + len(values)] = values
+        return self.chunk_frame(columns)
 
-    def generate_label(self, label: str, key: str):
-        """Generate a label vector for a particular visitor profile"""
-        if label == "visitor_profile":
-            key_data = [key] * int(self.sample_params[key]["traffic_pct"] * self.num_samples)
+    def write_chunks(self, directory, file_format="npy", chunk_size=1000000, processes=1):
+        """
+        Stream the dataset to directory without holding more than a few chunks in memory:
+        - npy: one int8 <column>.npy per column (load_columns() memory-maps them)
+        - parquet: data.parquet with one row group per chunk (needs pyarrow)
+        - csv: data.csv, appended chunk by chunk
+        plus metadata.json (profiles, seed, chunk size, missing value)
+        :return: Path of the metadata file
+        """
+        os.makedirs(directory, exist_ok=True)
+        seed = self.resolve_seed()
+        chunks = self.iter_chunks(chunk_size, processes)
+        if file_format == "npy":
+            # chunks arrive in row order: write the .npy headers, then append each chunk's bytes
+            header = {"descr": "|i1", "fortran_order": False, "shape": (self.num_rows,)}
+            outputs = {
+                column: open(os.path.join(directory, f"{column}.npy"), "wb")
+                for column in self.columns
+            }
+            try:
+                for output in outputs.values():
+                    np.lib.format.write_array_header_1_0(output, header)
+                for _, chunk in chunks:
+                    for column, values in chunk.items():
+                        outputs[column].write(values.tobytes())
+            finally:
+                for output in outputs.values():
+                    output.close()
+        elif file_format == "parquet":
+            try:
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+            except ImportError as error:
+                raise ImportError("file_format='parquet' requires pyarrow") from error
+            writer = None
+            for _, chunk in chunks:
+                table = pa.Table.from_pandas(self.chunk_frame(chunk), preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(os.path.join(directory, "data.parquet"), table.schema)
+                writer.write_table(table)
+            if writer is not None:
+                writer.close()
+        elif file_format == "csv":
+            path = os.path.join(directory, "data.csv")
+            for start, chunk in chunks:
+                self.chunk_frame(chunk).to_csv(
+                    path, mode="w" if start == 0 else "a", header=start == 0, index=False
+                )
         else:
-            key_data = np.random.binomial(
-                1,
-                self.sample_params[key][label],
-                int(self.sample_params[key]["traffic_pct"] * self.num_samples),
-            )
-        return key_data
-
-    def generate_attribute(self, attribute, key):
-        """Generate an attribute vector for a particular visitor profile"""
-        if self.sample_params[key]["attributes"][attribute] is not None:
-            key_data = np.random.binomial(
-                1,
-                self.sample_params[key]["attributes"][attribute],
-                int(self.sample_params[key]["traffic_pct"] * self.num_samples),
+            raise ValueError(f"unknown file_format {file_format!r}: npy, parquet or csv")
+
+        metadata_path = os.path.join(directory, "metadata.json")
+        with open(metadata_path, "w") as fp:
+            json.dump(
+                {
+                    "format": file_format,
+                    "num_rows": self.num_rows,
+                    "columns": self.columns,
+                    "profiles": self.profiles,
+                    "missing": MISSING,
+                    "seed": seed,
+                    "chunk_size": chunk_size,
+                },
+                fp,
+                indent=2,
             )
-        else:
-            key_data = int(self.sample_params[key]["traffic_pct"] * self.num_samples) * [None]
-        return key_data
+        return metadata_path
 
-    def generate_data(self):
-        """Generate a sample dataset based on the rules/probabilities encoded into the self.sample_params json file"""
-        sample_df = pd.DataFrame()
-        # Generate labels
-        for label in self.labels:
-            col_data = []
-            for key in self.sample_params.keys():
-                col_data.extend(self.generate_label(label, key))
-            sample_df[label] = col_data
-
-        # Generate attributes
-        for attribute in self.attributes:
-            col_data = []
-            for key in self.sample_params.keys():
-                col_data.extend(self.generate_attribute(attribute, key))
-            sample_df[attribute] = col_data
-
-        return sample_df
-
-    def add_nulls(self, df: pd.DataFrame, frac: float):
-        """Add noise to a DataFrame by replacing random cells with missing values"""
-
-        inds = np.random.randint(
-            low=0, high=len(df), size=int(len(df) * len(self.attributes) * frac)
-        )
-        cols = np.random.randint(low=0, high=len(self.attributes), size=len(inds))
-        x = df[self.attributes].astype(object).to_numpy()
-        x[inds, cols] = None
-        df[self.attributes] = x
+    def noise_rng(self, seed=None):
+        """Generator for noise injection; seed None draws one from np.random"""
+        return np.random.default_rng(int(np.random.randint(0, 2**31 - 1)) if seed is None else seed)
+
+    def add_nulls(self, df: pd.DataFrame, frac: float, seed=None):
+        """
+        Add noise to a DataFrame by replacing int(rows * attributes * frac) distinct random
+        attribute cells with missing values. Works column by column on int8 codes, noisy
+        columns become nullable Int8 (values plus a validity mask, no object arrays)
+        """
+        rng = self.noise_rng(seed)
+        positions = sample_cells(rng, len(df), len(self.attributes), frac)
+        for attribute, rows in zip(self.attributes, positions):
+            if len(rows):
+                values = column_codes(df[attribute])
+                values[rows] = MISSING
+                df[attribute] = nullable_column(values)
         return df
 
-    def flip_booleans(self, df: pd.DataFrame, frac: float):
-        """Add noise to a DataFrame by flipping random the True/False values of random cells"""
-        inds = np.random.randint(range(len(df)), int(len(df) * frac), replace=True)
-        cols = np.random.randint(range(len(self.attributes)), len(inds), replace=True)
-        x = df[self.attributes].astype(object).to_numpy()
-        x[inds, cols] = (x[inds, cols] + 1) % 2
-        df[self.attributes] = x
+    def flip_booleans(self, df: pd.DataFrame, frac: float, seed=None):
+        """
+        Add noise to a DataFrame by flipping the 0/1 values of int(rows * attributes * frac)
+        distinct random attribute cells (missing cells stay missing)
+        """
+        rng = self.noise_rng(seed)
+        positions = sample_cells(rng, len(df), len(self.attributes), frac)
+        for attribute, rows in zip(self.attributes, positions):
+            if len(rows):
+                values = column_codes(df[attribute])
+                flipped = values[rows]
+                values[rows] = np.where(flipped == MISSING, MISSING, 1 - flipped)
+                df[attribute] = nullable_column(values)
         return df
 
+
+def sample_cells(rng, num_rows, num_columns, frac):
+    """
+    Draw int(num_rows * num_columns * frac) distinct cells of a num_rows x num_columns grid,
+    uniformly without replacement (per-column counts are multivariate hypergeometric)
+    :return: List of row index arrays, one per column
+    """
+    num_cells = min(int(num_rows * num_columns * frac), num_rows * num_columns)
+    counts = rng.multivariate_hypergeometric([num_rows] * num_columns, num_cells)
+    return [rng.choice(num_rows, count, replace=False) for count in counts]
+
+
+def column_codes(series):
+    """Writable int8 copy of a 0/1 column, MISSING where it is null"""
+    return np.array(series.to_numpy(dtype=np.int8, na_value=MISSING), dtype=np.int8)
+
+
+def nullable_column(values):
+    """Nullable Int8 array over int8 codes if any is MISSING, otherwise the codes themselves"""
+    missing = values == MISSING
+    return pd.arrays.IntegerArray(values, missing) if missing.any() else values
+
+
+def feature_matrix(df, features):
+    """LightGBM-ready float32 matrix of the feature columns, NaN where missing"""
+    X = np.empty((len(df), len(features)), dtype=np.float32)
+    for number, feature in enumerate(features):
+        X[:, number] = df[feature].to_numpy(dtype=np.float32, na_value=np.nan)
+    return X
+
+
+def load_columns(directory, mmap_mode="r"):
+    """Read the .npy columns written by DataMocker.write_chunks, memory-mapped by default"""
+    with open(os.path.join(directory, "metadata.json")) as fp:
+        metadata = json.load(fp)
+    columns = {
+        column: np.load(os.path.join(directory, f"{column}.npy"), mmap_mode=mmap_mode)
+        for column in metadata["columns"]
+    }
+    return columns, metadata
+
+
+def check_generation(params_loc="default_data_parameters.json", num_samples=200000):
+    """
+    Same seed and chunk size give identical data whether chunks come from one process or a
+    pool, and every profile's column means match its probabilities
+    """
+    mocker = DataMocker(num_samples, params_loc, seed=7)
+    serial = dict(mocker.iter_chunks(chunk_size=30000))
+    pooled = dict(mocker.iter_chunks(chunk_size=30000, processes=2))
+    assert serial.keys() == pooled.keys()
+    for start in serial:
+        for column in mocker.columns:
+            assert np.array_equal(serial[start][column], pooled[start][column]), (start, column)
+
+    data = mocker.generate_data(chunk_size=30000)
+    assert len(data) == int(mocker.bounds[-1])
+    for code, key in enumerate(mocker.profiles):
+        rows = data[data["visitor_profile"] == key]
+        assert len(rows) == int(mocker.profile_distribution[key] * num_samples), key
+        for column, probability in zip(mocker.drawn_columns, mocker.probabilities[code]):
+            if np.isnan(probability):
+                assert rows[column].isna().all(), (key, column)
+            elif len(rows):
+                error = 5 * np.sqrt(probability * (1 - probability) / len(rows)) + 1e-9
+                assert abs(rows[column].mean() - probability) <= error, (key, column)
+    return len(data)
+
+
+def check_noise(params_loc="default_data_parameters.json", num_samples=100000, frac=0.05):
+    """
+    add_nulls and flip_booleans change exactly int(rows * attributes * frac) distinct
+    attribute cells, keep compact dtypes and are repeatable for a seed
+    """
+    mocker = DataMocker(num_samples, params_loc, seed=3)
+    data = mocker.generate_data()
+    before = feature_matrix(data, mocker.attributes)
+    expected = int(len(data) * len(mocker.attributes) * frac)
+
+    flipped = feature_matrix(mocker.flip_booleans(data.copy(), frac, seed=1), mocker.attributes)
+    changed = (before != flipped) & ~np.isnan(before)
+    assert changed.sum() + np.isnan(before[sample_mask(mocker, len(data), frac)]).sum() == expected
+    assert np.array_equal(np.isnan(before), np.isnan(flipped))
+
+    nulled = mocker.add_nulls(data.copy(), frac, seed=1)
+    assert all(str(dtype) in ("int8", "Int8", "category") for dtype in nulled.dtypes)
+    new_nulls = np.isnan(feature_matrix(nulled, mocker.attributes)) & ~np.isnan(before)
+    assert (
+        new_nulls.sum() == expected - np.isnan(before[sample_mask(mocker, len(data), frac)]).sum()
+    )
+    assert mocker.add_nulls(data.copy(), frac, seed=1).equals(nulled)
+    return expected
+
+
+def sample_mask(mocker, num_rows, frac, seed=1):
+    """Boolean grid of the cells the noise methods pick for a seed"""
+    mask = np.zeros((num_rows, len(mocker.attributes)), dtype=bool)
+    positions = sample_cells(mocker.noise_rng(seed), num_rows, len(mocker.attributes), frac)
+    for number, rows in enumerate(positions):
+        mask[rows, number] = True
+    return mask
+
+
+def object_add_nulls(mocker, df, frac):
+    """The previous add_nulls: round trip of every attribute through an object array"""
+    inds = np.random.randint(low=0, high=len(df), size=int(len(df) * len(mocker.attributes) * frac))
+    cols = np.random.randint(low=0, high=len(mocker.attributes), size=len(inds))
+    x = df[mocker.attributes].to_numpy(dtype=object, na_value=None)
+    x[inds, cols] = None
+    df[mocker.attributes] = x
+    return df
+
+
+def noise_peak_rss(method, params_loc, num_samples, frac):
+    """
+    Run in a fresh process: generate the data, then add nulls with method ("object" or
+    "compact") and build the LightGBM feature matrix
+    :return: Peak RSS growth during noise injection (MB) and its duration (s)
+    """
+    import resource
+    import time
+
+    mocker = DataMocker(num_samples, params_loc, seed=0)
+    data = mocker.generate_data()
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    if method == "object":
+        data = object_add_nulls(mocker, data, frac)
+        X = data[mocker.attributes].astype(float).to_numpy(dtype=np.float32)
+    else:
+        data = mocker.add_nulls(data, frac, seed=0)
+        X = feature_matrix(data, mocker.attributes)
+    seconds = time.perf_counter() - start
+    del X
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before) / 1024, seconds
+
+
+def benchmark_noise(params_loc="adjusted_data_parameters.json", num_samples=1000000, frac=0.05):
+    """Peak RSS growth and time of both noise paths, each in its own process"""
+    import multiprocessing
+
+    results = {}
+    for method in ["object", "compact"]:
+        with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as executor:
+            results[method] = executor.submit(
+                noise_peak_rss, method, params_loc, num_samples, frac
+            ).result()
+    return results
+
+
 if __name__ == "__main__":
-    arp = DataMocker(num_samples=1000000, params_loc="/Users/tillman/dodgeball/dodgeball-analysis/model_training/adjusted_data_parameters.json")
-    data =  arp.generate_data()
-    data.to_csv("/Users/tillman/dodgeball/dodgeball-analysis/model_training/adjusted_sample_data.csv", index=False)
+    import argparse
+    import resource
+    import time
+
+    parser = argparse.ArgumentParser(description="Generate a synthetic training set")
+    parser.add_argument("output", nargs="?", help="output directory")
+    parser.add_argument("--num-samples", type=int, default=1000000)
+    parser.add_argument("--params-loc", default="adjusted_data_parameters.json")
+    parser.add_argument("--format", choices=["npy", "parquet", "csv"], default="npy")
+    parser.add_argument("--chunk-size", type=int, default=1000000)
+    parser.add_argument("--processes", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--check", action="store_true", help="run the check_* functions first")
+    parser.add_argument(
+        "--benchmark-noise", action="store_true", help="compare noise injection peak RSS and exit"
+    )
+    args = parser.parse_args()
+
+    if args.check:
+        print(f"check_generation: {check_generation()} rows ok")
+        print(f"check_noise: {check_noise()} cells ok")
+    if args.benchmark_noise:
+        for method, (peak_mb, seconds) in benchmark_noise(
+            args.params_loc, args.num_samples
+        ).items():
+            print(
+                f"add_nulls + feature matrix, {method:<7}: +{peak_mb:6.0f} MB peak RSS, {seconds:.2f} s"
+            )
+        raise SystemExit
+    if args.output is None:
+        parser.error("output directory required")
+    start = time.perf_counter()
+    mocker = DataMocker(args.num_samples, args.params_loc, seed=args.seed)
+    metadata_path = mocker.write_chunks(args.output, args.format, args.chunk_size, args.processes)
+    seconds = time.perf_counter() - start
+    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(
+        f"{mocker.num_rows} rows in {seconds:.1f} s ({mocker.num_rows / seconds:,.0f} rows/s), "
+        f"peak RSS {peak_mb:.0f} MB, written to {os.path.dirname(metadata_path)}"
+    )
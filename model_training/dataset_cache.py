@@ -0,0 +1,186 @@
+import hashlib
+import json
+import os
+
+import lightgbm as lgb
+import numpy as np
+import pandas as pd
+
+from data_mocker import feature_matrix, load_columns
+
+LABELS = ["manual_fraud", "bot_fraud"]
+NON_FEATURES = LABELS + ["visitor_profile"]
+# feature_pre_filter off: a binned Dataset is reused with different min_data_in_leaf values
+DATASET_PARAMS = {"feature_pre_filter": False}
+CACHE_VERSION = 1  # bump when the way features are read changes
+
+
+def source_digest(path, block_size=1 << 20):
+    """Content hash of a data file, or of every file of a write_chunks directory"""
+    digest = hashlib.blake2b(digest_size=16)
+    paths = (
+        [os.path.join(path, name) for name in sorted(os.listdir(path))]
+        if os.path.isdir(path)
+        else [path]
+    )
+    for file_path in paths:
+        digest.update(os.path.basename(file_path).encode())
+        with open(file_path, "rb") as fp:
+            for block in iter(lambda: fp.read(block_size), b""):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def csv_dtypes(path):
+    """
+    Explicit dtypes of a DataMocker CSV: int8 labels, categorical profile and float32
+    attributes (NaN where empty; pandas parses nullable Int8 several times slower)
+    """
+    columns = pd.read_csv(path, nrows=0).columns
+    return {
+        column: "int8" if column in LABELS else "category" if column in NON_FEATURES else "float32"
+        for column in columns
+    }
+
+
+def read_csv_chunks(path, chunksize=1000000):
+    """Stream a DataMocker CSV in chunks parsed straight into the compact dtypes"""
+    return pd.read_csv(path, dtype=csv_dtypes(path), chunksize=chunksize)
+
+
+def read_source(path, labels=("manual_fraud",), chunksize=1000000):
+    """
+    Read the features and labels from a DataMocker CSV or a write_chunks .npy directory,
+    chunk by chunk for CSVs
+    :return: float32 feature matrix (NaN where missing), dictionary of int8 label arrays,
+             feature names
+    """
+    if os.path.isdir(path):
+        columns, metadata = load_columns(path)
+        features = [column for column in metadata["columns"] if column not in NON_FEATURES]
+        X = np.empty((metadata["num_rows"], len(features)), dtype=np.float32)
+        for number, feature in enumerate(features):
+            values = columns[feature]
+            X[:, number] = values
+            X[values == metadata["missing"], number] = np.nan
+        return X, {label: np.asarray(columns[label]) for label in labels}, features
+
+    matrices, targets, features = [], {label: [] for label in labels}, None
+    for chunk in read_csv_chunks(path, chunksize):
+        if features is None:
+            features = [column for column in chunk.columns if column not in NON_FEATURES]
+        matrices.append(feature_matrix(chunk, features))
+        for label in labels:
+            targets[label].append(chunk[label].to_numpy())
+    return (
+        np.concatenate(matrices),
+        {label: np.concatenate(values) for label, values in targets.items()},
+        features,
+    )
+
+
+def load_features(path, label="manual_fraud", chunksize=1000000):
+    """:return: float32 feature matrix, int8 labels of one target, feature names"""
+    X, targets, features = read_source(path, [label], chunksize)
+    return X, targets[label], features
+
+
+def cache_path(path, label="manual_fraud", params=None, cache_dir=".dataset_cache"):
+    """Binary Dataset file for a source, label and Dataset parameters"""
+    key = json.dumps(
+        {
+            "source": source_digest(path),
+            "label": label,
+            "params": params or DATASET_PARAMS,
+            "lightgbm": lgb.__version__,
+            "version": CACHE_VERSION,
+        },
+        sort_keys=True,
+    )
+    name = hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+    return os.path.join(cache_dir, f"{label}_{name}.bin")
+
+
+def cached_dataset(path, label="manual_fraud", params=None, cache_dir=".dataset_cache", data=None):
+    """
+    LightGBM Dataset of a data file, binned once: the constructed Dataset is saved in
+    LightGBM's binary format under a hash of the source content, label, Dataset parameters
+    and LightGBM version, and later calls load that file instead of parsing and binning again.
+    data: (X, y, features) of the file if the caller already read it (see load_features)
+    :return: Dataset, path of its binary file, whether it came from the cache
+    """
+    path, params = os.path.expanduser(path), params or DATASET_PARAMS
+    binary_path = cache_path(path, label, params, cache_dir)
+    if os.path.exists(binary_path):
+        return lgb.Dataset(binary_path, params=params), binary_path, True
+
+    X, y, features = data or load_features(path, label)
+    dataset = lgb.Dataset(X, label=y, feature_name=features, params=params, free_raw_data=True)
+    dataset.construct()
+    os.makedirs(cache_dir, exist_ok=True)
+    # write under a temporary name so concurrent runs never read a partial file
+    temporary_path = f"{binary_path}.{os.getpid()}.tmp"
+    dataset.save_binary(temporary_path)
+    os.replace(temporary_path, binary_path)
+    return dataset, binary_path, False
+
+
+def check_cache(num_samples=200000, directory="/tmp/dataset_cache_check"):
+    """
+    A model trained on a cached Dataset matches one trained on the freshly built Dataset,
+    and a changed source gets a new cache entry
+    """
+    import shutil
+
+    from data_mocker import DataMocker
+
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+    csv_path = os.path.join(directory, "data.csv")
+    DataMocker(num_samples, "adjusted_data_parameters.json", seed=0).generate_data().to_csv(
+        csv_path, index=False
+    )
+    cache_dir = os.path.join(directory, "cache")
+    params = {"objective": "binary", "num_leaves": 15, "verbose": -1, "seed": 0}
+
+    fresh, binary_path, hit = cached_dataset(csv_path, cache_dir=cache_dir)
+    assert not hit
+    cached, cached_path, hit = cached_dataset(csv_path, cache_dir=cache_dir)
+    assert hit and cached_path == binary_path
+    X, _, _ = load_features(csv_path)
+    first = lgb.train(params, fresh, 20).predict(X)
+    second = lgb.train(params, cached, 20).predict(X)
+    assert np.allclose(first, second), np.abs(first - second).max()
+
+    with open(csv_path) as fp:
+        fp.readline()
+        row = fp.readline()
+    with open(csv_path, "a") as fp:
+        fp.write(row)
+    assert cache_path(csv_path, cache_dir=cache_dir) != binary_path
+    shutil.rmtree(directory)
+    return len(X)
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description="Build or reuse the binary Dataset of a data file")
+    parser.add_argument("path", nargs="?", help="DataMocker CSV or write_chunks directory")
+    parser.add_argument("--label", default="manual_fraud", choices=LABELS)
+    parser.add_argument("--cache-dir", default=".dataset_cache")
+    parser.add_argument("--check", action="store_true", help="run check_cache")
+    args = parser.parse_args()
+
+    if args.check:
+        print(f"check_cache: {check_cache()} rows ok")
+    if args.path:
+        for _ in range(2):
+            start = time.perf_counter()
+            dataset, binary_path, hit = cached_dataset(args.path, args.label, None, args.cache_dir)
+            dataset.construct()
+            print(
+                f"{'cache hit ' if hit else 'cache miss'} {time.perf_counter() - start:6.2f} s "
+                f"({dataset.num_data()} rows) {binary_path}"
+            )
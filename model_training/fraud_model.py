@@ -1,15 +1,52 @@
-import pandas as pd
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import lightgbm as lgb
+import numpy as np
+from sklearn.metrics import log_loss, roc_auc_score
+
+from data_mocker import DataMocker, feature_matrix
+from dataset_cache import DATASET_PARAMS, NON_FEATURES, cached_dataset, load_features, read_source
+from hyperparameter_search import HyperparameterSearch
+
+TARGETS = ["manual_fraud", "bot_fraud"]
+
+
+def binary_metrics(y, probabilities, threshold=0.5):
+    """AUC, log loss, sensitivity and specificity at threshold, as in metrics_review.ipynb"""
+    predicted, positive = probabilities > threshold, y == 1
+    tp, fn = int((predicted & positive).sum()), int((~predicted & positive).sum())
+    tn, fp = int((~predicted & ~positive).sum()), int((predicted & ~positive).sum())
+    return {
+        "rows": len(y),
+        "positives": tp + fn,
+        "auc": float(roc_auc_score(y, probabilities)) if 0 < tp + fn < len(y) else None,
+        "log_loss": float(log_loss(y, probabilities, labels=[0, 1])),
+        "threshold": threshold,
+        "sensitivity": tp / (tp + fn) if tp + fn else None,
+        "specificity": tn / (tn + fp) if tn + fp else None,
+    }
+
 
-from loss_funcs import logloss, logloss_eval
-from data_mocker import DataMocker
+def split_rows(num_rows, test_size=0.3, seed=0):
+    """Sorted random train and test row indices"""
+    order = np.random.default_rng(seed).permutation(num_rows)
+    num_test = int(num_rows * test_size)
+    return np.sort(order[num_test:]), np.sort(order[:num_test])
 
 
 class FraudModel:
     def __init__(
-        self, hyperparam_dict=None, optimization_dict=None, data_path=None, run_hyperopt=False
+        self,
+        hyperparam_dict=None,
+        optimization_dict=None,
+        data_path=None,
+        run_hyperopt=False,
+        cache_dir=".dataset_cache",
     ):
-        self.run_hyperopt = run_hyperopt
+        self.hyperopt = run_hyperopt  # not self.run_hyperopt, which would hide the method
         self.hyperparamaters = hyperparam_dict or {
             "bagging_fraction": 0.8805141557918836,
             "feature_fraction": 0.5233501744144564,
@@ -35,85 +72,196 @@ class FraudModel:
             "subsample": (0.01, 1.0),
         }
         self.data_path = data_path
+        self.cache_dir = cache_dir  # binary Datasets of data_path, see dataset_cache.py
+        self.binary_path = None
 
-    def train(self):
-        if self.data_path is not None:
-            data = pd.read_csv(self.data_path)
-        else:
+    def initialize_data(self):
+        """Mock a training set like adjusted_sample_data.csv when no data_path is given"""
+        return DataMocker(1000000, "adjusted_data_parameters.json").generate_data()
+
+    def prepare_data(self, label="manual_fraud"):
+        """Binned training Dataset, loaded from the binary cache while data_path is unchanged"""
+        if self.data_path is None:
             data = self.initialize_data()
-        model_features = list(set(data.columns) - set(("manual_fraud", "bot_fraud")))
-        X = data[model_features]
-        y = data["manual_fraud"]
-        if self.run_hyperopt:
-            model_params = bayes_parameter_opt_lgb(
-                X_train.drop(columns=["visitor_profile"]),
-                y_train,
-                init_round=5,
-                opt_round=10,
-                n_folds=3,
-                random_seed=6,
+            features = [column for column in data.columns if column not in NON_FEATURES]
+            return lgb.Dataset(
+                feature_matrix(data, features),
+                label=data[label].to_numpy(),
+                feature_name=features,
+                params=DATASET_PARAMS,
+            )
+        dataset, self.binary_path, hit = cached_dataset(
+            self.data_path, label, cache_dir=self.cache_dir
+        )
+        print(f"{'reusing' if hit else 'built'} binary Dataset {self.binary_path}")
+        return dataset
+
+    def train(self):
+        d_train = self.prepare_data()
+        if self.hyperopt:
+            model_params = self.run_hyperopt(
+                d_train, init_round=5, opt_round=10, n_folds=3, random_seed=6
             )
         else:
             model_params = self.hyperparamaters
-        d_train = lgb.Dataset(X.drop(columns=["visitor_profile"]), label=y)
         model = lgb.train(model_params, d_train, 250)
         model.save_model("manual_fraud_model.pkl")
 
-    def run_hyperopt(self, X, y, init_round=15, opt_round=25, n_folds=3, random_seed=6):
-        train_data = lgb.Dataset(data=X, label=y, free_raw_data=False)
-
-        def lgb_eval(
-            learning_rate,
-            num_leaves,
-            feature_fraction,
-            bagging_fraction,
-            max_depth,
-            min_data_in_leaf,
-            min_sum_hessian_in_leaf,
-            subsample,
-        ):
-            params = {"application": "binary"}
-            params["learning_rate"] = max(min(learning_rate, 1), 0)
-            params["num_leaves"] = int(round(num_leaves))
-            params["feature_fraction"] = max(min(feature_fraction, 1), 0)
-            params["bagging_fraction"] = max(min(bagging_fraction, 1), 0)
-            params["max_depth"] = int(round(max_depth))
-            params["min_data_in_leaf"] = int(round(min_data_in_leaf))
-            params["min_sum_hessian_in_leaf"] = min_sum_hessian_in_leaf
-            params["subsample"] = max(min(subsample, 1), 0)
-
-            cv_result = lgb.cv(
-                params,
-                train_data,
-                nfold=n_folds,
-                seed=random_seed,
-                stratified=True,
-                verbose_eval=200,
-                fobj=logloss,
-                feval=logloss_eval,
-            )
-            return max(cv_result["auc-mean"])
-
-        lgbBO = BayesianOptimization(lgb_eval, self.opt_boundaries, random_state=200,)
-
-        lgbBO.maximize(init_points=init_round, n_iter=opt_round)
+    def fit(self, dataset, num_rounds=250, threads=None):
+        """:return: Booster trained with self.hyperparamaters, training seconds"""
+        params = dict(self.hyperparamaters, verbose=-1)
+        if threads:
+            params["num_threads"] = threads
+        start = time.perf_counter()
+        booster = lgb.train(params, dataset, num_rounds)
+        return booster, time.perf_counter() - start
 
-        model_auc = []
-        for model in range(len(lgbBO.res)):
-            model_auc.append(lgbBO.res[model]["target"])
+    def train_targets(
+        self,
+        labels=TARGETS,
+        output_dir=".",
+        num_rounds=250,
+        test_size=0.3,
+        threshold=0.5,
+        seed=0,
+        shared=True,
+    ):
+        """
+        Train and evaluate one model per label on a random train / test split of data_path.
+        shared: read and bin the feature table once (through the binary Dataset cache) and
+        train the labels concurrently on subsets of that one Dataset, each with its own labels
+        and its share of the cores. Otherwise every label is a full sequential run: read, bin
+        and train with all cores (the comparison baseline).
+        Writes <label>_model.txt for every label and metrics_report.json to output_dir
+        :return: Report of the test metrics and timings per label
+        """
+        if self.data_path is None:
+            raise ValueError("train_targets reads its data from data_path")
+        start = time.perf_counter()
+        cores = os.cpu_count() or 1
+        boosters, tests = {}, {}
+        if shared:
+            X, targets, features = read_source(os.path.expanduser(self.data_path), labels)
+            dataset, self.binary_path, _ = cached_dataset(
+                self.data_path,
+                labels[0],
+                cache_dir=self.cache_dir,
+                data=(X, targets[labels[0]], features),
+            )
+            train_rows, test_rows = split_rows(len(X), test_size, seed)
+            subsets = {}
+            for label in labels:
+                subsets[label] = dataset.subset(train_rows).construct()
+                subsets[label].set_label(targets[label][train_rows])
+            threads = max(1, cores // len(labels))
+            with ThreadPoolExecutor(len(labels)) as executor:
+                fitted = executor.map(
+                    lambda label: self.fit(subsets[label], num_rounds, threads), labels
+                )
+                boosters = dict(zip(labels, fitted))
+            for label in labels:
+                tests[label] = (X[test_rows], targets[label][test_rows])
+        else:
+            for label in labels:
+                X, y, features = load_features(os.path.expanduser(self.data_path), label)
+                train_rows, test_rows = split_rows(len(X), test_size, seed)
+                dataset = lgb.Dataset(
+                    X[train_rows], label=y[train_rows], feature_name=features, params=DATASET_PARAMS
+                )
+                boosters[label] = self.fit(dataset, num_rounds, cores)
+                tests[label] = (X[test_rows], y[test_rows])
 
-        opt_params = lgbBO.res[pd.Series(model_auc).idxmax()]["params"]
-        opt_params["num_leaves"] = int(round(opt_params[1]["num_leaves"]))
-        opt_params["max_depth"] = int(round(opt_params[1]["max_depth"]))
-        opt_params["min_data_in_leaf"] = int(round(opt_params[1]["min_data_in_leaf"]))
-        opt_params["objective"] = "binary"
-        opt_params["metric"] = "auc"
-        opt_params["is_unbalance"] = True
-        opt_params["boost_from_average"] = False
+        os.makedirs(output_dir, exist_ok=True)
+        report = {"data_path": self.data_path, "shared": shared, "targets": {}}
+        for label in labels:
+            booster, seconds = boosters[label]
+            model_file = os.path.join(output_dir, f"{label}_model.txt")
+            booster.save_model(model_file)
+            X_test, y_test = tests[label]
+            report["targets"][label] = dict(
+                binary_metrics(y_test, booster.predict(X_test), threshold),
+                train_seconds=seconds,
+                model_file=model_file,
+            )
+        report["wall_seconds"] = time.perf_counter() - start
+        with open(os.path.join(output_dir, "metrics_report.json"), "w") as fp:
+            json.dump(report, fp, indent=2)
+        return report
 
+    def run_hyperopt(
+        self, train_data, init_round=15, opt_round=25, n_folds=3, random_seed=6, **search_options
+    ):
+        """
+        Search opt_boundaries with init_round random and opt_round Bayesian trials, in parallel
+        batches with successive halving (see hyperparameter_search.py for search_options).
+        Finished trials are checkpointed next to the cached Dataset, so an interrupted search
+        on the same data resumes.
+        """
+        if self.binary_path is None:  # mocked in memory: the worker processes read it from disk
+            os.makedirs(self.cache_dir, exist_ok=True)
+            binary_path = os.path.join(self.cache_dir, f"mocked_{os.getpid()}.bin")
+            train_data.save_binary(binary_path)
+            checkpoint_path = None
+        else:
+            binary_path = self.binary_path
+            checkpoint_path = os.path.splitext(binary_path)[0] + "_trials.jsonl"
+        search = HyperparameterSearch(
+            binary_path,
+            self.opt_boundaries,
+            n_trials=init_round + opt_round,
+            n_folds=n_folds,
+            init_points=init_round,
+            seed=random_seed,
+            checkpoint_path=checkpoint_path,
+            **search_options,
+        )
+        try:
+            opt_params, _ = search.run()
+        finally:
+            if checkpoint_path is None:
+                os.remove(binary_path)
         return opt_params
 
 
 if __name__ == "__main__":
-    model = FraudModel(data_path="~/dodgeball/dodgeball-analysis/model_training/adjusted_sample_data.csv")
-    model.train()
+    import argparse
+    import tempfile
+
+    parser = argparse.ArgumentParser(description="Train the fraud models")
+    parser.add_argument(
+        "data_path",
+        nargs="?",
+        default="~/dodgeball/dodgeball-analysis/model_training/adjusted_sample_data.csv",
+        help="DataMocker CSV or write_chunks directory",
+    )
+    parser.add_argument("--all-targets", action="store_true", help="train bot and manual fraud")
+    parser.add_argument("--output-dir", default=".")
+    parser.add_argument("--num-rounds", type=int, default=250)
+    parser.add_argument(
+        "--compare-sequential",
+        action="store_true",
+        help="with --all-targets: time against one full run per target, cache cold",
+    )
+    args = parser.parse_args()
+
+    if not args.all_targets:
+        FraudModel(data_path=args.data_path).train()
+    elif not args.compare_sequential:
+        report = FraudModel(data_path=args.data_path).train_targets(
+            output_dir=args.output_dir, num_rounds=args.num_rounds
+        )
+        print(json.dumps(report, indent=2))
+    else:
+        reports = {}
+        for shared in (False, True):
+            with tempfile.TemporaryDirectory() as cache_dir:
+                model = FraudModel(data_path=args.data_path, cache_dir=cache_dir)
+                reports[shared] = model.train_targets(
+                    output_dir=args.output_dir, num_rounds=args.num_rounds, shared=shared
+                )
+        print(json.dumps(reports[True], indent=2))
+        sequential, shared = reports[False]["wall_seconds"], reports[True]["wall_seconds"]
+        print(
+            f"shared dataset {shared:.1f} s, two sequential runs {sequential:.1f} s "
+            f"(x{sequential / shared:.2f}) on {os.cpu_count()} cores"
+        )
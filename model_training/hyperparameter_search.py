@@ -0,0 +1,374 @@
+import json
+import math
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import lightgbm as lgb
+import numpy as np
+
+from dataset_cache import DATASET_PARAMS
+
+INTEGER_PARAMS = ["num_leaves", "max_depth", "min_data_in_leaf"]
+FIXED_PARAMS = {
+    "objective": "binary",
+    "metric": "auc",
+    "is_unbalance": True,
+    "boost_from_average": False,
+}
+
+
+def lgb_params(suggestion):
+    """Clip and round a sampled point to valid LightGBM parameters (as FraudModel.train uses)"""
+    params = dict(suggestion)
+    for name in ["learning_rate", "feature_fraction", "bagging_fraction", "subsample"]:
+        if name in params:
+            params[name] = max(min(params[name], 1), 0)
+    for name in INTEGER_PARAMS:
+        if name in params:
+            params[name] = int(round(params[name]))
+    params.update(FIXED_PARAMS)
+    return params
+
+
+def cross_validate(binary_path, params, num_rounds, n_folds, seed, early_stopping_rounds):
+    """
+    Stratified n_folds CV of one configuration on a binary Dataset, stopped once the mean AUC
+    has not improved for early_stopping_rounds. Runs in a worker process.
+    :return: Dictionary of best mean AUC, its iteration and the wall time
+    """
+    start = time.perf_counter()
+    train_data = lgb.Dataset(binary_path, params=DATASET_PARAMS)
+    result = lgb.cv(
+        dict(params, verbose=-1, seed=seed),
+        train_data,
+        num_boost_round=num_rounds,
+        nfold=n_folds,
+        stratified=True,
+        seed=seed,
+        callbacks=[lgb.early_stopping(early_stopping_rounds, verbose=False)],
+    )
+    aucs = result[next(key for key in result if key.endswith("auc-mean"))]
+    return {
+        "auc": float(aucs[-1]),
+        "best_iteration": len(aucs),
+        "seconds": time.perf_counter() - start,
+    }
+
+
+class RandomSampler:
+    """Uniform samples of the boundaries, reproducible from the seed"""
+
+    def __init__(self, boundaries, seed=0):
+        self.boundaries = boundaries
+        self.rng = np.random.default_rng(seed)
+
+    def suggest(self, count):
+        return [
+            {
+                name: float(self.rng.uniform(low, high))
+                for name, (low, high) in self.boundaries.items()
+            }
+            for _ in range(count)
+        ]
+
+    def register(self, suggestion, target):
+        pass
+
+
+class BayesianSampler:
+    """
+    bayes_opt's ask/tell interface: random points until init_points results are registered,
+    then upper confidence bound suggestions with kappas spread over the batch, so one batch
+    mixes exploitation and exploration instead of repeating one point. bayes_opt 1.2.0 (as
+    pinned in requirements.txt) only runs with its pinned numpy and scipy: it uses np.float,
+    removed in numpy 1.24, and expects the array results scipy returned before 1.8
+    """
+
+    def __init__(self, boundaries, seed=0, init_points=15, kappas=(1.0, 10.0)):
+        from bayes_opt import BayesianOptimization, UtilityFunction
+
+        self.utility = UtilityFunction
+        self.optimizer = BayesianOptimization(
+            f=None, pbounds=boundaries, random_state=seed, verbose=0
+        )
+        self.init_points = init_points
+        self.kappas = kappas
+
+    def suggest(self, count):
+        space = self.optimizer.space
+        if len(space) < self.init_points:
+            return [space.array_to_params(space.random_sample()) for _ in range(count)]
+        return [
+            self.optimizer.suggest(self.utility(kind="ucb", kappa=kappa, xi=0.0))
+            for kappa in np.geomspace(*self.kappas, count)
+        ]
+
+    def register(self, suggestion, target):
+        try:
+            self.optimizer.register(params=suggestion, target=target)
+        except KeyError:  # the same point suggested twice
+            pass
+
+
+class HyperparameterSearch:
+    """
+    Batched hyperparameter search over a binary LightGBM Dataset (see dataset_cache.py).
+
+    Every batch of batch_size sampled configurations goes through successive halving: all are
+    cross-validated with min_rounds boosting rounds, the best 1 / eta continue with eta times
+    as many rounds, and so on up to max_rounds. CV early stopping ends a configuration whose
+    AUC stopped improving; its result is then final and it is not re-run at larger budgets.
+    Evaluations of a rung run concurrently in a process pool, each LightGBM run capped at
+    threads_per_trial threads.
+
+    Every finished evaluation is appended to the checkpoint (JSON lines). A search restarted
+    with the same settings and checkpoint regenerates the same configurations and reads the
+    finished evaluations back instead of repeating them, so an interrupted search resumes.
+    """
+
+    def __init__(
+        self,
+        binary_path,
+        boundaries,
+        n_trials=40,
+        batch_size=None,
+        threads_per_trial=1,
+        processes=None,
+        n_folds=3,
+        min_rounds=30,
+        max_rounds=250,
+        eta=3,
+        early_stopping_rounds=20,
+        checkpoint_path=None,
+        time_budget=None,
+        sampler="bayes",
+        init_points=15,
+        seed=6,
+    ):
+        self.binary_path = binary_path
+        self.boundaries = boundaries
+        self.n_trials = n_trials
+        self.threads_per_trial = threads_per_trial
+        self.processes = processes or max(1, (os.cpu_count() or 1) // threads_per_trial)
+        self.batch_size = batch_size or max(2 * self.processes, eta)
+        self.n_folds = n_folds
+        self.eta = eta
+        self.early_stopping_rounds = early_stopping_rounds
+        self.checkpoint_path = checkpoint_path
+        self.time_budget = time_budget  # seconds after which no new batch is started
+        self.seed = seed
+        self.budgets = sorted(
+            {
+                min(min_rounds * eta**rung, max_rounds)
+                for rung in range(math.ceil(math.log(max_rounds / min_rounds, eta)) + 1)
+            }
+        )
+        self.sampler = (
+            BayesianSampler(boundaries, seed, init_points)
+            if sampler == "bayes"
+            else RandomSampler(boundaries, seed)
+        )
+        self.finished = self.load_checkpoint()
+        self.evaluated = 0  # evaluations run by this process (not read from the checkpoint)
+
+    def load_checkpoint(self):
+        """:return: Dictionary of (trial, rounds) -> checkpoint record"""
+        finished = {}
+        if self.checkpoint_path and os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path) as fp:
+                for line in fp:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:  # empty, or cut off by an interrupted write
+                        continue
+                    finished[(record["trial"], record["rounds"])] = record
+        return finished
+
+    def save(self, record):
+        self.finished[(record["trial"], record["rounds"])] = record
+        if self.checkpoint_path:
+            with open(self.checkpoint_path, "a") as fp:
+                fp.write(json.dumps(record) + "\n")
+
+    def run_rung(self, executor, trials, rounds):
+        """Cross-validate every (trial id, params) with rounds boosting rounds, or reuse results"""
+        futures = {}
+        for trial, params in trials:
+            record = self.finished.get((trial, rounds))
+            if record is not None:
+                if record["params"] != params:
+                    raise ValueError(
+                        f"checkpoint {self.checkpoint_path} has other parameters for trial "
+                        f"{trial}: it belongs to a search with different settings"
+                    )
+                continue
+            future = executor.submit(
+                cross_validate,
+                self.binary_path,
+                dict(params, num_threads=self.threads_per_trial),
+                rounds,
+                self.n_folds,
+                self.seed,
+                self.early_stopping_rounds,
+            )
+            futures[future] = (trial, params)
+        for future in as_completed(futures):
+            trial, params = futures[future]
+            self.save(dict(future.result(), trial=trial, rounds=rounds, params=params))
+            self.evaluated += 1
+        return [self.finished[(trial, rounds)] for trial, _ in trials]
+
+    def run_batch(self, executor, batch_number, suggestions):
+        """Successive halving of one batch; :return: the final record of every configuration"""
+        trials = [
+            (f"{batch_number}-{number}", lgb_params(suggestion))
+            for number, suggestion in enumerate(suggestions)
+        ]
+        final = {}
+        for rung, rounds in enumerate(self.budgets):
+            records = self.run_rung(executor, trials, rounds)
+            for record in records:
+                final[record["trial"]] = record
+            # stopped early: more rounds would give the same result
+            trials = [
+                (record["trial"], record["params"])
+                for record in records
+                if record["best_iteration"] > rounds - self.early_stopping_rounds
+            ]
+            if rung + 1 < len(self.budgets):
+                keep = math.ceil(len(records) / self.eta)
+                best = {
+                    record["trial"]
+                    for record in sorted(records, key=lambda r: r["auc"], reverse=True)[:keep]
+                }
+                trials = [(trial, params) for trial, params in trials if trial in best]
+            if not trials:
+                break
+        return [final[f"{batch_number}-{number}"] for number in range(len(suggestions))]
+
+    def run(self, log=print):
+        """
+        :return: Best parameters in the shape FraudModel.train expects, and every final record
+        """
+        start = time.perf_counter()
+        results = []
+        context = multiprocessing.get_context("spawn")  # no fork after LightGBM used OpenMP
+        with ProcessPoolExecutor(self.processes, mp_context=context) as executor:
+            for batch_number in range(math.ceil(self.n_trials / self.batch_size)):
+                if self.time_budget and time.perf_counter() - start > self.time_budget:
+                    log(f"time budget of {self.time_budget} s used, stopping")
+                    break
+                count = min(self.batch_size, self.n_trials - batch_number * self.batch_size)
+                suggestions = self.sampler.suggest(count)
+                records = self.run_batch(executor, batch_number, suggestions)
+                for suggestion, record in zip(suggestions, records):
+                    self.sampler.register(suggestion, record["auc"])
+                results.extend(records)
+                best = max(results, key=lambda r: r["auc"])
+                log(
+                    f"batch {batch_number}: {len(results)} trials, best AUC {best['auc']:.5f} "
+                    f"({best['trial']}), {self.evaluated} evaluations run, "
+                    f"{time.perf_counter() - start:.0f} s"
+                )
+        best = max(results, key=lambda r: r["auc"])
+        opt_params = {name: best["params"][name] for name in self.boundaries}
+        opt_params.update(FIXED_PARAMS)
+        return opt_params, results
+
+
+def check_search(directory="/tmp/hyperparameter_search_check", sampler="random"):
+    """
+    A search interrupted after one batch and resumed from its checkpoint evaluates only the
+    missing trials and ends with the result of an uninterrupted search. With sampler="bayes"
+    the second batch comes from the Gaussian process, so the resumed sampler has to suggest
+    the same points after re-registering the checkpointed results
+    """
+    import shutil
+
+    from data_mocker import DataMocker
+    from dataset_cache import cached_dataset
+    from fraud_model import FraudModel
+
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+    data_path = os.path.join(directory, "data")
+    DataMocker(30000, "adjusted_data_parameters.json", seed=0).write_chunks(data_path)
+    _, binary_path, _ = cached_dataset(data_path, cache_dir=directory)
+    settings = dict(
+        boundaries=FraudModel().opt_boundaries,
+        n_trials=6,
+        batch_size=3,
+        processes=2,
+        min_rounds=10,
+        max_rounds=30,
+        early_stopping_rounds=5,
+        sampler=sampler,
+        init_points=3,
+    )
+    quiet = lambda message: None  # noqa: E731
+
+    full_search = HyperparameterSearch(binary_path, **settings)
+    full, full_results = full_search.run(quiet)
+    checkpoint = os.path.join(directory, "trials.jsonl")
+    first = HyperparameterSearch(binary_path, checkpoint_path=checkpoint, **settings)
+    first.n_trials = 3  # interrupted after the first batch
+    first.run(quiet)
+    resumed = HyperparameterSearch(binary_path, checkpoint_path=checkpoint, **settings)
+    opt_params, results = resumed.run(quiet)
+    assert first.evaluated + resumed.evaluated == full_search.evaluated
+    assert opt_params == full and [r["auc"] for r in results] == [r["auc"] for r in full_results]
+    again = HyperparameterSearch(binary_path, checkpoint_path=checkpoint, **settings)
+    assert again.run(quiet)[0] == full and again.evaluated == 0
+    if sampler == "bayes":
+        # every trial registered once; registering a point again is ignored
+        space = again.sampler.optimizer.space
+        assert len(space) == settings["n_trials"]
+        again.sampler.register(space.array_to_params(space.params[0]), 0.5)
+        assert len(space) == settings["n_trials"]
+    shutil.rmtree(directory)
+    return len(results)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from dataset_cache import cached_dataset
+    from fraud_model import FraudModel
+
+    parser = argparse.ArgumentParser(
+        description="Parallel successive halving hyperparameter search"
+    )
+    parser.add_argument("path", nargs="?", help="DataMocker CSV or write_chunks directory")
+    parser.add_argument("--label", default="manual_fraud")
+    parser.add_argument("--cache-dir", default=".dataset_cache")
+    parser.add_argument("--trials", type=int, default=40)
+    parser.add_argument("--batch-size", type=int, default=None)
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--threads-per-trial", type=int, default=1)
+    parser.add_argument("--max-rounds", type=int, default=250)
+    parser.add_argument("--checkpoint", default="hyperparameter_trials.jsonl")
+    parser.add_argument("--time-budget", type=float, default=None, help="seconds")
+    parser.add_argument("--sampler", choices=["bayes", "random"], default="bayes")
+    parser.add_argument("--check", action="store_true", help="run check_search")
+    args = parser.parse_args()
+
+    if args.check:
+        print(f"check_search: {check_search(sampler=args.sampler)} {args.sampler} trials ok")
+    if args.path:
+        _, binary_path, _ = cached_dataset(args.path, args.label, cache_dir=args.cache_dir)
+        search = HyperparameterSearch(
+            binary_path,
+            FraudModel().opt_boundaries,
+            n_trials=args.trials,
+            batch_size=args.batch_size,
+            threads_per_trial=args.threads_per_trial,
+            processes=args.processes,
+            max_rounds=args.max_rounds,
+            checkpoint_path=args.checkpoint,
+            time_budget=args.time_budget,
+            sampler=args.sampler,
+        )
+        opt_params, _ = search.run()
+        print(json.dumps(opt_params, indent=2))
@@ -0,0 +1,350 @@
+import copy
+import json
+import os
+import sys
+import time
+
+import lightgbm as lgb
+import numpy as np
+from sklearn.metrics import roc_auc_score
+
+from data_mocker import DataMocker, feature_matrix
+
+LEAF_FIELDS = ["leaf_value", "leaf_weight", "leaf_count"]
+NODE_FIELDS = [
+    "split_feature",
+    "split_gain",
+    "threshold",
+    "decision_type",
+    "left_child",
+    "right_child",
+    "internal_value",
+    "internal_weight",
+    "internal_count",
+]
+STRUCTURE_FIELDS = ["split_feature", "threshold", "decision_type", "left_child", "right_child"]
+MAX_TOLERANCE_HALVINGS = 8  # then only leaves with equal values are collapsed
+
+
+def parse_model(model_text: str):
+    """Split a LightGBM text model into its header lines, tree dictionaries and trailer"""
+    head, _, rest = model_text.partition("\nTree=")
+    body, _, trailer = ("Tree=" + rest).partition("end of trees")
+    header = [line for line in head.splitlines() if not line.startswith("tree_sizes=")]
+    trees = []
+    for block in body.split("Tree=")[1:]:
+        tree = {}
+        for line in block.splitlines()[1:]:
+            if "=" in line:
+                key, value = line.split("=", 1)
+                tree[key] = value.split() if key in NODE_FIELDS + LEAF_FIELDS else value
+        trees.append(tree)
+    return header, trees, "end of trees" + trailer
+
+
+def format_model(header, trees, trailer):
+    """Inverse of parse_model. tree_sizes is left out, LightGBM then reads the trees in order"""
+    blocks = []
+    for number, tree in enumerate(trees):
+        lines = [
+            f"{key}={' '.join(value) if isinstance(value, list) else value}"
+            for key, value in tree.items()
+        ]
+        blocks.append(f"Tree={number}\n" + "\n".join(lines) + "\n\n\n")
+    return "\n".join(header) + "\n\n" + "".join(blocks) + trailer
+
+
+def leaf_values(tree):
+    return np.array([float(value) for value in tree["leaf_value"]])
+
+
+def collapse_identical_leaves(tree, tolerance=0.0):
+    """
+    Replace every split whose two sides end in leaves with the same value (within tolerance)
+    by a single leaf, bottom up, and renumber the nodes in preorder
+    :return: Number of splits removed
+    """
+    num_splits = int(tree["num_leaves"]) - 1
+    if num_splits == 0:
+        return 0
+    values = leaf_values(tree)
+    nodes, leaves = [], []  # preorder lists of original node indices / merged leaf records
+
+    def simplify(child):
+        """:return: ("leaf", value, [original leaves]) or ("node", original index, left, right)"""
+        if child < 0:
+            return ("leaf", values[~child], [~child])
+        left = simplify(int(tree["left_child"][child]))
+        right = simplify(int(tree["right_child"][child]))
+        if left[0] == "leaf" and right[0] == "leaf" and abs(left[1] - right[1]) <= tolerance:
+            merged = left[2] + right[2]
+            weights = np.array([float(tree["leaf_weight"][leaf]) for leaf in merged])
+            value = np.average(values[merged], weights=weights) if weights.sum() > 0 else left[1]
+            return ("leaf", value, merged)
+        return ("node", child, left, right)
+
+    def emit(item):
+        """:return: Child pointer of item in the renumbered tree"""
+        if item[0] == "leaf":
+            leaves.append(item)
+            return ~(len(leaves) - 1)
+        position = len(nodes)
+        nodes.append([item[1], None, None])
+        nodes[position][1] = emit(item[2])
+        nodes[position][2] = emit(item[3])
+        return position
+
+    emit(simplify(0))
+    if len(nodes) == num_splits:
+        return 0
+
+    for field in NODE_FIELDS:
+        if field in ("left_child", "right_child"):
+            column = 1 if field == "left_child" else 2
+            tree[field] = [str(node[column]) for node in nodes]
+        else:
+            tree[field] = [tree[field][node[0]] for node in nodes]
+    new_leaves = {field: [] for field in LEAF_FIELDS}
+    for _, value, merged in leaves:
+        if len(merged) == 1:
+            for field in LEAF_FIELDS:
+                new_leaves[field].append(tree[field][merged[0]])
+        else:
+            new_leaves["leaf_value"].append(repr(float(value)))
+            new_leaves["leaf_weight"].append(
+                repr(sum(float(tree["leaf_weight"][leaf]) for leaf in merged))
+            )
+            new_leaves["leaf_count"].append(
+                str(sum(int(tree["leaf_count"][leaf]) for leaf in merged))
+            )
+    tree.update(new_leaves)
+    tree["num_leaves"] = str(len(leaves))
+    return num_splits - len(nodes)
+
+
+def structure_key(tree):
+    return tuple(tuple(tree[field]) for field in STRUCTURE_FIELDS) + (tree["num_leaves"],)
+
+
+def merge_identical_trees(trees):
+    """
+    Trees with the same splits give an additive contribution that one tree with the summed
+    leaf values gives as well: keep the first of every structurally identical group
+    :return: List of remaining trees, number of trees merged away
+    """
+    groups = {}
+    for tree in trees:
+        groups.setdefault(structure_key(tree), []).append(tree)
+    merged = []
+    for tree in trees:
+        group = groups.pop(structure_key(tree), None)
+        if group is None:
+            continue
+        if len(group) > 1:
+            total = sum(leaf_values(member) for member in group)
+            tree["leaf_value"] = [repr(float(value)) for value in total]
+        merged.append(tree)
+    return merged, len(trees) - len(merged)
+
+
+class ModelCompactor:
+    """
+    Post-training compaction of a LightGBM model: collapse splits whose leaves are identical
+    (or within leaf_tolerance), merge structurally identical trees, then drop the trees that
+    contribute least, as long as the AUC and the largest probability change on a DataMocker
+    holdout stay within budget. Reports tree counts, file size, AUC, drift and latency before
+    and after.
+    """
+
+    def __init__(
+        self,
+        model_file: str,
+        label: str = "manual_fraud",
+        params_loc: str = "adjusted_data_parameters.json",
+        num_holdout: int = 200000,
+        max_auc_drop: float = 0.001,
+        max_drift: float = 0.01,
+        leaf_tolerance: float = 0.0,
+        seed: int = 0,
+    ):
+        self.model_file = model_file
+        self.label = label
+        self.params_loc = params_loc
+        self.num_holdout = num_holdout
+        self.max_auc_drop = max_auc_drop  # largest allowed holdout AUC loss
+        self.max_drift = max_drift  # largest allowed absolute change of any holdout probability
+        self.leaf_tolerance = leaf_tolerance  # leaves closer than this count as identical
+        self.seed = seed
+        with open(model_file) as fp:
+            self.model_text = fp.read()
+
+    def holdout(self):
+        """Generate a labelled holdout set with DataMocker, features in model order"""
+        np.random.seed(self.seed)
+        data = DataMocker(num_samples=self.num_holdout, params_loc=self.params_loc).generate_data()
+        features = lgb.Booster(model_str=self.model_text).feature_name()
+        X = feature_matrix(data, features)
+        y = data[self.label].to_numpy()
+        if len(np.unique(y)) < 2:
+            raise ValueError(f"{self.params_loc} generates no positive and negative {self.label}")
+        return X, y
+
+    def tree_outputs(self, trees, header, trailer, X):
+        """Raw score contribution of every tree to every holdout row, shape (rows, trees)"""
+        booster = lgb.Booster(model_str=format_model(header, trees, trailer))
+        leaves = booster.predict(X, pred_leaf=True).reshape(len(X), len(trees)).astype(np.int64)
+        outputs = np.empty(leaves.shape)
+        for number, tree in enumerate(trees):
+            outputs[:, number] = leaf_values(tree)[leaves[:, number]]
+        return outputs
+
+    def drop_trees(self, outputs, y, reference):
+        """
+        Greedily drop the trees with the smallest mean absolute contribution, keeping each drop
+        only if holdout AUC and probability drift stay within budget
+        :return: Boolean array of kept trees
+        """
+        reference_auc = roc_auc_score(y, reference)
+        keep = np.ones(outputs.shape[1], dtype=bool)
+        raw = outputs.sum(axis=1)
+        for number in np.argsort(np.abs(outputs).mean(axis=0)):
+            candidate = raw - outputs[:, number]
+            probability = 1 / (1 + np.exp(-candidate))
+            drift = np.abs(probability - reference).max()
+            if drift > self.max_drift:
+                continue
+            if reference_auc - roc_auc_score(y, probability) > self.max_auc_drop:
+                continue
+            keep[number] = False
+            raw = candidate
+        return keep
+
+    def budget_used(self, y, reference, predictions):
+        """:return: Holdout AUC drop and largest absolute probability change against reference"""
+        auc_drop = roc_auc_score(y, reference) - roc_auc_score(y, predictions)
+        return float(auc_drop), float(np.abs(predictions - reference).max())
+
+    def within_budget(self, y, reference, predictions):
+        auc_drop, drift = self.budget_used(y, reference, predictions)
+        return auc_drop <= self.max_auc_drop and drift <= self.max_drift
+
+    def predict(self, header, trees, trailer, X):
+        return lgb.Booster(model_str=format_model(header, trees, trailer)).predict(X)
+
+    def collapse_leaves(self, header, trees, trailer, X, y, reference):
+        """
+        collapse_identical_leaves on every tree, halving the leaf tolerance until the holdout
+        stays within budget. A tolerance of 0 only merges leaves with equal values, so it is
+        always accepted
+        :return: Collapsed trees, number of splits removed, tolerance used
+        """
+        tolerance = self.leaf_tolerance
+        while True:
+            if tolerance < self.leaf_tolerance / 2**MAX_TOLERANCE_HALVINGS:
+                tolerance = 0.0
+            candidate = copy.deepcopy(trees)
+            collapsed = sum(collapse_identical_leaves(tree, tolerance) for tree in candidate)
+            if tolerance == 0.0 or self.within_budget(
+                y, reference, self.predict(header, candidate, trailer, X)
+            ):
+                return candidate, collapsed, tolerance
+            tolerance /= 2
+
+    def compact(self):
+        """
+        Run every compaction step, checking the budget after each one: the leaf tolerance is
+        lowered until collapsing stays within budget, and merging is skipped if it does not
+        :return: Compacted model text and a report, whose within_budget is False only if the
+                 compacted model is over budget after all (the caller must not use it)
+        """
+        header, trees, trailer = parse_model(self.model_text)
+        X, y = self.holdout()
+        original = lgb.Booster(model_str=self.model_text)
+        reference = original.predict(X)
+
+        trees, collapsed, tolerance = self.collapse_leaves(header, trees, trailer, X, y, reference)
+        merged_trees, merged = merge_identical_trees(copy.deepcopy(trees))
+        if merged and self.within_budget(
+            y, reference, self.predict(header, merged_trees, trailer, X)
+        ):
+            trees = merged_trees
+        else:
+            merged = 0
+        keep = self.drop_trees(self.tree_outputs(trees, header, trailer, X), y, reference)
+        trees = [tree for tree, kept in zip(trees, keep) if kept]
+        compacted_text = format_model(header, trees, trailer)
+
+        compacted = lgb.Booster(model_str=compacted_text)
+        predictions = compacted.predict(X)
+        auc_drop, drift = self.budget_used(y, reference, predictions)
+        report = {
+            "model_file": self.model_file,
+            "trees": [original.num_trees(), compacted.num_trees()],
+            "splits_collapsed": int(collapsed),
+            "leaf_tolerance": [self.leaf_tolerance, tolerance],
+            "trees_merged": merged,
+            "trees_dropped": int((~keep).sum()),
+            "size_bytes": [len(self.model_text.encode()), len(compacted_text.encode())],
+            "auc": [roc_auc_score(y, reference), roc_auc_score(y, predictions)],
+            "max_drift": drift,
+            "budget": {"max_auc_drop": self.max_auc_drop, "max_drift": self.max_drift},
+            "within_budget": auc_drop <= self.max_auc_drop and drift <= self.max_drift,
+            "latency_us": {
+                "single_row": [latency(original, X[:1]), latency(compacted, X[:1])],
+                "per_row_batch": [
+                    latency(original, X[:10000]) / 10000,
+                    latency(compacted, X[:10000]) / 10000,
+                ],
+            },
+        }
+        return compacted_text, report
+
+
+def latency(booster, X, repeat=20):
+    """Best-of-repeat prediction time in microseconds"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        booster.predict(X)
+        times.append(time.perf_counter() - start)
+    return min(times) * 1e6
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Compact a LightGBM fraud model within a budget")
+    parser.add_argument("model_file")
+    parser.add_argument("output_file")
+    parser.add_argument("--label", default=None, help="bot_fraud or manual_fraud (from the name)")
+    parser.add_argument("--params-loc", default=None, help="DataMocker parameters (by label)")
+    parser.add_argument("--num-holdout", type=int, default=200000)
+    parser.add_argument("--max-auc-drop", type=float, default=0.001)
+    parser.add_argument("--max-drift", type=float, default=0.01)
+    parser.add_argument("--leaf-tolerance", type=float, default=0.0)
+    args = parser.parse_args()
+
+    label = args.label or (
+        "bot_fraud" if "bot" in os.path.basename(args.model_file) else "manual_fraud"
+    )
+    # the adjusted parameters only generate manual fraud
+    params_loc = args.params_loc or (
+        "default_data_parameters.json" if label == "bot_fraud" else "adjusted_data_parameters.json"
+    )
+    compactor = ModelCompactor(
+        args.model_file,
+        label=label,
+        params_loc=params_loc,
+        num_holdout=args.num_holdout,
+        max_auc_drop=args.max_auc_drop,
+        max_drift=args.max_drift,
+        leaf_tolerance=args.leaf_tolerance,
+    )
+    compacted_text, report = compactor.compact()
+    print(json.dumps(report, indent=2))
+    if not report["within_budget"]:
+        sys.exit(f"compacted model is over budget, {args.output_file} not written")
+    with open(args.output_file, "w") as fp:
+        fp.write(compacted_text)
+    with open(os.path.splitext(args.output_file)[0] + "_report.json", "w") as fp:
+        json.dump(report, fp, indent=2)
@@ -0,0 +1,437 @@
+import asyncio
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# the lambda directories use flat imports, so put them on the path like their zip roots
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(REPO, "visitor_matching"), os.path.join(REPO, "model_serving")]
+
+from fraud_inference import FraudPredictor  # noqa: E402
+from instrumentation import INSTRUMENTATION  # noqa: E402
+import lambda_function as fingerprint_lambda  # noqa: E402
+import visitor_attribute_lambda_function as visitor_lambda  # noqa: E402
+
+BOT_MODEL_FILE = os.path.join(REPO, "bot_fraud_inference", "app", "bot_fraud_model.txt")
+MANUAL_MODEL_FILE = os.path.join(REPO, "model_serving", "manual_fraud_model.txt")
+STATUS_TEXT = {200: "OK", 400: "Bad Request", 404: "Not Found", 500: "Internal Server Error"}
+
+
+def load_model(model_file):
+    """
+    :return: A FlatTreeModel for an .npz artifact (see flat_trees.py), otherwise a Booster
+    """
+    if model_file.endswith(".npz"):
+        from flat_trees import FlatTreeModel
+
+        return FlatTreeModel.load(model_file)
+    import lightgbm as lgb
+
+    return lgb.Booster(model_file=model_file)
+
+
+class MicroBatcher:
+    """
+    Collect concurrent requests in an asyncio queue and hand them to batch_function in
+    batches of at most max_batch_size, waiting at most max_wait seconds after the first
+    request of a batch for more to arrive. Batches run in the executor one at a time, so
+    requests arriving while a batch is scored form the next batch.
+    """
+
+    def __init__(self, batch_function, executor, max_batch_size=32, max_wait=0.002):
+        # list of items -> list of results, with the exception in place of an item that failed
+        self.batch_function = batch_function
+        self.executor = executor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = asyncio.Queue()
+        self.batches, self.items = 0, 0
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def submit(self, item):
+        """
+        :return: Result of item, once its batch has been scored
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((item, future))
+        return await future
+
+    async def next_batch(self):
+        batch = [await self.queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self.next_batch()
+            items = [item for item, _ in batch]
+            try:
+                results = await loop.run_in_executor(self.executor, self.batch_function, items)
+            except Exception as error:
+                for _, future in batch:
+                    future.set_exception(error)
+            else:
+                for (_, future), result in zip(batch, results):
+                    if isinstance(result, Exception):  # only this item failed
+                        future.set_exception(result)
+                    else:
+                        future.set_result(result)
+            self.batches += 1
+            self.items += len(batch)
+
+
+def fraud_batch_function(predictor, prediction_type):
+    """
+    A batch is scored with one predict_many call; if that fails, the events are scored one by
+    one so that a malformed event only fails its own request
+    """
+
+    def body(probability):
+        return {
+            "prediction_type": prediction_type,
+            "fruad_probability": 100 * round(probability, 4),
+        }
+
+    def score(events):
+        try:
+            with INSTRUMENTATION.stage(f"{prediction_type}.predict_many"):
+                return [body(float(p)) for p in predictor.predict_many(events)]
+        except Exception:
+            if len(events) == 1:
+                raise
+        results = []
+        for event in events:
+            try:
+                results.append(body(float(predictor.predict_many([event])[0])))
+            except Exception as error:
+                results.append(error)
+        return results
+
+    return score
+
+
+def lambda_batch_function(handler):
+    """
+    Matching events carry their own candidate history, so a batch is scored event by event
+    (still one executor hop per batch); an event that raises fails only its own request
+    """
+
+    def score(events):
+        results = []
+        for event in events:
+            try:
+                results.append(handler(event, None)["body"])
+            except Exception as error:
+                results.append(error)
+        return results
+
+    return score
+
+
+class ScoringService:
+    """
+    One process hosting the bot and manual fraud models and the fingerprint and visitor
+    comparers behind a small HTTP/JSON API:
+
+    POST /bot_fraud, /manual_fraud          body: fraud model event (has* flags)
+    POST /fingerprint_match, /visitor_match body: matching lambda event
+    POST /checkout                          body: {"bot_fraud": ..., "manual_fraud": ...,
+                                                   "fingerprint_match": ..., "visitor_match": ...}
+                                            (any subset), scored concurrently
+    GET /stats                              batch counters per endpoint
+    GET /metrics                            instrumentation snapshot (Prometheus text, see
+                                            visitor_matching/instrumentation.py)
+
+    Responses carry the same body as the corresponding lambda.
+    """
+
+    def __init__(
+        self,
+        bot_model_file=BOT_MODEL_FILE,
+        manual_model_file=MANUAL_MODEL_FILE,
+        max_batch_size=32,
+        max_wait=0.002,
+        workers=4,
+    ):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.predictors = {
+            "bot_fraud": FraudPredictor(load_model(bot_model_file)),
+            "manual_fraud": FraudPredictor(load_model(manual_model_file)),
+        }
+        functions = {
+            "bot_fraud": fraud_batch_function(self.predictors["bot_fraud"], "bot_fraud"),
+            "manual_fraud": fraud_batch_function(self.predictors["manual_fraud"], "manual_fraud"),
+            "fingerprint_match": lambda_batch_function(fingerprint_lambda.lambda_handler),
+            "visitor_match": lambda_batch_function(visitor_lambda.lambda_handler),
+        }
+        self.batchers = {
+            name: MicroBatcher(function, self.executor, max_batch_size, max_wait)
+            for name, function in functions.items()
+        }
+
+    async def checkout(self, event):
+        names = [name for name in self.batchers if name in event]
+        results = await asyncio.gather(*[self.batchers[name].submit(event[name]) for name in names])
+        return dict(zip(names, results))
+
+    def stats(self):
+        return {
+            name: {"batches": batcher.batches, "items": batcher.items}
+            for name, batcher in self.batchers.items()
+        }
+
+    async def route(self, method, path, body):
+        """
+        :return: Status code and response body
+        """
+        name = path.strip("/")
+        if method == "GET" and name == "stats":
+            return 200, self.stats()
+        if method == "GET" and name == "metrics":
+            return 200, INSTRUMENTATION.prometheus()
+        if method != "POST" or (name not in self.batchers and name != "checkout"):
+            return 404, {"error": f"no route for {method} {path}"}
+        try:
+            event = json.loads(body or b"{}")
+        except ValueError as error:
+            return 400, {"error": f"invalid JSON: {error}"}
+        try:
+            if name == "checkout":
+                return 200, await self.checkout(event)
+            return 200, await self.batchers[name].submit(event)
+        except Exception as error:
+            return 500, {"error": repr(error)}
+
+    async def handle(self, reader, writer):
+        """
+        Serve HTTP/1.1 requests on one connection (keep-alive) until the client closes it
+        """
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    key, _, value = line.decode("latin-1").partition(":")
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                status, response = await self.route(method, path, body)
+                if isinstance(response, str):
+                    payload, content_type = response.encode(), "text/plain; version=0.0.4"
+                else:
+                    payload, content_type = json.dumps(response).encode(), "application/json"
+                writer.write(
+                    f"HTTP/1.1 {status} {STATUS_TEXT[status]}\r\n"
+                    f"Content-Type: {content_type}\r\nContent-Length: {len(payload)}\r\n\r\n".encode()
+                    + payload
+                )
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host="127.0.0.1", port=8080):
+        for batcher in self.batchers.values():
+            batcher.start()
+        return await asyncio.start_server(self.handle, host, port)
+
+    async def stop(self):
+        for batcher in self.batchers.values():
+            batcher.task.cancel()
+        await asyncio.gather(
+            *[batcher.task for batcher in self.batchers.values()], return_exceptions=True
+        )
+        self.executor.shutdown()
+
+
+async def post(reader, writer, path, event):
+    """
+    Minimal keep-alive HTTP client for the benchmark
+    :return: Decoded JSON response body
+    """
+    payload = json.dumps(event).encode()
+    writer.write(
+        f"POST {path} HTTP/1.1\r\nHost: localhost\r\nContent-Length: {len(payload)}\r\n\r\n".encode()
+        + payload
+    )
+    await writer.drain()
+    await reader.readline()
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        key, _, value = line.decode("latin-1").partition(":")
+        if key.lower() == "content-length":
+            length = int(value)
+    return json.loads(await reader.readexactly(length))
+
+
+def synthetic_checkouts(num_events, feature_names, seed=0):
+    """
+    Checkout events combining random fraud flags with synthetic fingerprint and visitor
+    matching events
+    """
+    from fraud_inference import random_events
+    from synthetic import generate_fingerprint_event, generate_visitor_event
+
+    fraud_events = random_events(feature_names, num_events, seed=seed)
+    return [
+        {
+            "bot_fraud": fraud_events[number],
+            "manual_fraud": fraud_events[number],
+            "fingerprint_match": generate_fingerprint_event(20, seed=seed + number),
+            "visitor_match": generate_visitor_event(5, 2, seed=seed + number),
+        }
+        for number in range(num_events)
+    ]
+
+
+async def load_test(port, path, events, concurrency):
+    """
+    Send events from concurrency keep-alive connections
+    :return: Requests per second and latency percentiles (ms)
+    """
+    import numpy as np
+
+    latencies = []
+    remaining = list(events)
+
+    async def client():
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        while remaining:
+            event = remaining.pop()
+            start = time.perf_counter()
+            await post(reader, writer, path, event)
+            latencies.append(time.perf_counter() - start)
+        writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    p50, p99 = np.percentile(latencies, [50, 99]) * 1000
+    return len(events) / elapsed, p50, p99
+
+
+async def check_error_isolation():
+    """
+    A malformed event batched together with valid ones fails only its own request, on the
+    fraud and the matching endpoints
+    """
+    from synthetic import generate_fingerprint_event, generate_visitor_event
+
+    service = ScoringService(max_batch_size=8, max_wait=0.05)  # wait long enough to batch
+    for batcher in service.batchers.values():
+        batcher.start()
+    fraud_event = {name: 1 for name in service.predictors["bot_fraud"].feature_names}
+    valid = {
+        "bot_fraud": fraud_event,
+        "manual_fraud": fraud_event,
+        "fingerprint_match": generate_fingerprint_event(10),
+        "visitor_match": generate_visitor_event(3, 2),
+    }
+    malformed = {name: {"bogus": 1} for name in ["fingerprint_match", "visitor_match"]}
+    for name in ["bot_fraud", "manual_fraud"]:
+        feature = service.predictors[name].feature_names[0]
+        malformed[name] = {feature: "yes"}  # not a number
+    try:
+        for name, event in valid.items():
+            expected = await service.route("POST", f"/{name}", json.dumps(event))
+            batches = service.batchers[name].batches
+            responses = await asyncio.gather(
+                service.route("POST", f"/{name}", json.dumps(event)),
+                service.route("POST", f"/{name}", json.dumps(malformed[name])),
+                service.route("POST", f"/{name}", json.dumps(event)),
+            )
+            assert service.batchers[name].batches == batches + 1, name  # scored together
+            assert responses[0] == responses[2] == expected and expected[0] == 200, name
+            assert responses[1][0] == 500, (name, responses[1])
+    finally:
+        await service.stop()
+
+
+async def benchmark():
+    for max_batch_size, max_wait in [(1, 0.0), (32, 0.002), (128, 0.005)]:
+        service = ScoringService(max_batch_size=max_batch_size, max_wait=max_wait)
+        server = await service.start(port=0)
+        port = server.sockets[0].getsockname()[1]
+        checkouts = synthetic_checkouts(200, service.predictors["bot_fraud"].feature_names)
+        fraud = [checkout["bot_fraud"] for checkout in checkouts] * 10
+        for path, events, concurrency in [
+            ("/bot_fraud", fraud, 64),
+            ("/checkout", checkouts, 16),
+        ]:
+            throughput, p50, p99 = await load_test(port, path, events, concurrency)
+            print(
+                f"batch {max_batch_size:>3}, wait {max_wait * 1000:.0f} ms, {path:<11} "
+                f"x{concurrency}: {throughput:7.0f} req/s, p50 {p50:6.2f} ms, p99 {p99:6.2f} ms"
+            )
+        print(f"  {service.stats()}")
+        server.close()
+        await server.wait_closed()
+        await service.stop()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Fraud scoring and visitor matching service")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--bot-model", default=BOT_MODEL_FILE)
+    parser.add_argument("--manual-model", default=MANUAL_MODEL_FILE)
+    parser.add_argument("--max-batch-size", type=int, default=32)
+    parser.add_argument("--max-wait-ms", type=float, default=2.0)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--benchmark", action="store_true", help="run a synthetic load test")
+    parser.add_argument("--check", action="store_true", help="check per-request error isolation")
+    args = parser.parse_args()
+
+    if args.check:
+        asyncio.run(check_error_isolation())
+        print("check_error_isolation: a malformed event fails only its own request")
+        sys.exit()
+
+    if args.benchmark:
+        asyncio.run(benchmark())
+        sys.exit()
+
+    async def serve():
+        service = ScoringService(
+            args.bot_model,
+            args.manual_model,
+            args.max_batch_size,
+            args.max_wait_ms / 1000,
+            args.workers,
+        )
+        server = await service.start(args.host, args.port)
+        print(f"serving on {args.host}:{args.port}")
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(serve())
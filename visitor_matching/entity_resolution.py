@@ -0,0 +1,442 @@
+import csv
+import json
+import os
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import numpy as np
+
+from identity_index import identity_keys, normalize_token, visitor_key
+from utils import epoch_microseconds
+from visitor_attribute_compare import VisitorAttributeCompare, VisitorRecord
+
+GEO_CELL_DEGREES = 0.1  # about 11 km, the scale of match_telemetry's 10 km full-credit radius
+
+SCHEMA = """
+CREATE TABLE visitors (row INTEGER PRIMARY KEY, visitor_id TEXT NOT NULL, offset INTEGER NOT NULL);
+CREATE TABLE blocking_keys (kind TEXT NOT NULL, value TEXT NOT NULL, row INTEGER NOT NULL);
+"""
+
+
+def blocking_keys(visitor):
+    """
+    Keys two visitors must share to be compared: the exact identity and payment keys of the
+    identity index (payment fingerprint, card, email, phone, username, full name), the IP
+    addresses, the street address and the geo cells of the IP observations
+    :return: Set of (kind, value)
+    """
+    keys = set(identity_keys(visitor))
+    for ip in visitor["ips"]:
+        if ip.get("ip"):
+            keys.add(("ip", str(ip["ip"])))
+        latitude, longitude = ip["props"].get("latitude"), ip["props"].get("longitude")
+        if latitude is not None and longitude is not None:
+            cell = (int(latitude // GEO_CELL_DEGREES), int(longitude // GEO_CELL_DEGREES))
+            keys.add(("geo", f"{cell[0]},{cell[1]}"))
+    address = visitor["visitor_addresses"]
+    line1, postal_code = normalize_token(address.get("Line1")), address.get("Postal_code")
+    if line1 and postal_code:
+        keys.add(("address", f"{normalize_token(postal_code)}|{line1}"))
+    return keys
+
+
+class UnionFind:
+    """Disjoint sets over rows 0..size-1 (int32 parents, union by size, path halving)"""
+
+    def __init__(self, size):
+        self.parent = np.arange(size, dtype=np.int32)
+        self.size = np.ones(size, dtype=np.int32)
+
+    def find(self, row):
+        parent = self.parent
+        while parent[row] != row:
+            parent[row] = parent[parent[row]]
+            row = parent[row]
+        return row
+
+    def union(self, a, b):
+        """:return: True if a and b were in different sets"""
+        a, b = self.find(a), self.find(b)
+        if a == b:
+            return False
+        if self.size[a] < self.size[b]:
+            a, b = b, a
+        self.parent[b] = a
+        self.size[a] += self.size[b]
+        return True
+
+    def identities(self):
+        """:return: Identity of every row: the smallest row of its set"""
+        roots = self.parent.copy()
+        while True:  # pointer jumping until every row points at its root
+            grand = roots[roots]
+            if np.array_equal(grand, roots):
+                break
+            roots = grand
+        first = np.full(len(roots), len(roots), dtype=np.int32)
+        np.minimum.at(first, roots, np.arange(len(roots), dtype=np.int32))
+        return first[roots]
+
+
+def pair_match(comparer, a, b, now, threshold, merge_red_flagged=False):
+    """
+    Score two VisitorRecords with VisitorAttributeCompare.score_visitor, the earlier
+    created one as the previous visitor
+    :return: Score, and whether the pair is a match
+    """
+    if (b.created_at or 0) < (a.created_at or 0):
+        a, b = b, a
+    result = comparer.score_visitor([a], b, now)
+    matched = result["score"] >= threshold and (
+        merge_red_flagged or not result["ip_timing_red_flag"]
+    )
+    return result["score"], matched
+
+
+_worker = {}  # per worker process: open export file and comparer
+
+
+def score_pairs(export_path, weights, now, threshold, merge_red_flagged, pairs):
+    """
+    Score candidate pairs in a worker process, reading the visitors at their byte offsets
+    :param pairs: list of (row a, row b, offset a, offset b)
+    :return: List of matched (row a, row b)
+    """
+    if _worker.get("path") != export_path:
+        _worker.update(path=export_path, export=open(export_path, "rb"))
+        _worker["comparer"] = VisitorAttributeCompare(weights=weights)
+    export, comparer = _worker["export"], _worker["comparer"]
+    records = {}
+
+    def record(offset):
+        if offset not in records:
+            export.seek(offset)
+            records[offset] = VisitorRecord(json.loads(export.readline()))
+        return records[offset]
+
+    matches = []
+    for row_a, row_b, offset_a, offset_b in pairs:
+        _, matched = pair_match(
+            comparer, record(offset_a), record(offset_b), now, threshold, merge_red_flagged
+        )
+        if matched:
+            matches.append((row_a, row_b))
+    return matches
+
+
+def close_worker():
+    """Close the export file score_pairs opened in this process"""
+    if "export" in _worker:
+        _worker["export"].close()
+    _worker.clear()
+
+
+class EntityResolution:
+    """
+    Offline grouping of every visitor of a JSONL export (one visitor per line) into
+    identities:
+
+    1. stream the export once, storing each visitor's id, byte offset and blocking keys
+       (blocking_keys) in an on-disk SQLite work database
+    2. candidate pairs are the distinct pairs of visitors sharing a key; blocks with more than
+       max_block_size visitors (a shared city cell or a carrier IP) are skipped
+    3. score the pairs in batches in a process pool with the fused visitor match
+       (VisitorAttributeCompare.score_visitor, one reference clock for the whole job); workers
+       read the two visitors at their offsets, so only matched pairs travel back
+    4. union-find merges every pair scoring at least threshold (and without an IP timing red
+       flag, unless merge_red_flagged); the identity of a visitor is the id of the first
+       visitor of its group in the export
+
+    Memory is bounded by the union-find arrays (8 bytes per visitor), the pair batches in
+    flight and the SQLite page cache; keys and pairs stay on disk.
+    """
+
+    def __init__(
+        self,
+        weights,
+        threshold=80,
+        max_block_size=100,
+        processes=1,
+        batch_size=5000,
+        merge_red_flagged=False,
+        work_path=None,
+        progress_every=10.0,
+    ):
+        self.weights = weights
+        # on synthetic data, records of one person score 95 or more and unrelated visitors at
+        # most about 65 (same name and city)
+        self.threshold = threshold
+        self.max_block_size = max_block_size
+        self.processes = processes
+        self.batch_size = batch_size
+        self.merge_red_flagged = merge_red_flagged
+        self.work_path = work_path  # SQLite work database, by default next to the output
+        self.progress_every = progress_every  # seconds between progress lines
+        self.stats = {}
+
+    def load(self, connection, export_path, batch_size=10000):
+        """Stream the export into the work database; :return: number of visitors"""
+        connection.executescript(SCHEMA)
+        rows, keys = [], []
+        num_visitors, offset = 0, 0
+        with open(export_path, "rb") as export:
+            for line in export:
+                if line.strip():
+                    visitor = json.loads(line)
+                    rows.append((num_visitors, visitor_key(visitor), offset))
+                    keys.extend(
+                        (kind, value, num_visitors) for kind, value in blocking_keys(visitor)
+                    )
+                    num_visitors += 1
+                    if len(rows) >= batch_size:
+                        self.insert(connection, rows, keys)
+                        rows, keys = [], []
+                offset += len(line)
+        self.insert(connection, rows, keys)
+        connection.execute("CREATE INDEX blocking_keys_block ON blocking_keys (kind, value)")
+        return num_visitors
+
+    def insert(self, connection, rows, keys):
+        with connection:
+            connection.executemany("INSERT INTO visitors VALUES (?, ?, ?)", rows)
+            connection.executemany("INSERT INTO blocking_keys VALUES (?, ?, ?)", keys)
+
+    def candidate_pairs(self, connection):
+        """Yield (row a, row b, offset a, offset b) for every distinct blocked pair, a < b"""
+        connection.executescript(f"""
+            CREATE TEMP TABLE blocks AS
+                SELECT kind, value, COUNT(*) AS size FROM blocking_keys GROUP BY kind, value
+                HAVING size > 1;
+            CREATE TEMP TABLE small_blocks AS
+                SELECT kind, value FROM blocks WHERE size <= {int(self.max_block_size)};
+            """)
+        self.stats["blocks"] = connection.execute("SELECT COUNT(*) FROM blocks").fetchone()[0]
+        self.stats["skipped_blocks"] = connection.execute(
+            "SELECT kind, COUNT(*), MAX(size) FROM blocks WHERE size > ? GROUP BY kind",
+            (self.max_block_size,),
+        ).fetchall()
+        yield from connection.execute("""
+            SELECT pairs.a, pairs.b, va.offset, vb.offset FROM (
+                SELECT DISTINCT ka.row AS a, kb.row AS b FROM small_blocks s
+                JOIN blocking_keys ka ON ka.kind = s.kind AND ka.value = s.value
+                JOIN blocking_keys kb ON kb.kind = s.kind AND kb.value = s.value AND ka.row < kb.row
+            ) AS pairs
+            JOIN visitors va ON va.row = pairs.a JOIN visitors vb ON vb.row = pairs.b
+            ORDER BY pairs.a, pairs.b
+            """)
+
+    def batches(self, pairs):
+        batch = []
+        for pair in pairs:
+            batch.append(pair)
+            if len(batch) >= self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def scored_batches(self, export_path, pairs, now):
+        """Yield (number of pairs, matches) per batch, from at most 2 * processes in flight"""
+        arguments = (
+            export_path,
+            self.weights,
+            now,
+            self.threshold,
+            self.merge_red_flagged,
+        )
+        if self.processes <= 1:
+            for batch in self.batches(pairs):
+                yield len(batch), score_pairs(*arguments, batch)
+            return
+        with ProcessPoolExecutor(self.processes) as executor:
+            pending = []
+            for batch in self.batches(pairs):
+                pending.append((len(batch), executor.submit(score_pairs, *arguments, batch)))
+                if len(pending) >= 2 * self.processes:
+                    size, future = pending.pop(0)
+                    yield size, future.result()
+            for size, future in pending:
+                yield size, future.result()
+
+    def run(self, export_path, output_path, now=None, log=print):
+        """
+        Resolve the export and write output_path, a CSV of visitor_id, identity_id and
+        identity_size in export order
+        :return: Statistics of the run
+        """
+        start = time.perf_counter()
+        now = epoch_microseconds(datetime.today()) if now is None else now
+        work_path = self.work_path or f"{output_path}.work.db"
+        if os.path.exists(work_path):
+            os.remove(work_path)
+        connection = sqlite3.connect(work_path)
+        connection.execute("PRAGMA journal_mode = OFF")
+        connection.execute("PRAGMA synchronous = OFF")
+        try:
+            num_visitors = self.load(connection, export_path)
+            self.stats.update(visitors=num_visitors, load_seconds=time.perf_counter() - start)
+            log(f"loaded {num_visitors} visitors in {self.stats['load_seconds']:.1f} s")
+
+            union_find = UnionFind(num_visitors)
+            scored, matches, last_report = 0, 0, time.perf_counter()
+            score_start = time.perf_counter()
+            pairs = self.candidate_pairs(connection)
+            for size, matched in self.scored_batches(export_path, pairs, now):
+                scored += size
+                for a, b in matched:
+                    matches += 1
+                    union_find.union(a, b)
+                if time.perf_counter() - last_report > self.progress_every:
+                    last_report = time.perf_counter()
+                    rate = scored / (last_report - score_start)
+                    log(f"scored {scored} pairs ({rate:,.0f} pairs/s), {matches} matches")
+            score_seconds = time.perf_counter() - score_start
+            for kind, count, largest in self.stats["skipped_blocks"]:
+                log(
+                    f"skipped {count} {kind} blocks over {self.max_block_size} visitors (max {largest})"
+                )
+            self.stats.update(
+                candidate_pairs=scored,
+                matches=matches,
+                score_seconds=score_seconds,
+                pairs_per_second=scored / score_seconds if score_seconds else None,
+            )
+
+            identities = union_find.identities()
+            sizes = np.bincount(identities, minlength=num_visitors)
+            names = {}  # identity row -> its visitor id, for identities with several visitors
+            with open(output_path, "w", newline="") as output:
+                writer = csv.writer(output)
+                writer.writerow(["visitor_id", "identity_id", "identity_size"])
+                for row, visitor_id in connection.execute(
+                    "SELECT row, visitor_id FROM visitors ORDER BY row"
+                ):
+                    identity = int(identities[row])
+                    if identity == row and sizes[row] > 1:
+                        names[row] = visitor_id
+                    name = visitor_id if identity == row else names[identity]
+                    writer.writerow([visitor_id, name, sizes[identity]])
+        finally:
+            close_worker()  # scored in this process when processes <= 1
+            connection.close()
+            os.remove(work_path)
+        self.stats.update(
+            identities=int((sizes > 0).sum()),
+            largest_identity=int(sizes.max()) if num_visitors else 0,
+            seconds=time.perf_counter() - start,
+        )
+        log(
+            f"{num_visitors} visitors -> {self.stats['identities']} identities: "
+            f"{scored} candidate pairs, {matches} matches, {self.stats['seconds']:.1f} s"
+        )
+        return self.stats
+
+
+def brute_force_identities(visitors, weights, threshold=80, now=None, merge_red_flagged=False):
+    """
+    Reference for EntityResolution: score every pair of visitors and merge the matches
+    :return: Identity (visitor id of the first visitor of the group) per visitor id
+    """
+    now = epoch_microseconds(datetime.today()) if now is None else now
+    comparer = VisitorAttributeCompare(weights=weights)
+    records = [VisitorRecord(visitor) for visitor in visitors]
+    union_find = UnionFind(len(visitors))
+    for a in range(len(records)):
+        for b in range(a + 1, len(records)):
+            if pair_match(comparer, records[a], records[b], now, threshold, merge_red_flagged)[1]:
+                union_find.union(a, b)
+    ids = [visitor_key(visitor) for visitor in visitors]
+    return {ids[row]: ids[identity] for row, identity in enumerate(union_find.identities())}
+
+
+def generate_visitor_corpus(num_people, seed=0, max_records=4):
+    """
+    Synthetic export: every person has 1 to max_records visitor records (later records are
+    mutate_visitor copies), shuffled
+    :return: List of visitors with ids, dictionary of visitor id -> person number
+    """
+    import random
+
+    from synthetic import generate_visitor, mutate_visitor
+
+    rng = random.Random(seed)
+    visitors, people = [], {}
+    for person in range(num_people):
+        first = generate_visitor(rng, rng.randint(1, 3))
+        records = [first] + [
+            mutate_visitor(rng, first, rng.randint(1, 3))
+            for _ in range(rng.randint(0, max_records - 1))
+        ]
+        for record in records:
+            record["visitors"]["id"] = f"v{len(visitors)}"
+            people[record["visitors"]["id"]] = person
+            visitors.append(record)
+    rng.shuffle(visitors)
+    return visitors, people
+
+
+def check_resolution(num_people=150, seed=0, processes=2):
+    """
+    On a small corpus, blocking plus union-find gives the same identities as scoring every
+    pair, also for visitor ids the CSV has to quote
+    :return: Number of visitors, number of identities
+    """
+    import tempfile
+
+    from synthetic import VISITOR_WEIGHTS
+
+    visitors, _ = generate_visitor_corpus(num_people, seed)
+    for visitor, quoted in zip(visitors, ['v,"comma"', 'v"quote', "v\nnewline"]):
+        visitor["visitors"]["id"] = quoted
+    now = epoch_microseconds(datetime(2021, 12, 1))
+    expected = brute_force_identities(visitors, VISITOR_WEIGHTS, now=now)
+    with tempfile.TemporaryDirectory() as directory:
+        export_path, output_path = (os.path.join(directory, name) for name in ["v.jsonl", "i.csv"])
+        with open(export_path, "w") as export:
+            for visitor in visitors:
+                export.write(json.dumps(visitor) + "\n")
+        resolution = EntityResolution(VISITOR_WEIGHTS, processes=processes, batch_size=200)
+        resolution.run(export_path, output_path, now=now, log=lambda message: None)
+        assert not _worker  # the export file score_pairs opened is closed
+        with open(output_path, newline="") as output:
+            actual = {row["visitor_id"]: row["identity_id"] for row in csv.DictReader(output)}
+    assert actual == expected, sum(actual[key] != expected[key] for key in expected)
+    return len(visitors), len(set(actual.values()))
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from synthetic import VISITOR_WEIGHTS
+
+    parser = argparse.ArgumentParser(description="Group the visitors of a JSONL export")
+    parser.add_argument("export", nargs="?", help="JSONL export, one visitor per line")
+    parser.add_argument("output", nargs="?", help="CSV of visitor_id, identity_id")
+    parser.add_argument("--weights", help="JSON file of match weights (default: synthetic)")
+    parser.add_argument("--threshold", type=float, default=80)
+    parser.add_argument("--max-block-size", type=int, default=100)
+    parser.add_argument("--processes", type=int, default=os.cpu_count())
+    parser.add_argument("--synthetic", type=int, help="write a corpus of this many people first")
+    parser.add_argument("--check", action="store_true", help="run check_resolution")
+    args = parser.parse_args()
+
+    if args.check:
+        print(
+            "check_resolution: %d visitors, %d identities, same as brute force" % check_resolution()
+        )
+    if args.export and args.output:
+        if args.synthetic:
+            visitors, _ = generate_visitor_corpus(args.synthetic)
+            with open(args.export, "w") as export:
+                for visitor in visitors:
+                    export.write(json.dumps(visitor) + "\n")
+        weights = VISITOR_WEIGHTS
+        if args.weights:
+            with open(args.weights) as fp:
+                weights = json.load(fp)
+        stats = EntityResolution(weights, args.threshold, args.max_block_size, args.processes).run(
+            args.export, args.output
+        )
+        print(json.dumps(stats, indent=2))
@@ -0,0 +1,456 @@
+import numpy as np
+
+from fingerprint_compare import FingerprintCompare, FINGERPRINT_ATTRIBUTES
+from utils import exact_match, asymmetric_match, match_set, less_than_or_equal
+from instrumentation import INSTRUMENTATION
+
+# exact match attributes with many possible values, stored as interned integer codes.
+# Every other exact/asymmetric attribute is a 0/1 flag and is stored as a packed bit
+CATEGORICAL_ATTRIBUTES = ["engine", "currentResolution", "timeZone", "language", "systemLanguage"]
+FLAG_ATTRIBUTES = [
+    key
+    for key, compare in FINGERPRINT_ATTRIBUTES.items()
+    if compare in (exact_match, asymmetric_match) and key not in CATEGORICAL_ATTRIBUTES
+]
+VERSION_ATTRIBUTES = [
+    key for key, compare in FINGERPRINT_ATTRIBUTES.items() if compare is less_than_or_equal
+]
+SET_ATTRIBUTES = [key for key, compare in FINGERPRINT_ATTRIBUTES.items() if compare is match_set]
+# instrumentation stage of every non-flag attribute comparison
+COMPARE_STAGES = {
+    key: f"fingerprint.compare.{key}"
+    for key in VERSION_ATTRIBUTES + CATEGORICAL_ATTRIBUTES + SET_ATTRIBUTES
+}
+
+MISSING_VERSION = np.iinfo(np.int64).min  # pads short versions, sorts before any component
+SET_THRESHOLD = 0.5  # default dice distance threshold of utils.match_set
+
+# every byte value expanded to its 8 bits (most significant first, like np.packbits)
+_BYTE_BITS = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).astype(np.float64)
+
+
+def version_tuple(value):
+    """
+    Parse an integer or a version string (e.g. 5.4.10) into a tuple of integers.
+    Comparing two tuples with <= gives the same answer as utils.less_than_or_equal
+    :return: Tuple of integers, or None if the value is missing
+    """
+    if not value:
+        return None
+    if isinstance(value, int):
+        return (value,)
+    return tuple(int(part) for part in str(value).split("."))
+
+
+def set_tokens(value):
+    """
+    Split a comma separated field into its distinct tokens, the same way utils.match_set does
+    :return: Set of tokens, or None if the value is missing
+    """
+    if not value:
+        return None
+    return set(value.split(","))
+
+
+class FingerprintColumns:
+    """
+    Column oriented encoding of a list of fingerprints, built once so that every candidate
+    can be compared against a new fingerprint with a handful of vectorized operations:
+    - flags: bit matrix (one row per fingerprint) packed with np.packbits
+    - versions: integer matrix per attribute, one column per version component
+    - categorical fields: integer codes, 0 meaning missing
+    - sets: token ids of every fingerprint concatenated, with per-row offsets
+    """
+
+    def __init__(self, fingerprints):
+        self.size = len(fingerprints)
+
+        flags = np.zeros((self.size, len(FLAG_ATTRIBUTES)), dtype=bool)
+        for row, fingerprint in enumerate(fingerprints):
+            flags[row] = [fingerprint[key] == 1 for key in FLAG_ATTRIBUTES]
+        self.flags = np.packbits(flags, axis=1)
+
+        self.versions = {}
+        for key in VERSION_ATTRIBUTES:
+            parsed = [version_tuple(fingerprint[key]) for fingerprint in fingerprints]
+            width = max([len(version) for version in parsed if version] or [1])
+            column = np.full((self.size, width), MISSING_VERSION, dtype=np.int64)
+            for row, version in enumerate(parsed):
+                if version:
+                    column[row, : len(version)] = version
+            self.versions[key] = column
+
+        self.vocabularies, self.codes = {}, {}
+        for key in CATEGORICAL_ATTRIBUTES:
+            vocabulary = {}
+            self.codes[key] = np.array(
+                [
+                    (
+                        vocabulary.setdefault(fingerprint[key], len(vocabulary) + 1)
+                        if fingerprint[key]
+                        else 0
+                    )
+                    for fingerprint in fingerprints
+                ],
+                dtype=np.int32,
+            )
+            self.vocabularies[key] = vocabulary
+
+        self.sets = {}
+        for key in SET_ATTRIBUTES:
+            vocabulary, token_ids, sizes = {}, [], np.zeros(self.size, dtype=np.int64)
+            for row, fingerprint in enumerate(fingerprints):
+                tokens = set_tokens(fingerprint[key])
+                if tokens is not None:
+                    token_ids.extend(
+                        vocabulary.setdefault(token, len(vocabulary)) for token in tokens
+                    )
+                    sizes[row] = len(tokens)
+            self.vocabularies[key] = vocabulary
+            # sizes double as the presence mask: a present set always has at least one token
+            self.sets[key] = (
+                np.repeat(np.arange(self.size), sizes),
+                np.array(token_ids, dtype=np.int64),
+                sizes,
+            )
+
+    def take(self, rows):
+        """
+        Select a subset of the encoded fingerprints without re-encoding them
+        :param rows: array of row numbers, in the order the subset should keep
+        :return: FingerprintColumns holding only those rows (vocabularies are shared)
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        subset = FingerprintColumns.__new__(FingerprintColumns)
+        subset.size = len(rows)
+        subset.flags = self.flags[rows]
+        subset.versions = {key: column[rows] for key, column in self.versions.items()}
+        subset.codes = {key: codes[rows] for key, codes in self.codes.items()}
+        subset.vocabularies = self.vocabularies
+        subset.sets = {}
+        for key, (_, token_ids, sizes) in self.sets.items():
+            starts = np.cumsum(sizes) - sizes
+            subset_sizes = sizes[rows]
+            # position of every selected token: its row's start offset plus its rank in the row
+            offsets = np.cumsum(subset_sizes) - subset_sizes
+            positions = np.repeat(starts[rows] - offsets, subset_sizes) + np.arange(
+                subset_sizes.sum()
+            )
+            subset.sets[key] = (
+                np.repeat(np.arange(subset.size), subset_sizes),
+                token_ids[positions],
+                subset_sizes,
+            )
+        return subset
+
+    def match_versions(self, key, new_value):
+        """
+        Vectorized utils.less_than_or_equal of every stored version against a new value
+        :return: Boolean array, one entry per stored fingerprint
+        """
+        new_version = version_tuple(new_value)
+        column = self.versions[key]
+        if new_version is None:
+            return np.zeros(self.size, dtype=bool)
+        width = column.shape[1]
+        new_row = np.full(width, MISSING_VERSION, dtype=np.int64)
+        new_row[: min(width, len(new_version))] = new_version[:width]
+
+        # lexicographic comparison: the first differing component decides, equal rows match
+        differs = column != new_row
+        first = differs.argmax(axis=1)
+        rows = np.arange(self.size)
+        matches = ~differs.any(axis=1) | (column[rows, first] < new_row[first])
+        return matches & (column[:, 0] != MISSING_VERSION)
+
+    def match_categorical(self, key, new_value):
+        """
+        Vectorized utils.exact_match of every stored value against a new value
+        :return: Boolean array, one entry per stored fingerprint
+        """
+        if not new_value:
+            return np.zeros(self.size, dtype=bool)
+        return self.codes[key] == self.vocabularies[key].get(new_value, -1)
+
+    def match_sets(self, key, new_value, threshold=SET_THRESHOLD):
+        """
+        Vectorized utils.match_set of every stored set against a new comma separated value
+        :return: Boolean array, one entry per stored fingerprint
+        """
+        new_tokens = set_tokens(new_value)
+        rows, token_ids, sizes = self.sets[key]
+        if new_tokens is None:
+            return np.zeros(self.size, dtype=bool)
+        vocabulary = self.vocabularies[key]
+        in_new = np.zeros(len(vocabulary), dtype=bool)
+        in_new[[vocabulary[token] for token in new_tokens if token in vocabulary]] = True
+        overlap = np.bincount(rows, weights=in_new[token_ids], minlength=self.size)
+        distance = 1 - ((2 * overlap) / (sizes + len(new_tokens)))
+        return (sizes > 0) & (distance <= threshold)
+
+    def match_flags(self, new_fingerprint):
+        """
+        Bitwise AND of the stored flag bits and the new fingerprint's flag bits
+        :return: Packed uint8 matrix, a set bit meaning the flag matched
+        """
+        new_flags = np.packbits([new_fingerprint[key] == 1 for key in FLAG_ATTRIBUTES])
+        return self.flags & new_flags
+
+    def compare(self, new_fingerprint):
+        """
+        Compare every stored fingerprint against a new fingerprint
+        :return: Packed flag matches, and a dictionary of attribute -> boolean match array
+                 for the non-flag attributes
+        """
+        stage = INSTRUMENTATION.stage
+        matches = {}
+        for key in VERSION_ATTRIBUTES:
+            with stage(COMPARE_STAGES[key]):
+                matches[key] = self.match_versions(key, new_fingerprint[key])
+        for key in CATEGORICAL_ATTRIBUTES:
+            with stage(COMPARE_STAGES[key]):
+                matches[key] = self.match_categorical(key, new_fingerprint[key])
+        for key in SET_ATTRIBUTES:
+            with stage(COMPARE_STAGES[key]):
+                matches[key] = self.match_sets(key, new_fingerprint[key])
+        with stage("fingerprint.compare.flags"):
+            return self.match_flags(new_fingerprint), matches
+
+
+class FingerprintBatchCompare(FingerprintCompare):
+    """
+    Drop-in replacement for FingerprintCompare that encodes the previous fingerprints into
+    columns once (FingerprintColumns) and scores every candidate with vectorized comparisons
+    and a weight vector instead of comparing attributes one candidate at a time.
+
+    Flag attributes are assumed to hold 0/1 (or booleans), as sent by the fingerprinting client.
+    """
+
+    # vectorized similarities can differ from the scalar ones in the last bit
+    CACHE_KIND = "fingerprint_batch"
+
+    def __init__(self, prev_fps=[], new_fingerprint=None, weights=None, columns=None, cache=None):
+        super().__init__(prev_fps, new_fingerprint, weights, cache)
+        self._columns = columns
+
+    @property
+    def columns(self):
+        """FingerprintColumns of prev_fps, encoded on first use"""
+        if self._columns is None:
+            with INSTRUMENTATION.stage("fingerprint.parse"):
+                self._columns = FingerprintColumns(self.prev_fps)
+        return self._columns
+
+    @classmethod
+    def from_account(cls, store, account_id, new_fingerprint=None, weights=None):
+        """
+        Compare against the history of an account in a FingerprintStore, mapped from its
+        column files instead of being sent and decoded as JSON (prev_fps stays empty)
+        """
+        with INSTRUMENTATION.stage("fingerprint.parse"):
+            columns = store.columns(account_id)
+        return cls(new_fingerprint=new_fingerprint, weights=weights, columns=columns)
+
+    def weight_vector(self, keys):
+        """
+        :return: Array with the weight of every attribute in keys (1 for unweighted matching)
+        """
+        if self.weights:
+            return np.array([self.weights[key] for key in keys], dtype=np.float64)
+        return np.ones(len(keys), dtype=np.float64)
+
+    def score_candidates(self, flag_matches, matches):
+        """
+        Weighted similarity of every candidate, as estimate_fingerprint_match computes it
+        :return: Array of similarities, one entry per previous fingerprint
+        """
+        # per byte of the packed flags, a 256 entry table of the summed weights of its set bits
+        flag_weights = np.zeros(flag_matches.shape[1] * 8)
+        flag_weights[: len(FLAG_ATTRIBUTES)] = self.weight_vector(FLAG_ATTRIBUTES)
+        tables = _BYTE_BITS @ flag_weights.reshape(-1, 8).T
+        score = tables[flag_matches, np.arange(flag_matches.shape[1])].sum(axis=1)
+
+        other_weights = self.weight_vector(matches.keys())
+        for weight, match in zip(other_weights, matches.values()):
+            score += weight * match
+
+        denominator = sum(self.weights.values()) if self.weights else len(FINGERPRINT_ATTRIBUTES)
+        return score / denominator
+
+    def candidate_results(self, row, flag_matches, matches):
+        """
+        Rebuild the per-attribute results dictionary of a single candidate
+        :return: Dictionary of attribute name -> match result, like compare_fingerprint
+        """
+        flags = np.unpackbits(flag_matches[row], count=len(FLAG_ATTRIBUTES))
+        row_results = dict(zip(FLAG_ATTRIBUTES, flags.astype(bool).tolist()))
+        for key, match in matches.items():
+            row_results[key] = bool(match[row])
+        for key in SET_ATTRIBUTES:
+            # match_set returns 0 rather than False when either side is missing
+            if not row_results[key] and not (self.columns.sets[key][2][row] and self.new_fp[key]):
+                row_results[key] = 0
+        return {key: row_results[key] for key in FINGERPRINT_ATTRIBUTES}
+
+    def identify_top_fingerprint_match(self):
+        """
+        Score all previous fingerprints at once, return the score of the fingerprint that
+        matches the new fingerprint most closely. Ties are broken like the scalar loop: the
+        first perfect match wins, otherwise the last candidate with the highest similarity
+        """
+        if self.cache is not None and self.prev_fps:
+            INSTRUMENTATION.count("fingerprint.candidates_scored", len(self.prev_fps))
+            return self.cached_top_match()
+        if self.columns.size == 0:
+            return 0.0, {}
+        INSTRUMENTATION.count("fingerprint.candidates_scored", self.columns.size)
+        flag_matches, matches = self.columns.compare(self.new_fp)
+        with INSTRUMENTATION.stage("fingerprint.scoring"):
+            scores = self.score_candidates(flag_matches, matches)
+            row = self.top_row(scores)
+            results = self.candidate_results(row, flag_matches, matches)
+            return self.estimate_fingerprint_match(results), results
+
+    def top_row(self, scores):
+        """
+        :return: Row of the first perfect match, otherwise of the last highest similarity
+        """
+        perfect = np.flatnonzero(scores == 1.0)
+        if len(perfect):
+            INSTRUMENTATION.count("fingerprint.perfect_match")
+            return perfect[0]
+        return len(scores) - 1 - int(np.argmax(scores[::-1]))
+
+    def cached_top_match(self):
+        """
+        identify_top_fingerprint_match with a PairCache: only the previous fingerprints
+        whose pair is missing from the cache are encoded and scored, and the attribute
+        results of the best match are recomputed with compare_fingerprint
+        """
+        keys = self.pair_keys()
+        scores = np.array(self.cache.get_many(keys), dtype=np.float64)  # NaN: miss
+        misses = np.flatnonzero(np.isnan(scores))
+        if len(misses) == len(scores):
+            columns = self.columns
+        elif self._columns is not None:
+            columns = self._columns.take(misses)
+        elif len(misses):
+            with INSTRUMENTATION.stage("fingerprint.parse"):
+                columns = FingerprintColumns([self.prev_fps[row] for row in misses])
+        if len(misses):
+            scores[misses] = self.score_candidates(*columns.compare(self.new_fp))
+            self.cache.put_many([(keys[row], float(scores[row])) for row in misses])
+        with INSTRUMENTATION.stage("fingerprint.scoring"):
+            results = self.compare_fingerprint(self.prev_fps[self.top_row(scores)])
+            return self.estimate_fingerprint_match(results), results
+
+    def identify_top_fingerprint_matches(self, new_fingerprints):
+        """
+        Score several new fingerprints against the previous fingerprints, which are encoded
+        only once
+        :return: List of identify_top_fingerprint_match results, one per new fingerprint
+        """
+        matches = []
+        for new_fingerprint in new_fingerprints:
+            comparer = FingerprintBatchCompare(
+                self.prev_fps, new_fingerprint, self.weights, self._columns, self.cache
+            )
+            comparer._previous_hashes = self._previous_hashes  # hashed once, on first use
+            matches.append(comparer.identify_top_fingerprint_match())
+            self._previous_hashes, self._columns = comparer._previous_hashes, comparer._columns
+        return matches
+
+
+def check_parity(prev_fps, new_fp, weights=None):
+    """
+    Compare the batch engine against the scalar FingerprintCompare loop: per-candidate
+    results and similarities must be identical, and so must the top match
+    :return: Number of candidates checked
+    """
+    scalar = FingerprintCompare(prev_fps, new_fp, weights)
+    batch = FingerprintBatchCompare(prev_fps, new_fp, weights)
+    flag_matches, matches = batch.columns.compare(new_fp)
+    scores = batch.score_candidates(flag_matches, matches)
+    for row, prev_fp in enumerate(prev_fps):
+        expected = scalar.compare_fingerprint(prev_fp)
+        actual = batch.candidate_results(row, flag_matches, matches)
+        assert expected == actual, f"candidate {row}: {expected} != {actual}"
+        assert [type(value) for value in expected.values()] == [
+            type(value) for value in actual.values()
+        ], f"candidate {row}: result types differ"
+        assert np.isclose(scalar.estimate_fingerprint_match(expected), scores[row])
+    assert scalar.identify_top_fingerprint_match() == batch.identify_top_fingerprint_match()
+    return len(prev_fps)
+
+
+if __name__ == "__main__":
+    import timeit
+
+    from synthetic import generate_fingerprint_event
+
+    weights = {key: (index % 7) * 0.9 for index, key in enumerate(FINGERPRINT_ATTRIBUTES)}
+    checked = 0
+    for seed in range(20):
+        event = generate_fingerprint_event(200, seed=seed)
+        checked += check_parity(event["previous_fingerprints"], event["new_fingerprint"])
+        checked += check_parity(event["previous_fingerprints"], event["new_fingerprint"], weights)
+        # a repeat of a stored fingerprint exercises the perfect match early exit
+        checked += check_parity(
+            event["previous_fingerprints"], event["previous_fingerprints"][seed]
+        )
+    print(f"parity: {checked} candidate comparisons identical to the scalar path")
+
+    for num_fingerprints in [10, 100, 1000, 5000]:
+        event = generate_fingerprint_event(num_fingerprints, seed=0)
+        args = event["previous_fingerprints"], event["new_fingerprint"], weights
+        scalar = timeit.timeit(
+            lambda: FingerprintCompare(*args).identify_top_fingerprint_match(), number=5
+        )
+        batch = timeit.timeit(
+            lambda: FingerprintBatchCompare(*args).identify_top_fingerprint_match(), number=5
+        )
+        columns = FingerprintBatchCompare(*args).columns
+        encoded = timeit.timeit(
+            lambda: FingerprintBatchCompare(
+                *args, columns=columns
+            ).identify_top_fingerprint_match(),
+            number=5,
+        )
+        print(
+            f"{num_fingerprints:>5} candidates: scalar {scalar / 5 * 1000:.2f} ms, "
+            f"batch {batch / 5 * 1000:.2f} ms, batch (pre-encoded) {encoded / 5 * 1000:.2f} ms"
+        )
+
+    # per request latency of the single-fingerprint lambda path (the history arrives as JSON
+    # and is encoded on every request) and of batch events with 10 new fingerprints
+    for num_fingerprints in [10, 100, 1000]:
+        events = [generate_fingerprint_event(num_fingerprints, seed=seed) for seed in range(40)]
+        line = f"{num_fingerprints:>5} candidates, per request:"
+        for engine in [FingerprintCompare, FingerprintBatchCompare]:
+            times = [
+                timeit.timeit(
+                    lambda: engine(
+                        event["previous_fingerprints"], event["new_fingerprint"]
+                    ).identify_top_fingerprint_match(),
+                    number=1,
+                )
+                for event in events * 3
+            ]
+            p50, p99 = np.percentile(times, [50, 99]) * 1000
+            line += f" {engine.__name__} p50 {p50:.2f} ms, p99 {p99:.2f} ms;"
+        new_fps = [event["new_fingerprint"] for event in events[:10]]
+        history = events[0]["previous_fingerprints"]
+        scalar = timeit.timeit(
+            lambda: [
+                FingerprintCompare(history, new_fp).identify_top_fingerprint_match()
+                for new_fp in new_fps
+            ],
+            number=3,
+        )
+        batch = timeit.timeit(
+            lambda: FingerprintBatchCompare(history).identify_top_fingerprint_matches(new_fps),
+            number=3,
+        )
+        print(
+            f"{line} batch of 10: scalar {scalar / 3 * 1000:.2f} ms, batch {batch / 3 * 1000:.2f} ms"
+        )
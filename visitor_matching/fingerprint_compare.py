@@ -1,4 +1,63 @@
+import heapq
+
 from utils import exact_match, asymmetric_match, match_set, less_than_or_equal
+from instrumentation import INSTRUMENTATION
+from score_cache import content_hash
+
+# attribute name -> function used to compare the previous and new values
+FINGERPRINT_ATTRIBUTES = {
+    "browserVersion": less_than_or_equal,
+    "browserMajorVersion": less_than_or_equal,
+    "isIE": exact_match,
+    "isChrome": exact_match,
+    "isFirefox": exact_match,
+    "isSafari": exact_match,
+    "isOpera": exact_match,
+    "engine": exact_match,
+    "engineVersion": less_than_or_equal,
+    "osVersion": less_than_or_equal,
+    "isWindows": exact_match,
+    "isMac": exact_match,
+    "isLinux": exact_match,
+    "isUbuntu": exact_match,
+    "isSolaris": exact_match,
+    "IsMobile": exact_match,
+    "isMobileMajor": exact_match,
+    "isMobileAndroid": exact_match,
+    "isMobileOpera": exact_match,
+    "isMobileWindows": exact_match,
+    "isMobileBlackBerry": exact_match,
+    "isMobileIOS": exact_match,
+    "isIphone": exact_match,
+    "isIpad": exact_match,
+    "isIpod": exact_match,
+    "colorDepth": less_than_or_equal,
+    "currentResolution": exact_match,
+    "plugins": match_set,
+    "isJava": asymmetric_match,
+    "isFlash": asymmetric_match,
+    "isSilverlight": asymmetric_match,
+    "mimeTypes": match_set,
+    "isMimeTypes": asymmetric_match,
+    "fonts": match_set,
+    "isLocalStorage": asymmetric_match,
+    "isSessionStorage": asymmetric_match,
+    "isCookie": asymmetric_match,
+    "timeZone": exact_match,
+    "language": exact_match,
+    "systemLanguage": exact_match,
+    "isCanvas": asymmetric_match,
+}
+
+# relative cost of a single call of each comparison function, used to order attributes
+# when pruning candidates (match_set splits and intersects two comma separated lists)
+COMPARISON_COSTS = {
+    exact_match: 1,
+    asymmetric_match: 1,
+    less_than_or_equal: 3,
+    match_set: 20,
+}
+BOUND_TOLERANCE = 1e-9  # slack for float summation order when comparing bounds and scores
 
 
 class FingerprintCompare:
@@ -7,10 +66,15 @@ class FingerprintCompare:
     identify whether or not they likely belong to the same individual
     """
 
-    def __init__(self, prev_fps=[], new_fingerprint=None, weights=None):
+    CACHE_KIND = "fingerprint"  # first part of the PairCache keys of this class
+
+    def __init__(self, prev_fps=[], new_fingerprint=None, weights=None, cache=None):
         self.prev_fps = prev_fps  # all previous fingerprints to compare
         self.new_fp = new_fingerprint  # second fingerprint (occurred later)
         self.weights = weights  # optional dictionary indicating weights for similarity attributes
+        self.cache = cache  # optional score_cache.PairCache of pair similarities
+        self.pruning_stats = {}  # attribute evaluation counters of the last top_k_matches call
+        self._previous_hashes = None  # content hashes of prev_fps, computed on first use
 
     def estimate_fingerprint_match(self, results):
         """
@@ -27,59 +91,152 @@ class FingerprintCompare:
 
         return similarity
 
+    def compare_fingerprint(self, prev_fp):
+        """
+        Compare every fingerprint attribute of a previous fingerprint against the new one
+        :return: Dictionary of attribute name -> match result
+        """
+        return {
+            key: compare(prev_fp[key], self.new_fp[key])
+            for key, compare in FINGERPRINT_ATTRIBUTES.items()
+        }
+
+    def pair_keys(self):
+        """
+        :return: PairCache key of every (previous fingerprint, new fingerprint, weights) pair
+        """
+        if self._previous_hashes is None:
+            self._previous_hashes = [content_hash(prev_fp) for prev_fp in self.prev_fps]
+        new_hash, weights_hash = content_hash(self.new_fp), content_hash(self.weights)
+        return [(self.CACHE_KIND, prev, new_hash, weights_hash) for prev in self._previous_hashes]
+
     def identify_top_fingerprint_match(self):
         """
         Iterate through all potential fingerprint matches, return the score of the
-        fingerprint that matches the new fingerprint most closely
+        fingerprint that matches the new fingerprint most closely. With a cache, the
+        similarity of every pair is cached, and only the results of the best match are
+        recomputed when its similarity came from the cache
         """
-        max_similarity = 0.0
-        for prev_fp in self.prev_fps:
-            results = {
-                "browserVersion": less_than_or_equal(prev_fp["browserVersion"], self.new_fp["browserVersion"]),
-                "browserMajorVersion": less_than_or_equal(prev_fp["browserMajorVersion"], self.new_fp["browserMajorVersion"]),
-                "isIE": exact_match(prev_fp["isIE"], self.new_fp["isIE"]),
-                "isChrome": exact_match(prev_fp["isChrome"], self.new_fp["isChrome"]),
-                "isFirefox": exact_match(prev_fp["isFirefox"], self.new_fp["isFirefox"]),
-                "isSafari": exact_match(prev_fp["isSafari"], self.new_fp["isSafari"]),
-                "isOpera": exact_match(prev_fp["isOpera"], self.new_fp["isOpera"]),
-                "engine": exact_match(prev_fp["engine"], self.new_fp["engine"]),
-                "engineVersion": less_than_or_equal(prev_fp["engineVersion"], self.new_fp["engineVersion"]),
-                "osVersion": less_than_or_equal(prev_fp["osVersion"], self.new_fp["osVersion"]),
-                "isWindows": exact_match(prev_fp["isWindows"], self.new_fp["isWindows"]),
-                "isMac": exact_match(prev_fp["isMac"], self.new_fp["isMac"]),
-                "isLinux": exact_match(prev_fp["isLinux"], self.new_fp["isLinux"]),
-                "isUbuntu": exact_match(prev_fp["isUbuntu"], self.new_fp["isUbuntu"]),
-                "isSolaris": exact_match(prev_fp["isSolaris"], self.new_fp["isSolaris"]),
-                "IsMobile": exact_match(prev_fp["IsMobile"], self.new_fp["IsMobile"]),
-                "isMobileMajor": exact_match(prev_fp["isMobileMajor"], self.new_fp["isMobileMajor"]),
-                "isMobileAndroid": exact_match(prev_fp["isMobileAndroid"], self.new_fp["isMobileAndroid"]),
-                "isMobileOpera": exact_match(prev_fp["isMobileOpera"], self.new_fp["isMobileOpera"]),
-                "isMobileWindows": exact_match(prev_fp["isMobileWindows"], self.new_fp["isMobileWindows"]),
-                "isMobileBlackBerry": exact_match(prev_fp["isMobileBlackBerry"], self.new_fp["isMobileBlackBerry"],),
-                "isMobileIOS": exact_match(prev_fp["isMobileIOS"], self.new_fp["isMobileIOS"]),
-                "isIphone": exact_match(prev_fp["isIphone"], self.new_fp["isIphone"]),
-                "isIpad": exact_match(prev_fp["isIpad"], self.new_fp["isIpad"]),
-                "isIpod": exact_match(prev_fp["isIpod"], self.new_fp["isIpod"]),
-                "colorDepth": less_than_or_equal(prev_fp["colorDepth"], self.new_fp["colorDepth"]),
-                "currentResolution": exact_match(prev_fp["currentResolution"], self.new_fp["currentResolution"],),
-                "plugins": match_set(prev_fp["plugins"], self.new_fp["plugins"]),
-                "isJava": asymmetric_match(prev_fp["isJava"], self.new_fp["isJava"]),
-                "isFlash": asymmetric_match(prev_fp["isFlash"], self.new_fp["isFlash"]),
-                "isSilverlight": asymmetric_match(prev_fp["isSilverlight"], self.new_fp["isSilverlight"]),
-                "mimeTypes": match_set(prev_fp["mimeTypes"], self.new_fp["mimeTypes"]),
-                "isMimeTypes": asymmetric_match(prev_fp["isMimeTypes"], self.new_fp["isMimeTypes"]),
-                "fonts": match_set(prev_fp["fonts"], self.new_fp["fonts"]),
-                "isLocalStorage": asymmetric_match(prev_fp["isLocalStorage"], self.new_fp["isLocalStorage"]),
-                "isSessionStorage": asymmetric_match(prev_fp["isSessionStorage"], self.new_fp["isSessionStorage"],),
-                "isCookie": asymmetric_match(prev_fp["isCookie"], self.new_fp["isCookie"]),
-                "timeZone": exact_match(prev_fp["timeZone"], self.new_fp["timeZone"]),
-                "language": exact_match(prev_fp["language"], self.new_fp["language"]),
-                "systemLanguage": exact_match(prev_fp["systemLanguage"], self.new_fp["systemLanguage"]),
-                "isCanvas": asymmetric_match(prev_fp["isCanvas"], self.new_fp["isCanvas"]),
-            }
-            similarity = self.estimate_fingerprint_match(results)
+        keys, cached, computed = None, [None] * len(self.prev_fps), []
+        if self.cache is not None and self.prev_fps:
+            keys = self.pair_keys()
+            cached = self.cache.get_many(keys)
+        max_similarity, max_results, max_number = 0.0, {}, None
+        for number, prev_fp in enumerate(self.prev_fps):
+            similarity, results = cached[number], None
+            if similarity is None:
+                results = self.compare_fingerprint(prev_fp)
+                similarity = self.estimate_fingerprint_match(results)
+                if keys:
+                    computed.append((keys[number], similarity))
             if similarity == 1.0:
-                return similarity, results
+                INSTRUMENTATION.count("fingerprint.candidates_scored", number + 1)
+                INSTRUMENTATION.count("fingerprint.perfect_match")
+                if computed:
+                    self.cache.put_many(computed)
+                return similarity, results or self.compare_fingerprint(prev_fp)
             elif similarity >= max_similarity:
-                max_similarity, max_results = similarity, results
-            return max_similarity, max_results
+                max_similarity, max_results, max_number = similarity, results, number
+        INSTRUMENTATION.count("fingerprint.candidates_scored", len(self.prev_fps))
+        if computed:
+            self.cache.put_many(computed)
+        if max_results is None:
+            max_results = self.compare_fingerprint(self.prev_fps[max_number])
+        return max_similarity, max_results
+
+    def attribute_weight(self, key):
+        return self.weights[key] if self.weights else 1
+
+    def pruning_order(self):
+        """
+        Order attributes so that cheap, heavily weighted ones are evaluated first
+        :return: List of attribute names
+        """
+        return sorted(
+            FINGERPRINT_ATTRIBUTES,
+            key=lambda key: -self.attribute_weight(key)
+            / COMPARISON_COSTS[FINGERPRINT_ATTRIBUTES[key]],
+        )
+
+    def top_k_matches(self, k=1, prune=True):
+        """
+        Rank the previous fingerprints by similarity and return the k best. With prune=True,
+        attributes are evaluated in pruning_order while keeping a weighted upper bound on the
+        candidate's similarity, and the candidate is dropped as soon as that bound falls below
+        the current k-th best. The answer is identical to exhaustive scoring (prune=False).
+        Ties are ranked by position in prev_fps, earlier first.
+        :return: List of up to k dictionaries (best first) with the candidate's index in
+                 prev_fps, its similarity and its per-attribute results
+        """
+        order = self.pruning_order() if prune else list(FINGERPRINT_ATTRIBUTES)
+        denominator = sum(self.weights.values()) if self.weights else len(FINGERPRINT_ATTRIBUTES)
+        weights = [self.attribute_weight(key) for key in order]
+        # remaining[i]: most weight the attributes from position i onwards can still add
+        remaining = [0] * (len(order) + 1)
+        for position in reversed(range(len(order))):
+            remaining[position] = remaining[position + 1] + max(0, weights[position])
+
+        top = []  # min-heap of (similarity, -index, results): top[0] is the current k-th best
+        stats = {"candidates": len(self.prev_fps), "pruned": 0, "evaluated": 0, "skipped": 0}
+        for index, prev_fp in enumerate(self.prev_fps):
+            results, score = {}, 0
+            for position, key in enumerate(order):
+                if (
+                    prune
+                    and len(top) == k
+                    and (score + remaining[position]) / denominator < top[0][0] - BOUND_TOLERANCE
+                ):
+                    stats["pruned"] += 1
+                    stats["skipped"] += len(order) - position
+                    break
+                results[key] = FINGERPRINT_ATTRIBUTES[key](prev_fp[key], self.new_fp[key])
+                score += weights[position] * int(results[key])
+                stats["evaluated"] += 1
+            else:
+                results = {key: results[key] for key in FINGERPRINT_ATTRIBUTES}
+                entry = (self.estimate_fingerprint_match(results), -index, results)
+                if len(top) < k:
+                    heapq.heappush(top, entry)
+                elif entry[:2] > top[0][:2]:
+                    heapq.heapreplace(top, entry)
+
+        self.pruning_stats = stats
+        INSTRUMENTATION.count("fingerprint.candidates_scored", stats["candidates"])
+        INSTRUMENTATION.count("fingerprint.pruned_candidates", stats["pruned"])
+        ranked = sorted(top, key=lambda entry: entry[:2], reverse=True)
+        return [
+            {"index": -index, "similarity": similarity, "results": results}
+            for similarity, index, results in ranked
+        ]
+
+
+def check_top_k(prev_fps, new_fp, weights=None, k=5):
+    """
+    Verify that pruned top-k matching returns exactly what exhaustive scoring returns
+    :return: Attribute evaluation counters of the pruned run
+    """
+    comparer = FingerprintCompare(prev_fps, new_fp, weights)
+    expected = comparer.top_k_matches(k, prune=False)
+    actual = comparer.top_k_matches(k)
+    assert expected == actual, f"pruned top-{k} differs from exhaustive scoring"
+    return comparer.pruning_stats
+
+
+if __name__ == "__main__":
+    from synthetic import generate_fingerprint_event
+
+    weights = {key: (index % 7) * 0.9 for index, key in enumerate(FINGERPRINT_ATTRIBUTES)}
+    for k in [1, 5, 20]:
+        for label, event_weights in [("unweighted", None), ("weighted", weights)]:
+            totals = {"candidates": 0, "pruned": 0, "evaluated": 0, "skipped": 0}
+            for seed in range(20):
+                event = generate_fingerprint_event(500, seed=seed)
+                stats = check_top_k(
+                    event["previous_fingerprints"], event["new_fingerprint"], event_weights, k
+                )
+                totals = {key: totals[key] + stats[key] for key in totals}
+            print(
+                f"top-{k:<2} {label:>10}: {totals['pruned']}/{totals['candidates']} candidates pruned, "
+                f"{totals['skipped']}/{totals['evaluated'] + totals['skipped']} attribute "
+                "evaluations skipped, results identical to exhaustive scoring"
+            )
@@ -0,0 +1,285 @@
+from zlib import crc32
+
+import numpy as np
+
+from fingerprint_batch import (
+    CATEGORICAL_ATTRIBUTES,
+    SET_ATTRIBUTES,
+    FingerprintBatchCompare,
+    FingerprintColumns,
+    set_tokens,
+)
+from instrumentation import INSTRUMENTATION
+
+# engine, timeZone, language, currentResolution and systemLanguage
+BLOCKING_ATTRIBUTES = CATEGORICAL_ATTRIBUTES
+EMPTY_SIGNATURE = np.iinfo(np.uint64).max
+
+
+def token_hash(key, token):
+    """
+    Stable 32 bit hash of a set token, prefixed with its attribute so that e.g. a font and a
+    plugin with the same name are different tokens
+    """
+    return crc32(f"{key}:{token}".encode("utf-8"))
+
+
+class FingerprintIndex:
+    """
+    Candidate blocking for fingerprint matching. Instead of scoring every previous fingerprint,
+    a new fingerprint is only scored against a bounded shortlist of the previous fingerprints
+    that share something with it:
+    - inverted lists on the high selectivity exact match attributes (BLOCKING_ATTRIBUTES)
+    - MinHash signatures over the fonts, plugins and mimeTypes tokens, bucketed with LSH banding
+
+    Candidates collect one vote per shared exact attribute and one vote per LSH band they
+    collide in (scaled so all bands together are worth one vote per set attribute); the
+    max_candidates with the most votes go through full scoring with FingerprintBatchCompare.
+    """
+
+    def __init__(self, prev_fps=[], num_perm=32, band_size=2, seed=1, columns=None):
+        self.columns = columns if columns is not None else FingerprintColumns(prev_fps)
+        self.num_perm, self.band_size = num_perm, band_size
+        self.num_bands = num_perm // band_size
+
+        rng = np.random.default_rng(seed)
+        self.hash_a = rng.integers(1, 2**63, num_perm, dtype=np.uint64) | np.uint64(1)
+        self.hash_b = rng.integers(0, 2**63, num_perm, dtype=np.uint64)
+
+        # inverted lists: attribute -> interned code -> rows holding that value
+        self.postings = {}
+        for key in BLOCKING_ATTRIBUTES:
+            codes = self.columns.codes[key]
+            order = np.argsort(codes, kind="stable")
+            values, starts = np.unique(codes[order], return_index=True)
+            self.postings[key] = {
+                int(code): rows for code, rows in zip(values, np.split(order, starts[1:])) if code
+            }
+
+        self.signatures = self.build_signatures()
+        # LSH buckets: band -> bytes of the band's signature slice (as band_keys) -> rows
+        present = np.flatnonzero(self.signatures[:, 0] != EMPTY_SIGNATURE)
+        self.buckets = []
+        for band in range(self.num_bands):
+            bands = np.ascontiguousarray(
+                self.signatures[present, band * band_size : (band + 1) * band_size]
+            )
+            keys = bands.view(f"V{bands.itemsize * band_size}").ravel()
+            order = np.argsort(keys, kind="stable")
+            values, starts = np.unique(keys[order], return_index=True)
+            self.buckets.append(
+                {
+                    value.tobytes(): present[rows]
+                    for value, rows in zip(values, np.split(order, starts[1:]))
+                }
+            )
+
+    @classmethod
+    def from_account(cls, store, account_id, **kwargs):
+        """
+        Index the history of an account in a FingerprintStore, built once and reused by the
+        lambda across warm requests (see lambda_function.fingerprint_index)
+        """
+        with INSTRUMENTATION.stage("fingerprint.index"):
+            return cls(columns=store.columns(account_id), **kwargs)
+
+    def permute(self, hashes):
+        """
+        Apply every MinHash permutation (multiply-shift hashing) to an array of token hashes
+        :return: Array of shape (len(hashes), num_perm)
+        """
+        hashes = np.asarray(hashes, dtype=np.uint64)[:, None]
+        return (self.hash_a * hashes + self.hash_b) >> np.uint64(32)
+
+    def build_signatures(self):
+        """
+        MinHash signature of every stored fingerprint's fonts, plugins and mimeTypes tokens
+        :return: Array of shape (number of fingerprints, num_perm)
+        """
+        signatures = np.full((self.columns.size, self.num_perm), EMPTY_SIGNATURE, dtype=np.uint64)
+        rows, permuted = [], []
+        for key in SET_ATTRIBUTES:
+            set_rows, token_ids, _ = self.columns.sets[key]
+            vocabulary = self.columns.vocabularies[key]
+            token_hashes = np.zeros(len(vocabulary), dtype=np.uint64)
+            for token, token_id in vocabulary.items():
+                token_hashes[token_id] = token_hash(key, token)
+            # permuted once per distinct token; the permuted hashes are < 2**32
+            rows.append(set_rows)
+            permuted.append(self.permute(token_hashes).astype(np.uint32)[token_ids])
+        rows = np.concatenate(rows)
+        if len(rows) == 0:
+            return signatures
+
+        order = np.argsort(rows, kind="stable")
+        present, starts = np.unique(rows[order], return_index=True)
+        permuted = np.concatenate(permuted)[order]
+        signatures[present] = np.minimum.reduceat(permuted, starts, axis=0)
+        return signatures
+
+    def signature(self, fingerprint):
+        """
+        :return: MinHash signature of a single fingerprint, EMPTY_SIGNATURE if it has no tokens
+        """
+        hashes = [
+            token_hash(key, token)
+            for key in SET_ATTRIBUTES
+            for token in set_tokens(fingerprint[key]) or ()
+        ]
+        if not hashes:
+            return np.full(self.num_perm, EMPTY_SIGNATURE, dtype=np.uint64)
+        return self.permute(hashes).min(axis=0)
+
+    def band_keys(self, signature):
+        """
+        :return: One hashable bucket key per LSH band of a signature
+        """
+        return [
+            signature[band * self.band_size : (band + 1) * self.band_size].tobytes()
+            for band in range(self.num_bands)
+        ]
+
+    def shortlist(self, new_fingerprint, max_candidates=50):
+        """
+        Rank the stored fingerprints by how many blocking keys they share with a new fingerprint
+        :return: Sorted array of at most max_candidates row numbers
+        """
+        votes = np.zeros(self.columns.size)
+        for key in BLOCKING_ATTRIBUTES:
+            value = new_fingerprint[key]
+            code = self.columns.vocabularies[key].get(value) if value else None
+            if code in self.postings[key]:
+                votes[self.postings[key][code]] += 1
+
+        signature = self.signature(new_fingerprint)
+        if signature[0] != EMPTY_SIGNATURE:
+            band_vote = len(SET_ATTRIBUTES) / self.num_bands
+            for buckets, bucket in zip(self.buckets, self.band_keys(signature)):
+                if bucket in buckets:
+                    votes[buckets[bucket]] += band_vote
+
+        if self.columns.size <= max_candidates:
+            return np.arange(self.columns.size)
+        rows = np.argpartition(-votes, max_candidates - 1)[:max_candidates]
+        return np.sort(rows)
+
+    def comparer(self, new_fingerprint, weights=None, max_candidates=50):
+        """
+        :return: FingerprintBatchCompare of a new fingerprint against its shortlist only
+        """
+        with INSTRUMENTATION.stage("fingerprint.shortlist"):
+            columns = self.columns.take(self.shortlist(new_fingerprint, max_candidates))
+        return FingerprintBatchCompare(
+            new_fingerprint=new_fingerprint, weights=weights, columns=columns
+        )
+
+    def identify_top_fingerprint_match(self, new_fingerprint, weights=None, max_candidates=50):
+        """
+        Fully score the shortlist of a new fingerprint
+        :return: Similarity and attribute results of the best match, as
+                 FingerprintCompare.identify_top_fingerprint_match returns them
+        """
+        return self.comparer(
+            new_fingerprint, weights, max_candidates
+        ).identify_top_fingerprint_match()
+
+
+def measure_recall(num_fingerprints, max_candidates, num_events=50, weights=None):
+    """
+    Compare shortlist scoring against brute force scoring on synthetic account histories
+    :return: Dictionary with the fraction of events where the shortlist found the brute force
+             top similarity, the mean latency (ms) of both paths and the mean time (ms) to build
+             the index, which only pays off once it is reused for build / (brute force -
+             shortlist) requests
+    """
+    import time
+
+    from synthetic import generate_fingerprint_event
+
+    hits, brute_time, index_time, build_time = 0, 0.0, 0.0, 0.0
+    for seed in range(num_events):
+        event = generate_fingerprint_event(num_fingerprints, seed=seed, weights=weights)
+        columns = FingerprintColumns(event["previous_fingerprints"])
+        start = time.perf_counter()
+        index = FingerprintIndex(columns=columns)
+        build_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        expected, _ = FingerprintBatchCompare(
+            new_fingerprint=event["new_fingerprint"], weights=weights, columns=index.columns
+        ).identify_top_fingerprint_match()
+        brute_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        actual, _ = index.identify_top_fingerprint_match(
+            event["new_fingerprint"], weights, max_candidates
+        )
+        index_time += time.perf_counter() - start
+        hits += actual == expected
+
+    return {
+        "num_fingerprints": num_fingerprints,
+        "max_candidates": max_candidates,
+        "recall": hits / num_events,
+        "brute_force_ms": 1000 * brute_time / num_events,
+        "shortlist_ms": 1000 * index_time / num_events,
+        "build_ms": 1000 * build_time / num_events,
+    }
+
+
+def check_store_index(directory, num_accounts=5, num_fingerprints=300, seed=0):
+    """
+    Store-backed lambda events are scored against the shortlist of a cached index, which finds
+    the brute force top match, is reused across requests and is rebuilt after an append
+    :return: Number of events checked
+    """
+    import os
+    import shutil
+
+    import lambda_function
+    from fingerprint_store import FingerprintStore
+    from synthetic import generate_fingerprint_event
+
+    shutil.rmtree(directory, ignore_errors=True)
+    store = FingerprintStore(directory)
+    events = {
+        f"account-{number}": generate_fingerprint_event(num_fingerprints, seed=seed + number)
+        for number in range(num_accounts)
+    }
+    store.append_many(
+        {account: event["previous_fingerprints"] for account, event in events.items()}
+    )
+    os.environ["FINGERPRINT_STORE_PATH"] = directory
+
+    def check(account, event):
+        expected = FingerprintBatchCompare.from_account(store, account, event["new_fingerprint"])
+        similarity, results = expected.identify_top_fingerprint_match()
+        body = lambda_function.match_event(
+            {"account_id": account, "new_fingerprint": event["new_fingerprint"]}
+        )["body"]
+        assert body == lambda_function.match_body(similarity, results)
+        return lambda_function._indexes[(directory, account)][1]
+
+    indexes = {account: check(account, event) for account, event in events.items()}
+    for account, event in events.items():
+        assert check(account, event) is indexes[account]  # built once per warm container
+
+    extra = generate_fingerprint_event(10, seed=seed + num_accounts)["previous_fingerprints"]
+    store.append("account-0", extra)
+    rebuilt = check("account-0", events["account-0"])
+    assert rebuilt is not indexes["account-0"]
+    assert rebuilt.columns.size == num_fingerprints + len(extra)
+    shutil.rmtree(directory)
+    return 2 * num_accounts + 1
+
+
+if __name__ == "__main__":
+    print(f"check_store_index: {check_store_index('/tmp/fingerprint_index_check')} events matched")
+    for num_fingerprints in [200, 1000, 5000]:
+        for max_candidates in [10, 25, 50, 100]:
+            report = measure_recall(num_fingerprints, max_candidates, num_events=20)
+            print(
+                f"{report['num_fingerprints']:>5} fingerprints, shortlist {report['max_candidates']:>3}: "
+                f"recall {report['recall']:.2f}, brute force {report['brute_force_ms']:.2f} ms, "
+                f"shortlist {report['shortlist_ms']:.2f} ms, index build {report['build_ms']:.2f} ms"
+            )
@@ -0,0 +1,528 @@
+import json
+import os
+import shutil
+
+import numpy as np
+
+from fingerprint_batch import (
+    CATEGORICAL_ATTRIBUTES,
+    FLAG_ATTRIBUTES,
+    MISSING_VERSION,
+    SET_ATTRIBUTES,
+    VERSION_ATTRIBUTES,
+    FingerprintColumns,
+)
+
+STORE_FORMAT = 1
+GENERATION_PREFIX = "generation."
+VERSION_WIDTH = 4  # version components stored per version attribute (e.g. 99.1.4430.93)
+FLAG_BYTES = (len(FLAG_ATTRIBUTES) + 7) // 8
+
+
+class FingerprintStore:
+    """
+    Append-only, memory-mapped store of the previous fingerprints of every account, in the
+    column layout of FingerprintColumns, so a history is loaded without decoding JSON:
+    - flags.bin: flag attributes, bit-packed (FLAG_BYTES per fingerprint)
+    - version.<attribute>.bin: int64 version components, padded to version_width
+    - code.<attribute>.bin: int32 dictionary codes of the categorical attributes (0: missing)
+    - set_tokens/set_starts/set_sizes.<attribute>.bin: dictionary-encoded token ids of the
+      fonts, plugins and mimeTypes sets, with each fingerprint's offset and token count
+    - vocabularies.json: the dictionaries, shared by all accounts and only ever extended
+    - index.jsonl: one (account, first row, number of rows) segment per append
+
+    These files live in a generation directory (generation.<n>) named by the CURRENT file,
+    next to metadata.json; a store without CURRENT keeps them in its own directory.
+
+    Appends write the column files first and the index line last, so a crashed append leaves
+    rows no index line points at, which the next append overwrites. An account appended to
+    several times has several segments; columns() then concatenates them, and compact()
+    rewrites the store with one contiguous segment per account, which columns() returns as
+    zero-copy views of the memory maps. There is a single writer per store.
+    """
+
+    def __init__(self, path, version_width=VERSION_WIDTH):
+        self.path = path
+        metadata_path = os.path.join(path, "metadata.json")
+        if not os.path.exists(metadata_path):
+            os.makedirs(path, exist_ok=True)
+            self.create_generation(GENERATION_PREFIX + "0")
+            self.swap_generation(GENERATION_PREFIX + "0")
+            with open(metadata_path, "w") as fp:
+                json.dump({"format": STORE_FORMAT, "version_width": version_width}, fp)
+        with open(metadata_path) as fp:
+            metadata = json.load(fp)
+        if metadata["format"] != STORE_FORMAT:
+            raise ValueError(f"{path}: unsupported fingerprint store format {metadata['format']}")
+        self.version_width = metadata["version_width"]
+        self.index_state = -1  # not read yet
+        self.refresh()
+
+    def row_columns(self):
+        """:return: Dictionary of per-fingerprint column file -> (dtype, values per row)"""
+        columns = {"flags": (np.uint8, FLAG_BYTES)}
+        for key in VERSION_ATTRIBUTES:
+            columns[f"version.{key}"] = (np.int64, self.version_width)
+        for key in CATEGORICAL_ATTRIBUTES:
+            columns[f"code.{key}"] = (np.int32, 1)
+        for key in SET_ATTRIBUTES:
+            columns[f"set_starts.{key}"] = (np.int64, 1)
+            columns[f"set_sizes.{key}"] = (np.int32, 1)
+        return columns
+
+    def file_path(self, name, directory=None):
+        return os.path.join(directory or self.data_path, f"{name}.bin")
+
+    def current_generation(self):
+        """:return: Name of the generation directory CURRENT points at ("" without CURRENT)"""
+        try:
+            with open(os.path.join(self.path, "CURRENT")) as fp:
+                return fp.read().strip()
+        except FileNotFoundError:
+            return ""
+
+    def create_generation(self, generation):
+        """
+        Create an empty generation directory, with an empty index and vocabularies
+        :return: Its path
+        """
+        directory = os.path.join(self.path, generation)
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
+        open(os.path.join(directory, "index.jsonl"), "w").close()
+        with open(os.path.join(directory, "vocabularies.json"), "w") as fp:
+            json.dump({}, fp)
+        return directory
+
+    def swap_generation(self, generation):
+        """Point CURRENT at another generation directory, atomically"""
+        path = os.path.join(self.path, "CURRENT")
+        with open(f"{path}.tmp", "w") as fp:
+            fp.write(generation)
+        os.replace(f"{path}.tmp", path)
+
+    def refresh(self):
+        """
+        Re-read the index and remap the column files if another process appended to or
+        compacted the store since they were last read. A generation without index.jsonl is
+        an error, not an empty store, unless compact() swapped in a new one meanwhile
+        :return: True if the store changed
+        """
+        generation = self.current_generation()
+        data_path = os.path.join(self.path, generation)
+        index_path = os.path.join(data_path, "index.jsonl")
+        try:
+            stat = os.stat(index_path)
+            state = (generation, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+            if state == self.index_state:
+                return False
+
+            index, num_rows = {}, 0
+            with open(index_path) as fp:
+                for line in fp:
+                    segment = json.loads(line)
+                    start, count = segment["start"], segment["count"]
+                    index.setdefault(segment["account"], []).append((start, count))
+                    num_rows = max(num_rows, start + count)
+            with open(os.path.join(data_path, "vocabularies.json")) as fp:
+                values = json.load(fp)
+        except FileNotFoundError:
+            if self.current_generation() != generation:
+                return self.refresh()
+            raise
+        self.generation, self.data_path = generation, data_path
+        self.index, self.num_rows, self.index_state = index, num_rows, state
+
+        self.vocabulary_values = {
+            key: values.get(key, []) for key in CATEGORICAL_ATTRIBUTES + SET_ATTRIBUTES
+        }
+        # categorical codes start at 1 (0 is missing), set token ids at 0, as in FingerprintColumns
+        self.vocabularies = {
+            key: {value: code for code, value in enumerate(values, start=1)}
+            for key, values in self.vocabulary_values.items()
+            if key in CATEGORICAL_ATTRIBUTES
+        }
+        self.vocabularies.update(
+            {
+                key: {token: token_id for token_id, token in enumerate(self.vocabulary_values[key])}
+                for key in SET_ATTRIBUTES
+            }
+        )
+
+        self.maps = {
+            name: self.memory_map(name, dtype, self.num_rows, width)
+            for name, (dtype, width) in self.row_columns().items()
+        }
+        for key in SET_ATTRIBUTES:
+            self.maps[f"set_tokens.{key}"] = self.memory_map(
+                f"set_tokens.{key}", np.int32, self.num_tokens(key)
+            )
+        return True
+
+    def memory_map(self, name, dtype, rows, width=1):
+        """:return: Read-only memory map of the first rows of a column file"""
+        shape = (rows, width) if width > 1 else (rows,)
+        if rows == 0:
+            return np.empty(shape, dtype=dtype)
+        return np.memmap(self.file_path(name), dtype=dtype, mode="r", shape=shape)
+
+    def num_tokens(self, key):
+        """:return: Number of committed token ids of a set attribute"""
+        if self.num_rows == 0:
+            return 0
+        last = self.num_rows - 1
+        starts = self.memory_map(f"set_starts.{key}", np.int64, self.num_rows)
+        sizes = self.memory_map(f"set_sizes.{key}", np.int32, self.num_rows)
+        return int(starts[last] + sizes[last])
+
+    def accounts(self):
+        return list(self.index)
+
+    def __contains__(self, account_id):
+        return account_id in self.index
+
+    def count(self, account_id):
+        """:return: Number of stored fingerprints of an account"""
+        return sum(count for _, count in self.index.get(account_id, []))
+
+    def history_key(self, account_id):
+        """
+        :return: Hashable key that changes whenever the stored history of an account does:
+                 appends extend its segments and compact() swaps in a new generation
+        """
+        return self.generation, tuple(self.index.get(account_id, []))
+
+    def segment_arrays(self, start, count):
+        """:return: Dictionary of column -> view of the rows start..start + count"""
+        arrays = {name: self.maps[name][start : start + count] for name in self.row_columns()}
+        for key in SET_ATTRIBUTES:
+            starts = arrays[f"set_starts.{key}"]
+            first = int(starts[0]) if count else 0
+            last = int(starts[-1] + arrays[f"set_sizes.{key}"][-1]) if count else 0
+            arrays[f"set_tokens.{key}"] = self.maps[f"set_tokens.{key}"][first:last]
+        return arrays
+
+    def account_arrays(self, account_id, keep_last=None):
+        """
+        :return: Dictionary of column -> rows of an account, views of the memory maps when
+                 the account is a single segment (see compact)
+        """
+        segments = self.index.get(account_id, [])
+        if keep_last is not None:
+            kept, remaining = [], keep_last
+            for start, count in reversed(segments):
+                if remaining <= 0:
+                    break
+                take = min(count, remaining)
+                kept.append((start + count - take, take))
+                remaining -= take
+            segments = kept[::-1]
+        if len(segments) == 1:
+            return self.segment_arrays(*segments[0])
+        parts = [self.segment_arrays(start, count) for start, count in segments or [(0, 0)]]
+        return {name: np.concatenate([part[name] for part in parts]) for name in parts[0]}
+
+    def columns(self, account_id):
+        """
+        History of an account as FingerprintColumns (an empty one for an unknown account),
+        ready for FingerprintBatchCompare(columns=...). The vocabularies are the store's
+        """
+        arrays = self.account_arrays(account_id)
+        columns = FingerprintColumns.__new__(FingerprintColumns)
+        columns.size = len(arrays["flags"])
+        columns.flags = arrays["flags"]
+        columns.versions = {key: arrays[f"version.{key}"] for key in VERSION_ATTRIBUTES}
+        columns.codes = {key: arrays[f"code.{key}"] for key in CATEGORICAL_ATTRIBUTES}
+        columns.vocabularies = self.vocabularies
+        columns.sets = {}
+        for key in SET_ATTRIBUTES:
+            sizes = arrays[f"set_sizes.{key}"]
+            columns.sets[key] = (
+                np.repeat(np.arange(columns.size), sizes),
+                arrays[f"set_tokens.{key}"],
+                sizes,
+            )
+        return columns
+
+    def encode(self, fingerprints):
+        """
+        Encode fingerprints with FingerprintColumns and translate its per-call dictionaries
+        into the store's, extending them with unseen values
+        :return: Dictionary of column -> array of the new rows
+        """
+        encoded = FingerprintColumns(fingerprints)
+        arrays = {"flags": encoded.flags}
+        for key in VERSION_ATTRIBUTES:
+            column = encoded.versions[key]
+            if column.shape[1] > self.version_width:
+                raise ValueError(
+                    f"{key} has versions of {column.shape[1]} components, the store keeps "
+                    f"{self.version_width}"
+                )
+            padded = np.full((encoded.size, self.version_width), MISSING_VERSION, dtype=np.int64)
+            padded[:, : column.shape[1]] = column
+            arrays[f"version.{key}"] = padded
+        for key in CATEGORICAL_ATTRIBUTES:
+            # local code -> store code (local code 0 stays 0: missing)
+            local = np.zeros(len(encoded.vocabularies[key]) + 1, dtype=np.int32)
+            for value, code in encoded.vocabularies[key].items():
+                local[code] = self.vocabulary_id(key, value)
+            arrays[f"code.{key}"] = local[encoded.codes[key]]
+        for key in SET_ATTRIBUTES:
+            _, token_ids, sizes = encoded.sets[key]
+            local = np.zeros(len(encoded.vocabularies[key]), dtype=np.int32)
+            for token, token_id in encoded.vocabularies[key].items():
+                local[token_id] = self.vocabulary_id(key, token)
+            arrays[f"set_tokens.{key}"] = local[token_ids]
+            arrays[f"set_sizes.{key}"] = sizes.astype(np.int32)
+            arrays[f"set_starts.{key}"] = np.cumsum(sizes) - sizes  # relative to the batch
+        return arrays
+
+    def vocabulary_id(self, key, value):
+        vocabulary = self.vocabularies[key]
+        if value not in vocabulary:
+            vocabulary[value] = len(vocabulary) + (key in CATEGORICAL_ATTRIBUTES)
+            self.vocabulary_values[key].append(value)
+        return vocabulary[value]
+
+    def append(self, account_id, fingerprints):
+        """Add fingerprints to the end of an account's history"""
+        self.append_many({account_id: fingerprints})
+
+    def append_many(self, histories):
+        """
+        Add the fingerprints of several accounts in one write per column file
+        :param histories: dictionary of account id -> list of fingerprints
+        """
+        self.refresh()
+        histories = {account: fps for account, fps in histories.items() if fps}
+        if not histories:
+            return
+        segments, parts, start = [], [], self.num_rows
+        for account_id, fingerprints in histories.items():
+            parts.append(self.encode(fingerprints))
+            segments.append({"account": account_id, "start": start, "count": len(fingerprints)})
+            start += len(fingerprints)
+        arrays = {name: np.concatenate([part[name] for part in parts]) for name in parts[0]}
+        token_offsets = {key: self.num_tokens(key) for key in SET_ATTRIBUTES}
+        for key in SET_ATTRIBUTES:
+            sizes = arrays[f"set_sizes.{key}"]
+            arrays[f"set_starts.{key}"] = token_offsets[key] + np.cumsum(sizes) - sizes
+
+        committed = {name: self.num_rows for name in self.row_columns()}
+        committed.update({f"set_tokens.{key}": offset for key, offset in token_offsets.items()})
+        self.write_columns(arrays, committed)
+        self.write_vocabularies()
+        with open(os.path.join(self.data_path, "index.jsonl"), "a") as fp:
+            fp.write("".join(json.dumps(segment) + "\n" for segment in segments))
+        self.refresh()
+
+    def write_columns(self, arrays, committed=None, directory=None):
+        """
+        Append arrays to the column files, after cutting off any rows beyond the committed
+        ones that a failed append left behind
+        :param committed: dictionary of column -> number of committed rows (None: no cut)
+        :param directory: generation directory to write to (None: the current one)
+        """
+        for name, array in arrays.items():
+            path = self.file_path(name, directory)
+            with open(path, "r+b" if os.path.exists(path) else "wb") as fp:
+                if committed is not None:
+                    row_bytes = array.itemsize * int(np.prod(array.shape[1:]))
+                    fp.truncate(committed[name] * row_bytes)
+                fp.seek(0, os.SEEK_END)
+                fp.write(np.ascontiguousarray(array).tobytes())
+
+    def write_vocabularies(self, directory=None):
+        path = os.path.join(directory or self.data_path, "vocabularies.json")
+        with open(f"{path}.tmp", "w") as fp:
+            json.dump(self.vocabulary_values, fp)
+        os.replace(f"{path}.tmp", path)
+
+    def compact(self, keep_last=None):
+        """
+        Rewrite the store with every account's fingerprints in one contiguous segment,
+        optionally keeping only the keep_last most recent fingerprints of each account.
+        The new store is written to a new generation directory and swapped in by replacing
+        CURRENT, so readers always find a complete generation. Processes that still map the
+        old files keep reading them until they refresh(); the previous generation is only
+        deleted by the next compaction
+        :return: Number of fingerprints kept
+        """
+        self.refresh()
+        number = int(self.generation[len(GENERATION_PREFIX) :] or 0) + 1
+        generation = f"{GENERATION_PREFIX}{number}"
+        compacted_path = self.create_generation(generation)
+
+        segments, rows, tokens = [], 0, {key: 0 for key in SET_ATTRIBUTES}
+        for account_id in self.index:
+            arrays = self.account_arrays(account_id, keep_last)
+            count = len(arrays["flags"])
+            for key in SET_ATTRIBUTES:
+                sizes = arrays[f"set_sizes.{key}"]
+                arrays[f"set_starts.{key}"] = tokens[key] + np.cumsum(sizes) - sizes
+                tokens[key] += int(sizes.sum())
+            self.write_columns(arrays, directory=compacted_path)
+            segments.append({"account": account_id, "start": rows, "count": count})
+            rows += count
+        self.write_vocabularies(compacted_path)
+        with open(os.path.join(compacted_path, "index.jsonl"), "w") as fp:
+            fp.write("".join(json.dumps(segment) + "\n" for segment in segments))
+
+        previous = self.generation
+        self.swap_generation(generation)
+        self.refresh()
+        # drop the generations before the previous one, and the files of a store that had no
+        # CURRENT once it is no longer the previous generation
+        for name in os.listdir(self.path):
+            entry = os.path.join(self.path, name)
+            if name in ("metadata.json", "CURRENT", previous, generation):
+                continue
+            if os.path.isdir(entry):
+                shutil.rmtree(entry)
+            elif previous:
+                os.remove(entry)
+        return rows
+
+
+def check_store(directory, num_accounts=20, seed=0):
+    """
+    Histories appended in interleaved batches score every new fingerprint exactly like the
+    JSON histories, before and after compaction (also from a reader that opened the store
+    before it), and compact(keep_last) keeps the most recent fingerprints
+    :return: Number of fingerprints stored
+    """
+    from fingerprint_batch import FingerprintBatchCompare, check_parity
+    from synthetic import generate_fingerprint_event
+
+    shutil.rmtree(directory, ignore_errors=True)
+    store = FingerprintStore(directory)
+    events = {
+        f"account-{number}": generate_fingerprint_event(5 + 20 * number, seed=seed + number)
+        for number in range(num_accounts)
+    }
+    weights = {key: (index % 7) * 0.9 for index, key in enumerate(FLAG_ATTRIBUTES)}
+    weights.update({key: 2 for key in VERSION_ATTRIBUTES + CATEGORICAL_ATTRIBUTES + SET_ATTRIBUTES})
+
+    histories = {account: [] for account in events}  # in store order
+    # three interleaved appends per account give every history three segments
+    for part in range(3):
+        batch = {
+            account: event["previous_fingerprints"][part::3] for account, event in events.items()
+        }
+        store.append_many(batch)
+        for account, fingerprints in batch.items():
+            histories[account].extend(fingerprints)
+
+    def check(reopened):
+        for account, event in events.items():
+            history, new_fp = histories[account], event["new_fingerprint"]
+            for event_weights in [None, weights]:
+                expected = FingerprintBatchCompare(history, new_fp, event_weights)
+                actual = FingerprintBatchCompare.from_account(
+                    reopened, account, new_fp, event_weights
+                )
+                assert (
+                    expected.identify_top_fingerprint_match()
+                    == actual.identify_top_fingerprint_match()
+                )
+                scores = expected.score_candidates(*expected.columns.compare(new_fp))
+                assert np.array_equal(
+                    scores, actual.score_candidates(*actual.columns.compare(new_fp))
+                )
+            check_parity(history, new_fp)
+
+    check(FingerprintStore(directory))
+    # an append that died before writing its index line leaves rows the next append replaces
+    for name in ["flags", f"set_tokens.{SET_ATTRIBUTES[0]}"]:
+        with open(store.file_path(name), "ab") as fp:
+            fp.write(b"\xff" * 13)
+    extra = generate_fingerprint_event(7, seed=seed + num_accounts)
+    events["extra"], histories["extra"] = extra, extra["previous_fingerprints"] * 3
+    store.append("extra", extra["previous_fingerprints"])
+    store.append_many({"extra": extra["previous_fingerprints"] * 2})
+    check(FingerprintStore(directory))
+
+    # a reader opened before compaction keeps its generation until it refreshes
+    reader = FingerprintStore(directory)
+    store.compact()
+    check(reader)
+    assert reader.refresh() and reader.generation == store.generation
+    compacted = FingerprintStore(directory)
+    assert all(len(segments) == 1 for segments in compacted.index.values())
+    assert isinstance(compacted.columns("account-1").flags.base, np.memmap)  # zero-copy view
+    check(compacted)
+
+    total = store.num_rows
+    store.compact(keep_last=10)
+    for account, history in histories.items():
+        kept = FingerprintBatchCompare(history[-10:]).columns
+        stored = store.columns(account)
+        assert store.count(account) == min(10, len(history))
+        assert np.array_equal(kept.flags, stored.flags)
+    assert store.columns("unknown").size == 0
+    generations = [name for name in os.listdir(directory) if name.startswith(GENERATION_PREFIX)]
+    assert sorted(generations) == [f"{GENERATION_PREFIX}1", f"{GENERATION_PREFIX}2"]
+
+    # a generation that lost its index is an error, not an empty store
+    os.remove(os.path.join(store.data_path, "index.jsonl"))
+    try:
+        FingerprintStore(directory)
+        raise AssertionError("a store without index.jsonl was opened as empty")
+    except FileNotFoundError:
+        pass
+    shutil.rmtree(directory)
+    return total
+
+
+def benchmark_load(directory, sizes=(10, 100, 1000, 5000), number=20):
+    """
+    Time getting an account history ready for scoring: decoding the event JSON and encoding
+    it (what the lambda does with previous_fingerprints) against mapping it from the store
+    :return: List of (history size, JSON ms, store ms, compacted store ms)
+    """
+    import timeit
+
+    from fingerprint_batch import FingerprintBatchCompare
+    from synthetic import generate_fingerprint_event
+
+    shutil.rmtree(directory, ignore_errors=True)
+    store = FingerprintStore(directory)
+    payloads = {}
+    for size in sizes:
+        history = generate_fingerprint_event(size, seed=size)["previous_fingerprints"]
+        payloads[size] = json.dumps(history)
+        # appended in two halves, so the history is two segments until compaction
+        store.append(size, history[: size // 2])
+        store.append(size, history[size // 2 :])
+
+    def measure(load):
+        return min(timeit.repeat(load, number=number, repeat=3)) / number * 1000
+
+    json_ms = {
+        size: measure(lambda: FingerprintBatchCompare(json.loads(payloads[size]))) for size in sizes
+    }
+    store_ms = {
+        size: measure(lambda: FingerprintBatchCompare.from_account(store, size)) for size in sizes
+    }
+    store.compact()
+    compacted_ms = {
+        size: measure(lambda: FingerprintBatchCompare.from_account(store, size)) for size in sizes
+    }
+    shutil.rmtree(directory)
+    return [(size, json_ms[size], store_ms[size], compacted_ms[size]) for size in sizes]
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Check and benchmark the fingerprint store")
+    parser.add_argument("--directory", default="/tmp/fingerprint_store_check")
+    args = parser.parse_args()
+
+    print(f"check_store: {check_store(args.directory)} fingerprints scored identically")
+    for size, json_ms, store_ms, compacted_ms in benchmark_load(args.directory):
+        print(
+            f"{size:>5} fingerprints: JSON decode + encode {json_ms:.3f} ms, store "
+            f"{store_ms:.3f} ms, compacted store {compacted_ms:.3f} ms"
+        )
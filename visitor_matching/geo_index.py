@@ -0,0 +1,296 @@
+from math import asin, cos, degrees, pi, radians, sin
+
+import numpy as np
+
+from identity_index import visitor_key
+from utils import EARTH_RADIUS, haversine_distances, parse_timestamp
+
+MAX_PLAUSIBLE_SPEED = 0.35  # km/s, as VisitorAttributeCompare.MAX_PLAUSIBLE_SPEED
+MAX_DISTANCE = pi * EARTH_RADIUS  # half the circumference, the largest haversine distance
+
+
+class GeoIndex:
+    """
+    Grid index over the IP observations (ips[].props latitude/longitude and updated_at) of
+    stored visitors. Observations are bucketed into cells of cell_degrees x cell_degrees; a
+    radius query only computes haversine distances for the observations in the cells that
+    intersect the bounding box of the circle. The box spans every longitude when the circle
+    contains a pole, and wraps around the antimeridian.
+
+    Observations are also kept sorted by time, so impossible-travel checks (a large distance
+    covered faster than max_speed) only look at observations recent enough to be implausible.
+    """
+
+    def __init__(self, cell_degrees=1.0):
+        self.cell_degrees = cell_degrees
+        self.num_lat_cells = int(np.ceil(180 / cell_degrees))
+        self.num_lon_cells = int(np.ceil(360 / cell_degrees))
+        self.visitor_ids, self.ips, latitudes, longitudes, times = [], [], [], [], []
+        self._columns = latitudes, longitudes, times
+        self.cells = {}  # (latitude cell, longitude cell) -> list of observation rows
+        self._arrays = None  # numpy copies of the columns, built on first query
+
+    def __len__(self):
+        return len(self.ips)
+
+    def cell(self, latitude, longitude):
+        """
+        :return: (latitude cell, longitude cell) of a point, longitudes wrapped to [-180, 180)
+        """
+        lat_cell = min(int((latitude + 90) // self.cell_degrees), self.num_lat_cells - 1)
+        lon_cell = int(((longitude + 180) % 360) // self.cell_degrees) % self.num_lon_cells
+        return lat_cell, lon_cell
+
+    def add(self, visitor_id, ip):
+        """
+        Add one IP observation ({"ip", "updated_at", "props": {"latitude", "longitude"}})
+        """
+        latitude, longitude = ip["props"]["latitude"], ip["props"]["longitude"]
+        time = parse_timestamp(ip.get("updated_at"))
+        row = len(self.ips)
+        self.visitor_ids.append(visitor_id)
+        self.ips.append(ip.get("ip"))
+        for column, value in zip(self._columns, [latitude, longitude, time]):
+            column.append(value)
+        self.cells.setdefault(self.cell(latitude, longitude), []).append(row)
+        self._arrays = None
+
+    def add_visitor(self, visitor, visitor_id=None):
+        """
+        Add every IP observation of a visitor
+        :param visitor_id: id of the visitor, identity_index.visitor_key(visitor) by default
+        """
+        visitor_id = visitor_key(visitor) if visitor_id is None else visitor_id
+        for ip in visitor["ips"]:
+            self.add(visitor_id, ip)
+
+    def arrays(self):
+        """
+        :return: Latitudes, longitudes, times (epoch microseconds, see utils.parse_timestamp),
+                 whether the time is present, and the rows sorted by time
+        """
+        if self._arrays is None:
+            latitudes, longitudes, times = self._columns
+            has_time = np.array([time is not None for time in times], dtype=bool)
+            times = np.array([time or 0 for time in times], dtype=np.int64)
+            timed = np.flatnonzero(has_time)
+            self._arrays = (
+                np.array(latitudes, dtype=np.float64),
+                np.array(longitudes, dtype=np.float64),
+                times,
+                has_time,
+                timed[np.argsort(times[timed], kind="stable")],
+            )
+        return self._arrays
+
+    def query_cells(self, latitude, longitude, radius):
+        """
+        Cells intersecting the bounding box of a circle (see Matuschek, "Finding Points Within
+        a Distance of a Latitude/Longitude Using Bounding Coordinates")
+        :return: List of (latitude cell, longitude cell)
+        """
+        angle = radius / EARTH_RADIUS + 1e-9  # guard against rounding at the box edges
+        lat_min, lat_max = latitude - degrees(angle), latitude + degrees(angle)
+        lat_cells = range(self.cell(max(lat_min, -90), 0)[0], self.cell(min(lat_max, 90), 0)[0] + 1)
+        ratio = sin(angle) / cos(radians(latitude)) if abs(latitude) < 90 else 2
+        if lat_min <= -90 or lat_max >= 90 or angle >= pi / 2 or ratio >= 1:
+            lon_cells = range(self.num_lon_cells)  # the circle contains a pole
+        else:
+            delta = degrees(asin(ratio))  # at most 90, so the range never covers the circle
+            first = self.cell(0, longitude - delta)[1]
+            last = self.cell(0, longitude + delta)[1]
+            if first <= last:
+                lon_cells = range(first, last + 1)
+            else:  # wraps around the antimeridian
+                lon_cells = list(range(first, self.num_lon_cells)) + list(range(last + 1))
+        return [(lat_cell, lon_cell) for lat_cell in lat_cells for lon_cell in lon_cells]
+
+    def within(self, latitude, longitude, radius, start=None, end=None):
+        """
+        Stored IP observations within radius km of a point, optionally observed in
+        [start, end] (epoch microseconds; observations without a time are then excluded)
+        :return: Array of observation rows and array of their distances (km)
+        """
+        rows = [
+            row
+            for cell in self.query_cells(latitude, longitude, radius)
+            for row in self.cells.get(cell, ())
+        ]
+        rows = np.array(sorted(rows), dtype=np.int64)
+        latitudes, longitudes, times, has_time, _ = self.arrays()
+        if start is not None or end is not None:
+            keep = has_time[rows]
+            if start is not None:
+                keep &= times[rows] >= start
+            if end is not None:
+                keep &= times[rows] <= end
+            rows = rows[keep]
+        distances = haversine_distances(latitudes[rows], longitudes[rows], latitude, longitude)
+        keep = distances <= radius
+        return rows[keep], distances[keep]
+
+    def nearby_visitors(self, new_visitor, radius=10):
+        """
+        Stored visitors with an IP observation within radius km of one of the new visitor's
+        IP observations, e.g. the candidates that get full geographic proximity credit
+        :return: Dictionary of visitor id -> smallest distance (km), nearest first
+        """
+        nearest = {}
+        for ip in new_visitor["ips"]:
+            rows, distances = self.within(ip["props"]["latitude"], ip["props"]["longitude"], radius)
+            for row, distance in zip(rows, distances):
+                visitor_id = self.visitor_ids[row]
+                if distance < nearest.get(visitor_id, np.inf):
+                    nearest[visitor_id] = float(distance)
+        return dict(sorted(nearest.items(), key=lambda item: item[1]))
+
+    def impossible_travel(self, ip, max_speed=MAX_PLAUSIBLE_SPEED):
+        """
+        Stored observations the new IP observation could not have been reached from: more
+        than 10 km away and covered faster than max_speed, as in
+        VisitorAttributeCompare.telemetry_scores. No distance exceeds MAX_DISTANCE, so only
+        observations from the last MAX_DISTANCE / max_speed seconds (about 16 hours) can be
+        implausible, and only those are compared
+        :return: Array of observation rows and array of their distances (km)
+        """
+        time = parse_timestamp(ip.get("updated_at"))
+        if time is None:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+        latitudes, longitudes, times, _, by_time = self.arrays()
+        window = int(MAX_DISTANCE / max_speed * 1e6)
+        sorted_times = times[by_time]
+        first = np.searchsorted(sorted_times, time - window, side="left")
+        last = np.searchsorted(sorted_times, time, side="right")
+        rows = np.sort(by_time[first:last])
+        distances = haversine_distances(
+            latitudes[rows], longitudes[rows], ip["props"]["latitude"], ip["props"]["longitude"]
+        )
+        with np.errstate(divide="ignore"):
+            speeds = distances / ((time - times[rows]) / 1e6)
+        flagged = (distances > 10) & (speeds > max_speed)
+        return rows[flagged], distances[flagged]
+
+    def ip_timing_red_flag(self, new_visitor, max_speed=MAX_PLAUSIBLE_SPEED):
+        """
+        :return: True if any of the new visitor's IP observations is implausibly far from a
+                 stored observation (see impossible_travel)
+        """
+        return any(len(self.impossible_travel(ip, max_speed)[0]) for ip in new_visitor["ips"])
+
+
+def check_within(index, latitude, longitude, radius):
+    """
+    Verify GeoIndex.within against brute force haversine over every stored observation
+    :return: Number of observations within radius
+    """
+    latitudes, longitudes, *_ = index.arrays()
+    distances = haversine_distances(latitudes, longitudes, latitude, longitude)
+    expected = np.flatnonzero(distances <= radius)
+    rows, actual = index.within(latitude, longitude, radius)
+    assert np.array_equal(expected, rows), (latitude, longitude, radius)
+    assert np.allclose(distances[expected], actual)
+    return len(rows)
+
+
+def check_edges(num_points=20000, seed=0):
+    """
+    Check radius queries near the poles and the antimeridian, where the bounding box of a
+    circle wraps around, against brute force
+    :return: Number of queries and total number of observations found
+    """
+    rng = np.random.default_rng(seed)
+    # a third of the points near each pole, a third near the antimeridian, the rest anywhere
+    latitudes = np.concatenate(
+        [
+            rng.uniform(85, 90, num_points // 6),
+            rng.uniform(-90, -85, num_points // 6),
+            rng.uniform(-60, 60, num_points // 3),
+            np.degrees(np.arcsin(rng.uniform(-1, 1, num_points // 3))),
+        ]
+    )
+    longitudes = np.concatenate(
+        [
+            rng.uniform(-180, 180, 2 * (num_points // 6)),
+            rng.choice([-1, 1], num_points // 3) * rng.uniform(175, 180, num_points // 3),
+            rng.uniform(-180, 180, num_points // 3),
+        ]
+    )
+    queries, found = 0, 0
+    for cell_degrees in [0.5, 1.0, 7.0]:
+        index = GeoIndex(cell_degrees)
+        for number, (latitude, longitude) in enumerate(zip(latitudes, longitudes)):
+            index.add(number, {"ip": None, "props": {"latitude": latitude, "longitude": longitude}})
+        for latitude, longitude in [
+            (90, 0),
+            (-90, 45),
+            (89.9, 179.9),
+            (-89.5, -179.99),
+            (88, 10),
+            (0, 180),
+            (0, -180),
+            (45, 179.95),
+            (-30, -179.5),
+            (10, 0),
+        ]:
+            for radius in [1, 10, 100, 500, 1000, 5000, 20000]:
+                found += check_within(index, latitude, longitude, radius)
+                queries += 1
+    return queries, found
+
+
+def check_impossible_travel(num_visitors=300, seed=0):
+    """
+    Verify GeoIndex.ip_timing_red_flag against the red flag of match_telemetry
+    :return: Number of new visitors checked and number red flagged
+    """
+    import random
+
+    from synthetic import VISITOR_WEIGHTS, generate_visitor, mutate_visitor
+    from visitor_attribute_compare import VisitorAttributeCompare
+
+    rng = random.Random(seed)
+    visitors = [generate_visitor(rng, 3) for _ in range(num_visitors)]
+    index = GeoIndex()
+    for number, visitor in enumerate(visitors):
+        index.add_visitor(visitor, number)
+
+    flagged = 0
+    for _ in range(100):
+        new_visitor = mutate_visitor(rng, rng.choice(visitors), 2)
+        expected = VisitorAttributeCompare(visitors, new_visitor, VISITOR_WEIGHTS).match_telemetry()
+        actual = index.ip_timing_red_flag(new_visitor)
+        assert actual == expected["ip_timing_red_flag"]
+        flagged += actual
+    return 100, flagged
+
+
+if __name__ == "__main__":
+    import time
+
+    queries, found = check_edges()
+    print(f"poles/antimeridian: {queries} radius queries agree with brute force ({found} hits)")
+    checked, flagged = check_impossible_travel()
+    print(f"impossible travel: {checked} visitors agree with match_telemetry ({flagged} flagged)")
+
+    rng = np.random.default_rng(1)
+    for num_points in [10000, 100000, 1000000]:
+        index = GeoIndex()
+        latitudes = np.degrees(np.arcsin(rng.uniform(-1, 1, num_points)))
+        longitudes = rng.uniform(-180, 180, num_points)
+        for number, (latitude, longitude) in enumerate(zip(latitudes, longitudes)):
+            index.add(number, {"ip": None, "props": {"latitude": latitude, "longitude": longitude}})
+        all_latitudes, all_longitudes, *_ = index.arrays()
+
+        start = time.perf_counter()
+        for latitude, longitude in zip(latitudes[:100], longitudes[:100]):
+            index.within(latitude, longitude, 10)
+        grid = (time.perf_counter() - start) / 100
+        start = time.perf_counter()
+        for latitude, longitude in zip(latitudes[:100], longitudes[:100]):
+            distances = haversine_distances(all_latitudes, all_longitudes, latitude, longitude)
+            np.flatnonzero(distances <= 10)
+        brute = (time.perf_counter() - start) / 100
+        print(
+            f"{num_points:>7} observations, 10 km radius: grid {grid * 1000:.3f} ms, "
+            f"brute force {brute * 1000:.3f} ms"
+        )
@@ -0,0 +1,328 @@
+import json
+import pathlib
+import re
+import sqlite3
+
+from visitor_attribute_compare import PAYMENT_DETAILS
+
+# kind of index key -> function computing its normalized value from a visitor (None: no key)
+IDENTITY_KEYS = {
+    "payment_fingerprint": lambda visitor: normalize_token(
+        visitor["payment_methods"].get("fingerprint")
+    ),
+    "card": lambda visitor: card_key(visitor["payment_methods"]),
+    "email": lambda visitor: normalize_token(visitor["visitor_users"].get("email")),
+    "Phone": lambda visitor: normalize_phone(visitor["visitor_users"].get("Phone")),
+    "username": lambda visitor: normalize_token(visitor["visitor_users"].get("username")),
+    "name": lambda visitor: name_key(visitor["visitor_users"]),
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS visitors (visitor_id TEXT PRIMARY KEY, visitor TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS identity_keys (
+    kind TEXT NOT NULL,
+    value TEXT NOT NULL,
+    visitor_id TEXT NOT NULL,
+    PRIMARY KEY (kind, value, visitor_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS identity_keys_visitor ON identity_keys (visitor_id);
+"""
+
+
+def normalize_token(value):
+    """
+    :return: Lowercased string without surrounding whitespace, or None if the value is missing
+    """
+    if value is None:
+        return None
+    value = str(value).strip().lower()
+    return value or None
+
+
+def normalize_phone(value):
+    """
+    :return: Digits of a phone number, or None if it has none
+    """
+    if value is None:
+        return None
+    return re.sub(r"\D", "", str(value)) or None
+
+
+def card_key(payment):
+    """
+    The card details that match_payment compares as a whole
+    :return: Joined normalized card details, or None if any of them is missing
+    """
+    details = [normalize_token(payment.get(field)) for field in PAYMENT_DETAILS]
+    return "|".join(details) if all(details) else None
+
+
+def name_key(users):
+    """
+    First and last name as one key: either name alone is too common to narrow the candidates
+    :return: Normalized full name, or None if either name is missing
+    """
+    first, last = normalize_token(users.get("First_name")), normalize_token(users.get("Last_name"))
+    return f"{first} {last}" if first and last else None
+
+
+def identity_keys(visitor):
+    """
+    :return: List of (kind, normalized value) index keys of a visitor
+    """
+    keys = []
+    for kind, key in IDENTITY_KEYS.items():
+        value = key(visitor)
+        if value is not None:
+            keys.append((kind, value))
+    return keys
+
+
+def visitor_key(visitor):
+    """
+    :return: Id of a visitor, the id column of its visitors record
+    """
+    return str(visitor["visitors"]["id"])
+
+
+class IdentityIndex:
+    """
+    Persistent exact-match index over the identity and payment fields of stored visitors
+    (SQLite, so a snapshot is a single file that can be shipped with or downloaded by the
+    lambda). Every visitor is stored with its normalized keys (IDENTITY_KEYS): payment
+    fingerprint, card details, email, phone, username and full name. The candidates of a new
+    visitor are the stored visitors sharing at least one key, found with one primary key
+    lookup per key instead of a scan over the whole history.
+
+    Keys are normalized more loosely than match_payment and match_identity_information
+    compare (case, whitespace, phone formatting), so every visitor sharing one of these
+    values is a candidate. The candidates are not every visitor those methods would credit:
+    a visitor sharing only a first or a last name is intentionally dropped (see name_key),
+    as is one that would only score on address or telemetry.
+    """
+
+    def __init__(self, path=":memory:", read_only=False):
+        """
+        :param read_only: open an existing index for candidate lookups only: the connection
+                          cannot write, no schema is created, and it can be shared between
+                          threads (sqlite3 serializes the calls)
+        """
+        self.path = path
+        if read_only:
+            self.connection = sqlite3.connect(
+                pathlib.Path(path).resolve().as_uri() + "?mode=ro",
+                uri=True,
+                check_same_thread=False,
+            )
+        else:
+            self.connection = sqlite3.connect(path)
+            self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM visitors").fetchone()[0]
+
+    def upsert(self, visitor, visitor_id=None):
+        """
+        Insert a visitor, or replace a stored visitor with the same id along with its keys
+        :param visitor_id: id of the visitor, visitor_key(visitor) by default
+        """
+        with self.connection:
+            self._upsert(visitor_key(visitor) if visitor_id is None else str(visitor_id), visitor)
+
+    def _upsert(self, visitor_id, visitor):
+        self.connection.execute("DELETE FROM identity_keys WHERE visitor_id = ?", (visitor_id,))
+        self.connection.execute(
+            "INSERT OR REPLACE INTO visitors VALUES (?, ?)", (visitor_id, json.dumps(visitor))
+        )
+        self.connection.executemany(
+            "INSERT OR IGNORE INTO identity_keys VALUES (?, ?, ?)",
+            [(kind, value, visitor_id) for kind, value in identity_keys(visitor)],
+        )
+
+    def bulk_load(self, visitors, batch_size=10000):
+        """
+        Load many visitors at once (e.g. the lines of a JSONL export). Visitors are inserted
+        in batches, one transaction per batch; existing visitors with the same id are replaced
+        :param visitors: iterable of visitor dictionaries
+        :return: Number of visitors loaded
+        """
+        loaded, batch = 0, []
+        for visitor in visitors:
+            batch.append(visitor)
+            if len(batch) == batch_size:
+                loaded += self._load_batch(batch)
+                batch = []
+        return loaded + self._load_batch(batch)
+
+    def _load_batch(self, visitors):
+        ids = [visitor_key(visitor) for visitor in visitors]
+        with self.connection:
+            self.connection.executemany(
+                "DELETE FROM identity_keys WHERE visitor_id = ?", [(i,) for i in ids]
+            )
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO visitors VALUES (?, ?)",
+                [(i, json.dumps(visitor)) for i, visitor in zip(ids, visitors)],
+            )
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO identity_keys VALUES (?, ?, ?)",
+                [
+                    (kind, value, i)
+                    for i, visitor in zip(ids, visitors)
+                    for kind, value in identity_keys(visitor)
+                ],
+            )
+        return len(visitors)
+
+    def load_jsonl(self, path, batch_size=10000):
+        """
+        Bulk load a JSONL export with one visitor per line
+        :return: Number of visitors loaded
+        """
+        with open(path) as export:
+            return self.bulk_load((json.loads(line) for line in export if line.strip()), batch_size)
+
+    def candidate_ids(self, new_visitor, max_candidates=None):
+        """
+        Ids of the stored visitors sharing at least one identity key with a new visitor, the
+        ones sharing the most keys first
+        :return: List of (visitor id, number of shared keys)
+        """
+        keys = identity_keys(new_visitor)
+        if not keys:
+            return []
+        query = (
+            "SELECT visitor_id, COUNT(*) AS shared FROM identity_keys WHERE "
+            + " OR ".join(["(kind = ? AND value = ?)"] * len(keys))
+            + " GROUP BY visitor_id ORDER BY shared DESC, visitor_id"
+        )
+        parameters = [part for key in keys for part in key]
+        if max_candidates is not None:
+            query += " LIMIT ?"
+            parameters.append(max_candidates)
+        return self.connection.execute(query, parameters).fetchall()
+
+    def candidates(self, new_visitor, max_candidates=None):
+        """
+        :return: List of the stored visitors sharing at least one identity key with a new
+                 visitor, in the shape VisitorAttributeCompare takes as prev_vs
+        """
+        ids = [visitor_id for visitor_id, _ in self.candidate_ids(new_visitor, max_candidates)]
+        if not ids:
+            return []
+        rows = dict(
+            self.connection.execute(
+                f"SELECT visitor_id, visitor FROM visitors WHERE visitor_id IN "
+                f"({', '.join('?' * len(ids))})",
+                ids,
+            ).fetchall()
+        )
+        return [json.loads(rows[visitor_id]) for visitor_id in ids]
+
+    def snapshot(self, path):
+        """
+        Write a consistent copy of the index to path (e.g. before uploading it for the lambda)
+        """
+        target = sqlite3.connect(path)
+        with target:
+            self.connection.backup(target)
+        target.close()
+
+
+def check_candidates(index, visitors, new_visitor):
+    """
+    Verify that the index returns exactly the stored visitors that share a normalized
+    identity key with new_visitor, compared against a linear scan of visitors
+    :return: Number of candidates
+    """
+    new_keys = set(identity_keys(new_visitor))
+    expected = {visitor_key(v) for v in visitors if new_keys & set(identity_keys(v))}
+    actual = {visitor_id for visitor_id, _ in index.candidate_ids(new_visitor)}
+    assert expected == actual, (expected, actual)
+    return len(actual)
+
+
+if __name__ == "__main__":
+    import os
+    import random
+    import sys
+    import tempfile
+    import time
+
+    from synthetic import generate_visitor, mutate_visitor
+
+    if len(sys.argv) == 3:
+        # python identity_index.py export.jsonl index.db
+        index = IdentityIndex(sys.argv[2])
+        print(f"loaded {index.load_jsonl(sys.argv[1])} visitors into {sys.argv[2]}")
+        sys.exit()
+
+    rng = random.Random(0)
+    visitors = []
+    for number in range(50000):
+        visitor = generate_visitor(rng, 1)
+        visitor["visitors"]["id"] = number
+        visitors.append(visitor)
+
+    with tempfile.TemporaryDirectory() as directory:
+        export = os.path.join(directory, "visitors.jsonl")
+        with open(export, "w") as lines:
+            for visitor in visitors:
+                lines.write(json.dumps(visitor) + "\n")
+
+        index = IdentityIndex(os.path.join(directory, "identity.db"))
+        start = time.perf_counter()
+        index.load_jsonl(export)
+        print(f"bulk load: {len(index)} visitors in {time.perf_counter() - start:.2f} s")
+
+        new_visitors = [mutate_visitor(rng, rng.choice(visitors)) for _ in range(200)]
+        found = [check_candidates(index, visitors, v) for v in new_visitors[:20]]
+        print(f"candidates: {sum(found) / len(found):.0f} per new visitor, matching a linear scan")
+
+        start = time.perf_counter()
+        for new_visitor in new_visitors:
+            index.candidates(new_visitor, max_candidates=50)
+        lookup = (time.perf_counter() - start) / len(new_visitors)
+        start = time.perf_counter()
+        for new_visitor in new_visitors[:20]:
+            new_keys = set(identity_keys(new_visitor))
+            [v for v in visitors if new_keys & set(identity_keys(v))]
+        scan = (time.perf_counter() - start) / 20
+        print(
+            f"lookup (50 candidates) {lookup * 1000:.3f} ms, linear scan {scan * 1000:.1f} ms per new visitor"
+        )
+
+        # the lambda's read path: one read-only connection per container, not per request
+        path = os.path.join(directory, "identity.db")
+        reader = IdentityIndex(path, read_only=True)
+        assert all(reader.candidates(v) == index.candidates(v) for v in new_visitors[:20])
+        try:
+            reader.upsert(new_visitors[0])
+            raise AssertionError("a read-only index accepted a write")
+        except sqlite3.OperationalError:
+            pass
+        start = time.perf_counter()
+        for new_visitor in new_visitors:
+            reader.candidates(new_visitor, max_candidates=50)
+        shared = (time.perf_counter() - start) / len(new_visitors)
+        start = time.perf_counter()
+        for new_visitor in new_visitors:
+            per_request = IdentityIndex(path)
+            per_request.candidates(new_visitor, max_candidates=50)
+            per_request.close()
+        opened = (time.perf_counter() - start) / len(new_visitors)
+        reader.close()
+        print(
+            f"lookup, read-only index opened once {shared * 1000:.3f} ms, "
+            f"opened per request {opened * 1000:.3f} ms"
+        )
+
+        start = time.perf_counter()
+        for new_visitor in new_visitors:
+            index.upsert(new_visitor)
+        upsert = (time.perf_counter() - start) / len(new_visitors)
+        print(f"upsert {upsert * 1000:.3f} ms per visitor, {len(index)} visitors stored")
+        index.close()
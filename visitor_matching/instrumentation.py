@@ -0,0 +1,324 @@
+import cProfile
+import heapq
+import io
+import json
+import os
+import pstats
+import threading
+import time
+
+
+class _NullStage:
+    """Context manager that does nothing: what stage() returns while disabled"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_STAGE = _NullStage()
+
+
+class _Stage:
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.instrumentation.add_time(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class _Request:
+    def __init__(self, instrumentation, name, profile):
+        self.instrumentation = instrumentation
+        self.name = name
+        self.profiler = cProfile.Profile() if profile else None
+
+    def __enter__(self):
+        if self.profiler is not None:
+            self.profiler.enable()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        seconds = time.perf_counter() - self.start
+        if self.profiler is not None:
+            self.profiler.disable()
+        self.instrumentation.finish_request(self.name, seconds, self.profiler)
+        return False
+
+
+class Instrumentation:
+    """
+    Opt-in timers and counters for the matching and inference hot paths.
+
+    - stage(name): context manager adding its wall time to the timer of a stage (parse,
+      per-attribute comparison, scoring, model predict)
+    - count(name, value): adds to a counter (candidates scored, IP pairs, early exits)
+    - request(name): wraps a whole request; it is timed as the stage "request.<name>" and,
+      with profile_slowest > 0, run under cProfile so the profiles of the slowest
+      profile_slowest requests are kept (only every 1 / profile_rate-th request is profiled,
+      as cProfile slows them down; a profile_rate of 0 or less profiles none)
+
+    While disabled, stage() and request() return a shared no-op context manager and count()
+    returns immediately, so instrumented code pays one attribute check per call site. Hot
+    loops should still guard with `if INSTRUMENTATION.enabled`.
+
+    Aggregates are per process and cumulative, exported by snapshot(), log_line() (one JSON
+    line, e.g. for CloudWatch) or prometheus() (text exposition format).
+    """
+
+    def __init__(self, enabled=False, profile_slowest=0, profile_rate=1.0, log_every=0):
+        self.enabled = enabled
+        self.profile_slowest = profile_slowest
+        self.profile_rate = profile_rate
+        self.log_every = log_every  # print a log line every log_every requests (0: never)
+        self.lock = threading.Lock()
+        self.profiling = False  # only one cProfile profiler can run at a time
+        self.reset()
+
+    @classmethod
+    def from_environment(cls, environ=os.environ):
+        """
+        INSTRUMENTATION=1 enables it; INSTRUMENTATION_PROFILE_SLOWEST, _PROFILE_RATE and
+        _LOG_EVERY set the options of the same name
+        :raises ValueError: if INSTRUMENTATION_PROFILE_RATE is not a number between 0 and 1
+                            (0 or less turns profiling off)
+        """
+        profile_rate = float(environ.get("INSTRUMENTATION_PROFILE_RATE", 1.0))
+        if not profile_rate <= 1:  # also rejects NaN
+            raise ValueError(f"INSTRUMENTATION_PROFILE_RATE must be at most 1, got {profile_rate}")
+        return cls(
+            enabled=environ.get("INSTRUMENTATION", "0") not in ("", "0", "false"),
+            profile_slowest=int(environ.get("INSTRUMENTATION_PROFILE_SLOWEST", 0)),
+            profile_rate=profile_rate,
+            log_every=int(environ.get("INSTRUMENTATION_LOG_EVERY", 0)),
+        )
+
+    def reset(self):
+        self.timers = {}  # stage -> [calls, total seconds, max seconds]
+        self.counters = {}
+        self.slowest = []  # min-heap of (seconds, sequence number, request name, profiler)
+        self.requests = 0
+
+    def enable(self, profile_slowest=None):
+        self.enabled = True
+        if profile_slowest is not None:
+            self.profile_slowest = profile_slowest
+
+    def disable(self):
+        self.enabled = False
+
+    def stage(self, name):
+        if not self.enabled:
+            return NULL_STAGE
+        return _Stage(self, name)
+
+    def request(self, name):
+        if not self.enabled:
+            return NULL_STAGE
+        with self.lock:
+            profile = (
+                self.profile_slowest > 0
+                and self.profile_rate > 0
+                and not self.profiling
+                and self.requests % max(1, round(1 / self.profile_rate)) == 0
+            )
+            if profile:
+                self.profiling = True
+        return _Request(self, name, profile)
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            timer = self.timers.get(name)
+            if timer is None:
+                self.timers[name] = [1, seconds, seconds]
+            else:
+                timer[0] += 1
+                timer[1] += seconds
+                if seconds > timer[2]:
+                    timer[2] = seconds
+
+    def count(self, name, value=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def finish_request(self, name, seconds, profiler):
+        self.add_time(f"request.{name}", seconds)
+        with self.lock:
+            self.requests += 1
+            if profiler is not None:
+                self.profiling = False
+                entry = (seconds, self.requests, name, profiler)
+                if len(self.slowest) < self.profile_slowest:
+                    heapq.heappush(self.slowest, entry)
+                elif seconds > self.slowest[0][0]:
+                    heapq.heapreplace(self.slowest, entry)
+            emit = self.log_every and self.requests % self.log_every == 0
+        if emit:
+            print(self.log_line())
+
+    def snapshot(self):
+        """
+        :return: Dictionary of timers (calls, total, mean and max milliseconds), counters and
+                 the durations of the profiled slowest requests
+        """
+        with self.lock:
+            timers = {
+                name: {
+                    "calls": calls,
+                    "total_ms": total * 1000,
+                    "mean_ms": total * 1000 / calls,
+                    "max_ms": largest * 1000,
+                }
+                for name, (calls, total, largest) in sorted(self.timers.items())
+            }
+            return {
+                "requests": self.requests,
+                "timers": timers,
+                "counters": dict(sorted(self.counters.items())),
+                "slowest_profiled_ms": [
+                    {"request": name, "ms": seconds * 1000}
+                    for seconds, _, name, _ in sorted(self.slowest, reverse=True)
+                ],
+            }
+
+    def log_line(self):
+        """
+        :return: The snapshot as a single structured JSON log line
+        """
+        return json.dumps({"instrumentation": self.snapshot()}, separators=(",", ":"))
+
+    def prometheus(self, prefix="dodgeball"):
+        """
+        :return: The aggregates in the Prometheus text exposition format
+        """
+        snapshot = self.snapshot()
+        lines = []
+        for metric, kind, field, scale in [
+            ("stage_calls_total", "counter", "calls", 1),
+            ("stage_seconds_total", "counter", "total_ms", 1000),
+            ("stage_seconds_max", "gauge", "max_ms", 1000),
+        ]:
+            lines.append(f"# TYPE {prefix}_{metric} {kind}")
+            for name, timer in snapshot["timers"].items():
+                lines.append(f'{prefix}_{metric}{{stage="{name}"}} {timer[field] / scale:.9g}')
+        lines.append(f"# TYPE {prefix}_events_total counter")
+        for name, value in snapshot["counters"].items():
+            lines.append(f'{prefix}_events_total{{event="{name}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+    def profile_report(self, limit=15, sort="cumulative"):
+        """
+        :return: pstats text of every kept profile, slowest request first
+        """
+        reports = []
+        for seconds, _, name, profiler in sorted(self.slowest, reverse=True):
+            stream = io.StringIO()
+            pstats.Stats(profiler, stream=stream).sort_stats(sort).print_stats(limit)
+            reports.append(f"request {name}: {seconds * 1000:.2f} ms\n{stream.getvalue()}")
+        return "\n".join(reports)
+
+    def dump_profiles(self, directory):
+        """
+        Write the kept profiles as .prof files (readable with pstats or snakeviz)
+        :return: List of written paths, slowest request first
+        """
+        os.makedirs(directory, exist_ok=True)
+        paths = []
+        for rank, (seconds, _, name, profiler) in enumerate(sorted(self.slowest, reverse=True)):
+            path = os.path.join(directory, f"{rank:02d}_{name}_{seconds * 1000:.0f}ms.prof")
+            profiler.dump_stats(path)
+            paths.append(path)
+        return paths
+
+
+# process wide instance used by the matching modules and the handlers
+INSTRUMENTATION = Instrumentation.from_environment()
+
+
+def disabled_overhead(number=1000000):
+    """
+    :return: Cost in nanoseconds of a disabled stage() block and a disabled count() call
+    """
+    import timeit
+
+    instrumentation = Instrumentation()
+
+    def block():
+        with instrumentation.stage("stage"):
+            pass
+
+    empty = timeit.timeit("pass", number=number)
+    return (
+        (timeit.timeit(block, number=number) - empty) / number * 1e9,
+        (timeit.timeit(lambda: instrumentation.count("counter"), number=number) - empty)
+        / number
+        * 1e9,
+    )
+
+
+if __name__ == "__main__":
+    # python instrumentation.py: instrument synthetic matching requests and show the exports
+    import timeit
+
+    import lambda_function
+    from instrumentation import INSTRUMENTATION as instrumentation  # the instance handlers use
+    import visitor_attribute_lambda_function
+    from synthetic import generate_fingerprint_event, generate_visitor_event
+
+    events = [
+        (lambda_function.lambda_handler, generate_fingerprint_event(200, seed=seed))
+        for seed in range(20)
+    ] + [
+        (visitor_attribute_lambda_function.lambda_handler, generate_visitor_event(50, 4, seed=seed))
+        for seed in range(20)
+    ]
+
+    def run_all():
+        for handler, event in events:
+            handler(event, None)
+
+    # a profile rate of 0 turns profiling off; rates above 1 (or NaN) are rejected
+    environ = {"INSTRUMENTATION": "1", "INSTRUMENTATION_PROFILE_SLOWEST": "3"}
+    never = Instrumentation.from_environment(dict(environ, INSTRUMENTATION_PROFILE_RATE="0"))
+    for _ in range(5):
+        with never.request("check"):
+            pass
+    assert never.requests == 5 and not never.slowest
+    for rate in ["2", "nan"]:
+        try:
+            Instrumentation.from_environment(dict(environ, INSTRUMENTATION_PROFILE_RATE=rate))
+            raise AssertionError(f"accepted INSTRUMENTATION_PROFILE_RATE={rate}")
+        except ValueError:
+            pass
+
+    disabled_seconds = min(timeit.repeat(run_all, number=1, repeat=5))
+    instrumentation.enable(profile_slowest=1)
+    run_all()
+    print(instrumentation.profile_report(limit=8))
+    instrumentation.profile_slowest = 0  # profiling slows requests down, time them without
+    instrumentation.reset()
+    enabled_seconds = min(timeit.repeat(run_all, number=1, repeat=5))
+    snapshot = instrumentation.snapshot()
+    stage_calls = sum(timer["calls"] for timer in snapshot["timers"].values()) / 5  # per run
+    count_calls = 3 * len(events)  # at most 3 count() calls per request
+
+    print(instrumentation.prometheus())
+    stage_ns, count_ns = disabled_overhead()
+    estimate = (stage_calls * stage_ns + count_calls * count_ns) / 1e9
+    print(
+        f"{len(events)} requests: {disabled_seconds * 1000:.1f} ms disabled, "
+        f"{enabled_seconds * 1000:.1f} ms enabled; disabled instrumentation is "
+        f"{stage_calls / len(events):.0f} stage() blocks of {stage_ns:.0f} ns per request, "
+        f"about {estimate / disabled_seconds:.2%} of the request time"
+    )
@@ -1,12 +1,89 @@
+import os
+from collections import OrderedDict
+
+from fingerprint_batch import FingerprintBatchCompare
 from fingerprint_compare import FingerprintCompare
+from instrumentation import INSTRUMENTATION
+from score_cache import PAIR_CACHE
 
+_stores = {}  # FingerprintStore per path, kept across warm invocations
+_indexes = OrderedDict()  # (path, account) -> (history key, FingerprintIndex), least recent first
+MAX_CANDIDATES = int(os.environ.get("FINGERPRINT_MAX_CANDIDATES", 50))  # 0: score every fingerprint
+INDEX_CACHE_SIZE = int(os.environ.get("FINGERPRINT_INDEX_CACHE_SIZE", 256))
 
-def lambda_handler(event, context):
+
+def match_body(similarity, results):
+    return {"match_results": results, "match_score": 100 * round(similarity, 4)}
+
+
+def fingerprint_store():
+    """
+    No history shipped with the event: the account's previous fingerprints are mapped from
+    the store at FINGERPRINT_STORE_PATH
+    """
+    from fingerprint_store import FingerprintStore
+
+    path = os.environ["FINGERPRINT_STORE_PATH"]
+    if path not in _stores:
+        _stores[path] = FingerprintStore(path)
+    store = _stores[path]
+    store.refresh()
+    return store
+
+
+def fingerprint_index(store, account_id):
+    """
+    FingerprintIndex of an account's stored history, cached per account across warm
+    invocations and rebuilt once the history changed (an append or a compaction)
+    """
+    from fingerprint_index import FingerprintIndex
+
+    key = (store.path, account_id)
+    history_key = store.history_key(account_id)
+    cached = _indexes.pop(key, None)
+    if cached is None or cached[0] != history_key:
+        cached = (history_key, FingerprintIndex.from_account(store, account_id))
+    _indexes[key] = cached
+    while len(_indexes) > INDEX_CACHE_SIZE:
+        _indexes.popitem(last=False)
+    return cached[1]
+
+
+def history_comparer(event, new_fingerprint=None):
+    """
+    A single fingerprint against a JSON history is scored by the scalar FingerprintCompare:
+    encoding the history into columns for one comparison costs as much as it saves. Batch
+    events and store-backed histories are scored by FingerprintBatchCompare; a single
+    fingerprint against a stored history longer than MAX_CANDIDATES only against the shortlist
+    of the account's cached FingerprintIndex
+    """
     weights = event.get("weights") or None
-    comparer = FingerprintCompare(event["previous_fingerprints"], event["new_fingerprint"], weights)
+    if "previous_fingerprints" in event:
+        engine = FingerprintCompare if new_fingerprint is not None else FingerprintBatchCompare
+        return engine(event["previous_fingerprints"], new_fingerprint, weights, cache=PAIR_CACHE)
+    store, account_id = fingerprint_store(), event["account_id"]
+    if new_fingerprint is None or store.count(account_id) <= MAX_CANDIDATES or not MAX_CANDIDATES:
+        return FingerprintBatchCompare.from_account(store, account_id, new_fingerprint, weights)
+    index = fingerprint_index(store, account_id)
+    return index.comparer(new_fingerprint, weights, MAX_CANDIDATES)
+
+
+def lambda_handler(event, context):
+    with INSTRUMENTATION.request("fingerprint_match"):
+        return match_event(event)
+
+
+def match_event(event):
+    if "new_fingerprints" in event:
+        # batch mode: every new fingerprint against the same previous fingerprints
+        comparer = history_comparer(event)
+        matches = comparer.identify_top_fingerprint_matches(event["new_fingerprints"])
+        return {"statusCode": 200, "body": {"results": [match_body(*match) for match in matches]}}
+
+    comparer = history_comparer(event, event["new_fingerprint"])
     similarity, results = comparer.identify_top_fingerprint_match()
 
     return {
         "statusCode": 200,
-        "body": {"match_results": results, "match_score": 100 * round(similarity, 4)},
+        "body": match_body(similarity, results),
     }
@@ -0,0 +1,338 @@
+import hashlib
+import json
+import marshal
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from instrumentation import INSTRUMENTATION
+
+KEY_BYTES = 200  # approximate size of a key: a tuple of a kind and three 16 byte digests
+
+
+def content_hash(value):
+    """
+    Hash of the content of a record (a fingerprint, a visitor or a weights dictionary).
+    Records are serialized with marshal, several times faster than JSON; two records with the
+    same content but a different key order hash differently, which only costs a cache miss
+    :return: 16 byte digest (b"" for None)
+    """
+    if value is None:
+        return b""
+    try:
+        serialized = marshal.dumps(value, 2)
+    except ValueError:  # a type marshal does not handle, e.g. numpy scalars
+        serialized = json.dumps(value, sort_keys=True, default=str).encode("utf-8")
+    return hashlib.blake2b(serialized, digest_size=16).digest()
+
+
+def approximate_size(value):
+    """
+    :return: Approximate memory in bytes of a cached value: the value and, for tuples, lists
+             and dictionaries, their items (one level deep)
+    """
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(sys.getsizeof(item) for item in value.values())
+    elif isinstance(value, (tuple, list)):
+        size += sum(sys.getsizeof(item) for item in value)
+    return size
+
+
+class PairCache:
+    """
+    Bounded cache of pairwise match results across requests: the same previous records
+    are compared against a new record on every request of an active account, and a retried
+    or duplicated event repeats every pair.
+
+    Keys are (kind, content_hash(previous), content_hash(new), content_hash(weights)), so a
+    changed record or weight is a different key and entries never need invalidating. Values
+    must not depend on the clock: callers cache only the clock-independent parts of a score
+    (see VisitorAttributeCompare.pair_components). Entries expire ttl seconds after they are
+    written, and the least recently used ones are evicted beyond max_entries or max_bytes
+    (approximate_size of keys and values).
+
+    hits, misses, evictions (for size) and expirations are counted here and, when
+    instrumentation is enabled, as the pair_cache.* counters.
+
+    Every request hashes its whole history, which costs about 7 us per record, and a request
+    only hits if the same (previous, new) pairs were scored before: a new record misses on
+    every pair. The cache only pays off on traffic where a large share of requests repeat
+    earlier ones (retried or duplicated events); on one core its break-even is between a
+    30% and a 60% hit rate, and without repeats it adds up to about 40% per request (see
+    benchmark_traffic). Check the hit rate in stats() before leaving it on.
+    """
+
+    def __init__(self, max_entries=100000, max_bytes=64 << 20, ttl=3600, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.clock = clock
+        self.lock = threading.Lock()  # the scoring service scores on a thread pool
+        self.clear()
+
+    @classmethod
+    def from_environment(cls, environ=os.environ):
+        """
+        PAIR_CACHE=1 enables it; PAIR_CACHE_MAX_ENTRIES, PAIR_CACHE_MAX_BYTES and
+        PAIR_CACHE_TTL set the options of the same name
+        :return: PairCache, or None if disabled
+        """
+        if environ.get("PAIR_CACHE", "0") in ("", "0", "false"):
+            return None
+        return cls(
+            max_entries=int(environ.get("PAIR_CACHE_MAX_ENTRIES", 100000)),
+            max_bytes=int(environ.get("PAIR_CACHE_MAX_BYTES", 64 << 20)),
+            ttl=float(environ.get("PAIR_CACHE_TTL", 3600)),
+        )
+
+    def clear(self):
+        self.entries = OrderedDict()  # key -> (expiry time, size, value), oldest first
+        self.bytes = 0
+        self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """:return: Cached value, or None on a miss"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] < self.clock():
+                self.remove(key)
+                self.expirations += 1
+                INSTRUMENTATION.count("pair_cache.expirations")
+                entry = None
+            if entry is None:
+                self.misses += 1
+                INSTRUMENTATION.count("pair_cache.misses")
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            INSTRUMENTATION.count("pair_cache.hits")
+            return entry[2]
+
+    def get_many(self, keys):
+        """
+        get for every key of a request under one lock and one clock reading
+        :return: List of cached values, None for the misses
+        """
+        values = []
+        with self.lock:
+            now = self.clock()
+            expired = 0
+            for key in keys:
+                entry = self.entries.get(key)
+                if entry is not None and entry[0] < now:
+                    self.remove(key)
+                    expired += 1
+                    entry = None
+                if entry is None:
+                    values.append(None)
+                else:
+                    self.entries.move_to_end(key)
+                    values.append(entry[2])
+            misses = values.count(None)
+            self.hits += len(values) - misses
+            self.misses += misses
+            self.expirations += expired
+        INSTRUMENTATION.count("pair_cache.hits", len(values) - misses)
+        INSTRUMENTATION.count("pair_cache.misses", misses)
+        if expired:
+            INSTRUMENTATION.count("pair_cache.expirations", expired)
+        return values
+
+    def put(self, key, value):
+        self.put_many([(key, value)])
+
+    def put_many(self, items):
+        """
+        put every (key, value) of a request under one lock and one clock reading
+        """
+        items = [(key, value, KEY_BYTES + approximate_size(value)) for key, value in items]
+        with self.lock:
+            expiry = self.clock() + self.ttl
+            evicted = 0
+            for key, value, size in items:
+                if key in self.entries:
+                    self.remove(key)
+                self.entries[key] = (expiry, size, value)
+                self.bytes += size
+            while self.entries and (
+                len(self.entries) > self.max_entries or self.bytes > self.max_bytes
+            ):
+                self.remove(next(iter(self.entries)))
+                evicted += 1
+            self.evictions += evicted
+        if evicted:
+            INSTRUMENTATION.count("pair_cache.evictions", evicted)
+
+    def remove(self, key):
+        _, size, _ = self.entries.pop(key)
+        self.bytes -= size
+
+    def stats(self):
+        """:return: Dictionary of counters, entries and approximate bytes"""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "entries": len(self.entries),
+                "bytes": self.bytes,
+            }
+
+
+# process wide cache used by the lambdas, off unless PAIR_CACHE=1
+PAIR_CACHE = PairCache.from_environment()
+
+
+def check_cache(seed=0):
+    """
+    Cached matching returns exactly what uncached matching returns: for fingerprints (scalar
+    and batch engines) and visitors, on repeated and partly new requests, and for visitors
+    at a later reference clock than the one the pairs were cached at. Then checks the
+    eviction and expiry bounds
+    :return: Stats of the matching cache
+    """
+    import random
+
+    from fingerprint_batch import FingerprintBatchCompare
+    from fingerprint_compare import FingerprintCompare
+    from synthetic import generate_fingerprint_event, generate_visitor_event
+    from visitor_attribute_compare import VisitorAttributeCompare
+
+    cache = PairCache()
+    for number in range(10):
+        event = generate_fingerprint_event(50, seed=seed + number)
+        weights = (
+            {key: 1 + len(key) % 3 for key in event["new_fingerprint"]} if number % 2 else None
+        )
+        history = event["previous_fingerprints"]
+        for new_fp in [event["new_fingerprint"], event["new_fingerprint"], history[number]]:
+            for engine in [FingerprintCompare, FingerprintBatchCompare]:
+                expected = engine(history, new_fp, weights).identify_top_fingerprint_match()
+                actual = engine(history, new_fp, weights, cache=cache)
+                assert actual.identify_top_fingerprint_match() == expected
+        new_fps = [event["new_fingerprint"], history[0]]
+        batch = FingerprintBatchCompare(history, weights=weights, cache=cache)
+        expected = FingerprintBatchCompare(history, weights=weights)
+        assert batch.identify_top_fingerprint_matches(new_fps) == (
+            expected.identify_top_fingerprint_matches(new_fps)
+        )
+
+    day = 86400 * 1000000
+    rng = random.Random(seed)
+    for number in range(30):
+        event = generate_visitor_event(1 + number % 8, 1 + number % 3, seed=seed + number)
+        weights = event["weights"] if number % 3 else dict(event["weights"], telemetry={})
+        history = event["previous_visitors"]
+        now = 1640995200 * 1000000 + rng.randint(0, 365) * day
+        for new_v in [event["new_visitor"], event["new_visitor"], history[0]]:
+            for later in [0, 30 * day]:  # the cached visitor age proximity must not go stale
+                uncached = VisitorAttributeCompare(history, new_v, weights)
+                previous, new = uncached.records()
+                expected = uncached.score_visitor(previous, new, now + later)
+                cached = VisitorAttributeCompare(history, weights=weights, cache=cache)
+                assert cached.cached_score(new_v, now + later) == expected, number
+
+    stats = cache.stats()
+    assert stats["hits"] and stats["misses"] and not stats["evictions"]
+
+    clock = [0.0]
+    bounded = PairCache(max_entries=3, max_bytes=10 * KEY_BYTES, ttl=10, clock=lambda: clock[0])
+    for number in range(5):
+        bounded.put(number, "value")
+    assert list(bounded.entries) == [2, 3, 4] and bounded.evictions == 2
+    bounded.get(2)  # 2 is now the most recently used, so 3 goes next
+    bounded.put(5, "value")
+    assert list(bounded.entries) == [4, 2, 5]
+    bounded.put(6, "x" * 20 * KEY_BYTES)  # over max_bytes on its own: nothing is kept
+    assert len(bounded) == 0 and bounded.bytes == 0
+    bounded.put(7, "value")
+    clock[0] = 11
+    assert bounded.get(7) is None and bounded.expirations == 1
+    return stats
+
+
+def benchmark_traffic(num_previous=200, num_requests=200, retry_rate=0.3, seed=0):
+    """
+    Requests of one active account: its history grows by one record per request and the
+    new record is scored against it; a retry_rate share of the requests are retries of the
+    previous request
+    :return: Dictionary of mean milliseconds per request with and without a cache, per
+             engine, and the cache stats
+    """
+    import random
+    import timeit
+
+    from fingerprint_batch import FingerprintBatchCompare
+    from fingerprint_compare import FingerprintCompare
+    from synthetic import generate_fingerprint_history, generate_visitor, mutate_visitor
+    from synthetic import VISITOR_WEIGHTS
+    from visitor_attribute_compare import VisitorAttributeCompare
+
+    rng = random.Random(seed)
+    fingerprints = generate_fingerprint_history(num_previous + num_requests, seed=seed)
+    people = [generate_visitor(rng, 3) for _ in range(20)]
+    visitors = [
+        mutate_visitor(rng, rng.choice(people), 3) for _ in range(num_previous + num_requests)
+    ]
+
+    def requests(records):
+        position = num_previous
+        for _ in range(num_requests):
+            if rng.random() >= retry_rate:
+                position += 1
+            yield records[: position - 1], records[position - 1]
+
+    def run(score, records):
+        rng.seed(seed)
+        for previous, new in requests(records):
+            score(previous, new)
+
+    engines = {
+        "fingerprint scalar": (FingerprintCompare, "identify_top_fingerprint_match", fingerprints),
+        "fingerprint batch": (
+            FingerprintBatchCompare,
+            "identify_top_fingerprint_match",
+            fingerprints,
+        ),
+        "visitor": (VisitorAttributeCompare, "estimate_visitor_match", visitors),
+    }
+    report = {}
+    for name, (engine, method, records) in engines.items():
+        weights = VISITOR_WEIGHTS if engine is VisitorAttributeCompare else None
+        cache = PairCache()
+        times = {}
+        for label, request_cache in [("uncached", None), ("cached", cache)]:
+            seconds = timeit.timeit(
+                lambda: run(
+                    lambda previous, new: getattr(
+                        engine(previous, new, weights, cache=request_cache), method
+                    )(),
+                    records,
+                ),
+                number=1,
+            )
+            times[f"{label}_ms"] = seconds / num_requests * 1000
+        report[name] = dict(times, **cache.stats())
+    return report
+
+
+if __name__ == "__main__":
+    print(f"check_cache: cached matching identical to uncached, {check_cache()}")
+    for retry_rate in [0.0, 0.3, 0.6, 0.9]:
+        print(f"{retry_rate:.0%} retries:")
+        for name, result in benchmark_traffic(retry_rate=retry_rate).items():
+            print(
+                f"{name:>20}: uncached {result['uncached_ms']:.2f} ms, "
+                f"cached {result['cached_ms']:.2f} ms per request, hit rate "
+                f"{result['hit_rate']:.1%}, {result['entries']} entries, "
+                f"{result['bytes'] / 1e6:.1f} MB"
+            )
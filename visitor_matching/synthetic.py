@@ -0,0 +1,582 @@
+import random
+
+FONTS = [
+    "Agency FB",
+    "Algerian",
+    "Arial",
+    "Arial Black",
+    "Arial Narrow",
+    "Arial Rounded MT Bold",
+    "Bahnschrift",
+    "Baskerville Old Face",
+    "Bauhaus 93",
+    "Bell MT",
+    "Berlin Sans FB",
+    "Bernard MT Condensed",
+    "Blackadder ITC",
+    "Bodoni MT",
+    "Book Antiqua",
+    "Bookman Old Style",
+    "Bradley Hand ITC",
+    "Britannic Bold",
+    "Broadway",
+    "Brush Script MT",
+    "Calibri",
+    "Californian FB",
+    "Calisto MT",
+    "Cambria",
+    "Cambria Math",
+    "Candara",
+    "Castellar",
+    "Centaur",
+    "Century",
+    "Century Gothic",
+    "Century Schoolbook",
+    "Chalkduster",
+    "Chiller",
+    "Colonna MT",
+    "Comic Sans MS",
+    "Consolas",
+    "Constantia",
+    "Cooper Black",
+    "Copperplate Gothic Bold",
+    "Corbel",
+    "Courier",
+    "Courier New",
+    "Curlz MT",
+    "Ebrima",
+    "Edwardian Script ITC",
+    "Elephant",
+    "Engravers MT",
+    "Eras Bold ITC",
+    "Felix Titling",
+    "Footlight MT Light",
+    "Forte",
+    "Franklin Gothic Book",
+    "Freestyle Script",
+    "French Script MT",
+    "Gabriola",
+    "Gadugi",
+    "Garamond",
+    "Georgia",
+    "Gigi",
+    "Gill Sans MT",
+    "Gloucester MT Extra Condensed",
+    "Goudy Old Style",
+    "Goudy Stout",
+    "GungSeo",
+    "Haettenschweiler",
+    "Harlow Solid Italic",
+    "Harrington",
+    "Helvetica",
+    "Helvetica Neue",
+    "High Tower Text",
+    "Hiragino Sans GB",
+    "Impact",
+    "Imprint MT Shadow",
+    "Informal Roman",
+    "Jokerman",
+    "Juice ITC",
+    "Kristen ITC",
+    "Kunstler Script",
+    "Leelawadee UI",
+    "Lucida Bright",
+    "Lucida Calligraphy",
+    "Lucida Console",
+    "Lucida Fax",
+    "Lucida Handwriting",
+    "Lucida Sans",
+    "Lucida Sans Typewriter",
+    "Lucida Sans Unicode",
+    "Magneto",
+    "Maiandra GD",
+    "Malgun Gothic",
+    "Matura MT Script Capitals",
+    "Menlo",
+    "Microsoft Himalaya",
+    "Microsoft JhengHei",
+    "Microsoft New Tai Lue",
+    "Microsoft PhagsPa",
+    "Microsoft Sans Serif",
+    "Microsoft Tai Le",
+    "Microsoft YaHei",
+    "Microsoft Yi Baiti",
+    "MingLiU-ExtB",
+    "Mistral",
+    "Modern No. 20",
+    "Mongolian Baiti",
+    "Monotype Corsiva",
+    "MS Gothic",
+    "MS Outlook",
+    "MS Reference Sans Serif",
+    "MS Reference Specialty",
+    "MT Extra",
+    "MV Boli",
+    "Myanmar Text",
+    "Niagara Engraved",
+    "Niagara Solid",
+    "Nirmala UI",
+    "OCR A Extended",
+    "Old English Text MT",
+    "Onyx",
+    "Palace Script MT",
+    "Palatino Linotype",
+    "Papyrus",
+    "Parchment",
+    "Perpetua",
+    "Plantagenet Cherokee",
+    "Playbill",
+    "Poor Richard",
+    "Pristina",
+    "Rage Italic",
+    "Ravie",
+    "Rockwell",
+    "Script MT Bold",
+    "Segoe MDL2 Assets",
+    "Segoe Print",
+    "Segoe Script",
+    "Segoe UI",
+    "Segoe UI Emoji",
+    "Segoe UI Historic",
+    "Segoe UI Symbol",
+    "Showcard Gothic",
+    "SimSun",
+    "Snap ITC",
+    "Stencil",
+    "Sylfaen",
+    "Symbol",
+    "Tahoma",
+    "Tempus Sans ITC",
+    "Times New Roman",
+    "Trebuchet MS",
+    "Tw Cen MT",
+    "Verdana",
+    "Viner Hand ITC",
+    "Vivaldi",
+    "Vladimir Script",
+    "Webdings",
+    "Wide Latin",
+    "Wingdings",
+    "Wingdings 2",
+    "Wingdings 3",
+    "Yu Gothic",
+]
+PLUGINS = [
+    "Chrome PDF Plugin",
+    "Chrome PDF Viewer",
+    "Native Client1",
+    "Native Client2",
+    "Microsoft Edge PDF Viewer",
+    "WebKit built-in PDF",
+    "Shockwave Flash",
+    "Java Applet Plug-in",
+    "Silverlight Plug-In",
+    "QuickTime Plug-in",
+    "Widevine Content Decryption Module",
+]
+MIME_TYPES = [
+    "Portable Document Format",
+    "Native Client Executable",
+    "Portable Native Client Executable",
+    "Shockwave Flash",
+    "FutureSplash Player",
+    "Java Applet",
+    "Silverlight",
+    "QuickTime Movie",
+    "Widevine Content Decryption Module",
+]
+BROWSERS = [
+    ("Chrome", "Blink", "isChrome"),
+    ("Firefox", "Gecko", "isFirefox"),
+    ("Safari", "WebKit", "isSafari"),
+    ("Opera", "Blink", "isOpera"),
+    ("IE", "Trident", "isIE"),
+]
+OPERATING_SYSTEMS = [
+    ("Mac OS", "isMac", "10.15.6"),
+    ("Windows", "isWindows", "10.0.19042"),
+    ("Linux", "isLinux", "5.4.0"),
+    ("Ubuntu", "isUbuntu", "20.04"),
+    ("iOS", "isMobileIOS", "14.4.2"),
+    ("Android", "isMobileAndroid", "11.0.0"),
+]
+RESOLUTIONS = [
+    "1792x1120",
+    "1920x1080",
+    "1440x900",
+    "2560x1440",
+    "1366x768",
+    "828x1792",
+    "1080x2340",
+]
+TIME_ZONES = [
+    "-10",
+    "-08",
+    "-07",
+    "-06",
+    "-05",
+    "-04",
+    "-03",
+    "+00",
+    "+01",
+    "+02",
+    "+03",
+    "+05",
+    "+08",
+    "+09",
+]
+LANGUAGES = [
+    "en-US",
+    "en-GB",
+    "es-ES",
+    "es-MX",
+    "fr-FR",
+    "de-DE",
+    "pt-BR",
+    "ja-JP",
+    "zh-CN",
+    "ko-KR",
+]
+FLAGS = [
+    "isIE",
+    "isChrome",
+    "isFirefox",
+    "isSafari",
+    "isOpera",
+    "isWindows",
+    "isMac",
+    "isLinux",
+    "isUbuntu",
+    "isSolaris",
+    "IsMobile",
+    "isMobileMajor",
+    "isMobileAndroid",
+    "isMobileOpera",
+    "isMobileWindows",
+    "isMobileBlackBerry",
+    "isMobileIOS",
+    "isIphone",
+    "isIpad",
+    "isIpod",
+    "isJava",
+    "isFlash",
+    "isSilverlight",
+    "isMimeTypes",
+    "isLocalStorage",
+    "isSessionStorage",
+    "isCookie",
+    "isCanvas",
+]
+
+
+def _version(rng, parts):
+    """Generate a random dotted version string with the given number of components"""
+    return ".".join(str(rng.randint(0, 120 if i == 0 else 4500)) for i in range(parts))
+
+
+def generate_fingerprint(rng, num_fonts=None):
+    """
+    Generate a random browser fingerprint with the fields FingerprintCompare reads
+    :param rng: random.Random instance used for every draw, so output is reproducible
+    :param num_fonts: number of fonts to include (random between 10 and 60 if not given)
+    :return: Fingerprint dictionary
+    """
+    browser, engine, browser_flag = rng.choice(BROWSERS)
+    os_name, os_flag, os_version = rng.choice(OPERATING_SYSTEMS)
+    browser_version = _version(rng, 4)
+    fingerprint = {flag: 0 for flag in FLAGS}
+    fingerprint.update(
+        {
+            "browser": browser,
+            "browserVersion": browser_version,
+            "browserMajorVersion": int(browser_version.split(".")[0]),
+            "engine": engine,
+            "engineVersion": browser_version,
+            "os": os_name,
+            "osVersion": os_version,
+            "colorDepth": rng.choice([24, 30, 32]),
+            "currentResolution": rng.choice(RESOLUTIONS),
+            "plugins": ", ".join(rng.sample(PLUGINS, rng.randint(1, 5))),
+            "mimeTypes": ", ".join(rng.sample(MIME_TYPES, rng.randint(1, 4))),
+            "fonts": ", ".join(rng.sample(FONTS, num_fonts or rng.randint(10, 60))),
+            "timeZone": rng.choice(TIME_ZONES),
+            "language": rng.choice(LANGUAGES),
+            "systemLanguage": rng.choice(LANGUAGES),
+        }
+    )
+    fingerprint["availableResolution"] = fingerprint["currentResolution"]
+    fingerprint[browser_flag] = 1
+    fingerprint[os_flag] = 1
+    if os_flag in ("isMobileIOS", "isMobileAndroid"):
+        fingerprint["IsMobile"] = fingerprint["isMobileMajor"] = 1
+    for flag in ["isJava", "isFlash", "isSilverlight"]:
+        fingerprint[flag] = int(rng.random() < 0.1)
+    for flag in ["isMimeTypes", "isLocalStorage", "isSessionStorage", "isCookie", "isCanvas"]:
+        fingerprint[flag] = int(rng.random() < 0.95)
+    return fingerprint
+
+
+def _mutate_list(rng, value, pool, rate):
+    """Drop and add a few entries of a comma separated list"""
+    if not value:
+        return value
+    items = [item for item in value.split(", ") if rng.random() >= rate]
+    extra = [item for item in pool if item not in items and rng.random() < rate / 4]
+    return ", ".join(items + extra)
+
+
+def mutate_fingerprint(rng, fingerprint, rate=0.1):
+    """
+    Simulate a later fingerprint from the same device: versions move forward, a few fonts,
+    plugins and mime types come and go, and occasionally a setting is missing
+    :return: New fingerprint dictionary (the input is not modified)
+    """
+    mutated = dict(fingerprint)
+    if rng.random() < rate * 3:
+        major, *rest = mutated["browserVersion"].split(".")
+        mutated["browserVersion"] = ".".join([str(int(major) + 1)] + rest)
+        mutated["browserMajorVersion"] = int(major) + 1
+        mutated["engineVersion"] = mutated["browserVersion"]
+    mutated["fonts"] = _mutate_list(rng, mutated["fonts"], FONTS, rate)
+    mutated["plugins"] = _mutate_list(rng, mutated["plugins"], PLUGINS, rate)
+    mutated["mimeTypes"] = _mutate_list(rng, mutated["mimeTypes"], MIME_TYPES, rate)
+    if rng.random() < rate:
+        mutated["currentResolution"] = rng.choice(RESOLUTIONS)
+    if rng.random() < rate:
+        mutated["timeZone"] = rng.choice(TIME_ZONES)
+    for key in ["language", "systemLanguage", "osVersion", "plugins"]:
+        if rng.random() < rate / 5:
+            mutated[key] = None
+    return mutated
+
+
+def generate_fingerprint_history(num_fingerprints, seed=0, num_devices=None, num_fonts=None):
+    """
+    Generate the previous fingerprints of an account: a handful of devices, each seen
+    several times with small changes between sightings
+    :return: List of fingerprint dictionaries
+    """
+    rng = random.Random(seed)
+    devices = [
+        generate_fingerprint(rng, num_fonts)
+        for _ in range(num_devices or max(1, num_fingerprints // 20))
+    ]
+    return [mutate_fingerprint(rng, rng.choice(devices)) for _ in range(num_fingerprints)]
+
+
+def generate_fingerprint_event(num_fingerprints, seed=0, num_fonts=None, weights=None):
+    """
+    Generate a fingerprint lambda event: an account history plus a new fingerprint that
+    is a later sighting of one of its devices
+    :return: Event dictionary in the shape lambda_function.lambda_handler expects
+    """
+    previous_fingerprints = generate_fingerprint_history(
+        num_fingerprints, seed=seed, num_fonts=num_fonts
+    )
+    rng = random.Random(seed + 1)
+    event = {
+        "previous_fingerprints": previous_fingerprints,
+        "new_fingerprint": mutate_fingerprint(rng, rng.choice(previous_fingerprints)),
+    }
+    if weights is not None:
+        event["weights"] = weights
+    return event
+
+
+CITIES = [
+    ("Oakland", "CA", "US", 37.804363, -122.271111),
+    ("Washington", "DC", "US", 38.907192, -77.036873),
+    ("New York", "NY", "US", 40.712776, -74.005974),
+    ("Chicago", "IL", "US", 41.878113, -87.629799),
+    ("London", "ENG", "GB", 51.507351, -0.127758),
+    ("Paris", "IDF", "FR", 48.856613, 2.352222),
+    ("Tokyo", "TK", "JP", 35.689487, 139.691711),
+    ("Sydney", "NSW", "AU", -33.868820, 151.209290),
+    ("Sao Paulo", "SP", "BR", -23.550520, -46.633308),
+]
+FIRST_NAMES = ["Chester", "Ada", "Grace", "Alan", "Barbara", "Linus", "Margaret", "Ken", "Radia"]
+LAST_NAMES = ["Tester", "Lovelace", "Hopper", "Turing", "Liskov", "Torvalds", "Hamilton", "Perlman"]
+STREETS = ["21st St", "Broadway", "Main St", "Telegraph Ave", "Market St", "Oak St", "High St"]
+CARD_BRANDS = ["Visa", "Mastercard", "American Express", "Discover"]
+VISITOR_WEIGHTS = {
+    "telemetry": {
+        "ip_match": 15,
+        "geographic_proximity": 5,
+        "creation_time_proximity": 2.5,
+        "visitor_age_proximity": 2.5,
+    },
+    "payment_methods": 50,
+    "visitor_addresses": {
+        "Line1": 10,
+        "Line2": 10,
+        "City": 5,
+        "Postal_code": 5,
+        "State": 10,
+        "Country": 10,
+    },
+    "visitor_users": {"email": 25, "Phone": 15, "First_name": 10, "Last_name": 10, "username": 10},
+}
+EPOCH_START = 1609459200  # 2021-01-01 00:00:00 UTC
+
+
+def _timestamp(seconds):
+    """Format epoch seconds the way the visitor store does (%Y-%m-%d %H:%M:%S.%f, UTC)"""
+    from datetime import datetime, timezone
+
+    return datetime.fromtimestamp(seconds, timezone.utc).strftime("%Y-%m-%d %H:%M:%S.%f")
+
+
+def generate_visitor(rng, num_ips=2):
+    """
+    Generate a random visitor with the fields VisitorAttributeCompare reads
+    :param rng: random.Random instance used for every draw, so output is reproducible
+    :param num_ips: number of IP observations of the visitor
+    :return: Visitor dictionary
+    """
+    city, state, country, latitude, longitude = rng.choice(CITIES)
+    first_name, last_name = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+    created_at = EPOCH_START + rng.uniform(0, 180 * 86400)
+    username = f"{first_name.lower()}{rng.randint(1, 9999)}"
+    ips = []
+    for _ in range(num_ips):
+        # mostly seen from home, sometimes from another city
+        _, _, _, ip_latitude, ip_longitude = (
+            rng.choice(CITIES)
+            if rng.random() < 0.1
+            else (city, state, country, latitude, longitude)
+        )
+        ips.append(
+            {
+                "ip": f"192.168.{rng.randint(0, 3)}.{rng.randint(1, 20)}",
+                "updated_at": _timestamp(created_at + rng.uniform(0, 90 * 86400)),
+                "props": {
+                    "latitude": ip_latitude + rng.uniform(-0.05, 0.05),
+                    "longitude": ip_longitude + rng.uniform(-0.05, 0.05),
+                },
+            }
+        )
+    return {
+        "ips": ips,
+        "visitors": {"createdAt": _timestamp(created_at)},
+        "payment_methods": {
+            "brand": rng.choice(CARD_BRANDS),
+            "expMonth": rng.randint(1, 12),
+            "expYear": rng.randint(2021, 2028),
+            "last4": rng.randint(1000, 9999),
+            "country": country,
+            "fingerprint": "".join(
+                rng.choice("ABCDEFGHJKLMNPQRSTUVWXYZ0123456789") for _ in range(16)
+            ),
+            "global_unique_fingerprint": int(rng.random() < 0.5),
+        },
+        "visitor_users": {
+            "email": f"{username}@example.com",
+            "username": username,
+            "First_name": first_name,
+            "Last_name": last_name,
+            "Phone": str(rng.randint(2000000000, 9999999999)),
+        },
+        "visitor_addresses": {
+            "Line1": f"{rng.randint(1, 9999)} {rng.choice(STREETS)}",
+            "Line2": f"Apt {rng.randint(1, 999)}" if rng.random() < 0.5 else None,
+            "City": city,
+            "Country": country,
+            "Postal_code": str(rng.randint(10000, 99999)),
+            "State": state,
+        },
+    }
+
+
+def mutate_visitor(rng, visitor, num_ips=2, rate=0.2):
+    """
+    Simulate a later visitor record of the same person: new IP observations near the old
+    ones, and occasionally a changed or missing identity, payment or address field
+    :return: New visitor dictionary (the input is not modified)
+    """
+    mutated = {key: dict(value) for key, value in visitor.items() if key != "ips"}
+    base = rng.choice(visitor["ips"]) if visitor["ips"] else None
+    mutated["ips"] = []
+    for _ in range(num_ips):
+        ip = dict(base or generate_visitor(rng, 1)["ips"][0])
+        ip["props"] = {
+            "latitude": ip["props"]["latitude"] + rng.uniform(-0.1, 0.1),
+            "longitude": ip["props"]["longitude"] + rng.uniform(-0.1, 0.1),
+        }
+        ip["updated_at"] = _timestamp(EPOCH_START + rng.uniform(180 * 86400, 270 * 86400))
+        mutated["ips"].append(ip)
+    mutated["visitors"]["createdAt"] = _timestamp(
+        EPOCH_START + rng.uniform(180 * 86400, 200 * 86400)
+    )
+    if rng.random() < rate:
+        mutated["visitor_users"]["username"] = mutated["visitor_users"]["username"] + "x"
+    if rng.random() < rate:
+        mutated["visitor_users"]["Phone"] = None
+    if rng.random() < rate:
+        mutated["visitor_addresses"]["Line1"] = mutated["visitor_addresses"]["Line1"].replace(
+            "St", "Street"
+        )
+    if rng.random() < rate:
+        mutated["payment_methods"]["fingerprint"] = None
+    return mutated
+
+
+def generate_visitor_event(num_visitors, num_ips=2, seed=0, num_new_ips=None):
+    """
+    Generate a visitor attribute lambda event: previous visitors plus a new visitor that is
+    a later record of one of them
+    :return: Event dictionary in the shape visitor_attribute_lambda_function expects
+    """
+    rng = random.Random(seed)
+    previous_visitors = [generate_visitor(rng, num_ips) for _ in range(num_visitors)]
+    return {
+        "previous_visitors": previous_visitors,
+        "new_visitor": mutate_visitor(
+            rng, rng.choice(previous_visitors), num_new_ips if num_new_ips is not None else num_ips
+        ),
+        "weights": VISITOR_WEIGHTS,
+    }
+
+
+STREET_SUFFIXES = [("St", "Street"), ("Ave", "Avenue"), ("Blvd", "Boulevard"), ("Rd", "Road")]
+STREET_NAMES = ["21st", "Telegraph", "Martin Luther King Jr", "Pennsylvania", "Oak", "Market"]
+
+
+def _typo(rng, value):
+    """Drop, duplicate or swap a random character"""
+    if len(value) < 2:
+        return value
+    position = rng.randrange(len(value) - 1)
+    kind = rng.choice(["drop", "duplicate", "swap"])
+    if kind == "drop":
+        return value[:position] + value[position + 1 :]
+    if kind == "duplicate":
+        return value[:position] + value[position] + value[position:]
+    return value[:position] + value[position + 1] + value[position] + value[position + 2 :]
+
+
+def generate_address_pairs(num_pairs, seed=0):
+    """
+    Generate pairs of address lines as two visitor records of the same person would hold
+    them: abbreviated vs spelled out suffixes, reformatted units, typos and unrelated lines
+    :return: List of (previous line, new line) tuples
+    """
+    rng = random.Random(seed)
+    pairs = []
+    for _ in range(num_pairs):
+        short, long = rng.choice(STREET_SUFFIXES)
+        number, street = rng.randint(1, 29999), rng.choice(STREET_NAMES)
+        line = f"{number} {street} {short}"
+        variant = rng.random()
+        if variant < 0.25:
+            pairs.append((line, f"{number} {street} {long}"))
+        elif variant < 0.5:
+            pairs.append((line, _typo(rng, line)))
+        elif variant < 0.7:
+            unit = rng.randint(1, 999)
+            pairs.append((f"Apt {unit}", rng.choice([f"#{unit}", f"Unit {unit}", f"APT {unit}"])))
+        elif variant < 0.85:
+            pairs.append((line, line))
+        else:
+            other = f"{rng.randint(1, 29999)} {rng.choice(STREET_NAMES)} {rng.choice(STREET_SUFFIXES)[1]}"
+            pairs.append((line, other))
+    return pairs
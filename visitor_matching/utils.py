@@ -1,7 +1,17 @@
+import threading
 from math import radians, cos, sin, asin, sqrt
 from datetime import datetime
 from difflib import ndiff
 
+import numpy as np
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+MISSING_TIME_DIFFERENCE = 999999999999  # returned by the time functions if a value is missing
+EARTH_RADIUS = 6371  # Radius of earth in kilometers is 6371
+EPOCH = datetime(1970, 1, 1)
+WORD_SIZE = 64  # longest pattern for the bit-parallel edit distance
+ENTRY_BYTES = 128  # approximate overhead of a string and its dictionary entry
+
 
 def exact_match(previous_value, new_value):
     """
@@ -26,6 +36,113 @@ def asymmetric_match(previous_value, new_value):
         return False
 
 
+def popcount(bitmap):
+    """
+    Count the set bits of a non-negative integer
+    :return: Number of set bits
+    """
+    return bin(bitmap).count("1")
+
+
+if hasattr(int, "bit_count"):  # python 3.10+, avoids formatting the binary string
+    popcount = int.bit_count
+
+
+class TokenVocabulary:
+    """
+    Process-wide dictionary of the tokens found in comma separated fingerprint fields
+    (fonts, plugins, mimeTypes). Every distinct token gets an integer id, and every distinct
+    field value is stored once as a bitmap (a python int with bit <token id> set for each
+    of its tokens), so warm requests don't split and hash the same strings again.
+
+    Every string is client controlled, so the vocabulary is small and byte bounded: at most
+    max_tokens ids (a bitmap is then at most max_tokens / 8 bytes) and about max_bytes of
+    tokens, values and bitmaps. Ids and bitmaps are only comparable within one vocabulary,
+    so everything is reset together when it is full. A value that cannot fit even in an
+    empty vocabulary is not encoded (match_set compares it as plain sets). The two values of
+    a comparison are encoded under a lock (the scoring service matches on a thread pool),
+    with no reset in between
+    """
+
+    def __init__(self, max_tokens=4096, max_bytes=8 << 20, max_cached_values=100000):
+        self.max_tokens = max_tokens
+        self.max_bytes = max_bytes
+        self.max_cached_values = max_cached_values
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.token_ids = {}  # token -> integer id
+        self.token_sets = {}  # comma separated value -> (bitmap, number of distinct tokens)
+        self.bytes = 0  # approximate bytes of the tokens, values and bitmaps stored
+
+    def fits(self, value):
+        """
+        :return: Whether a value could be encoded in an empty vocabulary
+        """
+        return value.count(",") < self.max_tokens and 2 * len(value) < self.max_bytes
+
+    def token_set(self, value):
+        """
+        Call with the lock held
+        :return: Bitmap of the distinct tokens of a comma separated value and their count,
+                 or None if the vocabulary is too full to encode it
+        """
+        cached = self.token_sets.get(value)
+        if cached is not None:
+            return cached
+        tokens = set(value.split(","))
+        new_tokens = [token for token in tokens if token not in self.token_ids]
+        added = sum(len(token) + ENTRY_BYTES for token in new_tokens) + len(value) + ENTRY_BYTES
+        if (
+            len(self.token_ids) + len(new_tokens) > self.max_tokens
+            or self.bytes + added + self.max_tokens // 8 > self.max_bytes
+        ):
+            return None
+        for token in new_tokens:
+            self.token_ids[token] = len(self.token_ids)
+        bitmap = 0
+        for token in tokens:
+            bitmap |= 1 << self.token_ids[token]
+        cached = (bitmap, len(tokens))
+        self.token_sets[value] = cached
+        self.bytes += added + bitmap.bit_length() // 8
+        return cached
+
+    def token_set_pair(self, previous_value, new_value):
+        """
+        :return: token_set of both values, encoded against the same token ids, or None if
+                 they cannot be encoded together
+        """
+        with self.lock:
+            previous, new = self.token_sets.get(previous_value), self.token_sets.get(new_value)
+            if previous is not None and new is not None:
+                return previous, new
+            if not (self.fits(previous_value) and self.fits(new_value)):
+                return None
+            if len(self.token_sets) >= self.max_cached_values:
+                self.clear()
+            for attempt in range(2):
+                previous = self.token_set(previous_value)
+                new = self.token_set(new_value) if previous is not None else None
+                if new is not None:
+                    return previous, new
+                self.clear()  # full: start over
+            return None
+
+
+TOKEN_VOCABULARY = TokenVocabulary()
+
+
+def bitmap_dice_distance(set1, set2):
+    """
+    Dice distance between two token sets stored as (bitmap, size) pairs
+    :return: Dice distance (https://en.wikipedia.org/wiki/Sørensen–Dice_coefficient)
+    """
+    (bitmap1, size1), (bitmap2, size2) = set1, set2
+    return 1 - ((2 * popcount(bitmap1 & bitmap2)) / (size1 + size2))
+
+
 def match_set(previous_value, new_value, threshold=0.5):
     """
     Given two sets of fields, return True if they have the majority of fields
@@ -33,15 +150,12 @@ def match_set(previous_value, new_value, threshold=0.5):
     :return: Boolean indicating whether or not 50% or more of the fields are in common
     """
     if previous_value and new_value:
-        previous_value, new_value = (
-            set(previous_value.split(",")),
-            set(new_value.split(",")),
-        )
-        if len(previous_value) == 0:
-            return len(new_value) == 0
+        token_sets = TOKEN_VOCABULARY.token_set_pair(previous_value, new_value)
+        if token_sets is None:  # too large for the vocabulary
+            distance = dice_distance(set(previous_value.split(",")), set(new_value.split(",")))
         else:
-            distance = dice_distance(previous_value, new_value)
-            return distance <= threshold
+            distance = bitmap_dice_distance(*token_sets)
+        return distance <= threshold
     else:
         return 0
 
@@ -113,9 +227,46 @@ def haversine_distance(previous_props, new_props):
     return km_distance
 
 
-def edit_distance(previous_value, new_value):
+def haversine_distances(previous_latitude, previous_longitude, new_latitude, new_longitude):
+    """
+    Vectorized haversine_distance: the arguments are arrays of decimal degrees and are
+    broadcast against each other (e.g. a column of previous points and a row of new points
+    gives the distance matrix of every pair)
+    :return: Array of distances in km
     """
-    Calculate the levenshtein (edit) distance between two strings
+    lon1, lat1, lon2, lat2 = map(
+        np.radians, [previous_longitude, previous_latitude, new_longitude, new_latitude]
+    )
+    a = (
+        np.sin((lat2 - lat1) / 2) ** 2
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    )
+    return EARTH_RADIUS * 2 * np.arcsin(np.sqrt(a))
+
+
+def edit_distance(previous_value, new_value, max_distance=None):
+    """
+    Calculate the levenshtein (edit) distance between two strings (see levenshtein).
+    Compatibility note: before levenshtein, this walked difflib.ndiff output and charged
+    max(insertions, deletions) for every run of changes (ndiff_edit_distance). That is a valid
+    edit script but not always the shortest one: ndiff aligns on the longest matching blocks
+    and treats spaces as junk, so on strings with repeated characters, moved words or changed
+    spacing it can overcount. The distance here is never larger than the ndiff one, so address
+    similarities can only go up; on short address lines the two agree in most cases
+    (run python utils.py to compare them on a synthetic address corpus).
+    :param max_distance: optional cutoff, see levenshtein
+    :return: Edit distance divided by the length of the previous string
+    """
+    if previous_value and new_value:
+        return levenshtein(previous_value, new_value, max_distance) / len(previous_value)
+    else:
+        return 1
+
+
+def ndiff_edit_distance(previous_value, new_value):
+    """
+    Levenshtein-like distance from difflib.ndiff output (the previous edit_distance,
+    kept for compatibility comparisons)
     :return: Edit distance divided by the length of the previous string
     """
     if previous_value and new_value:
@@ -133,6 +284,91 @@ def edit_distance(previous_value, new_value):
         return 1
 
 
+def levenshtein(previous_value, new_value, max_distance=None):
+    """
+    Levenshtein (edit) distance between two strings: bit-parallel (Myers) when the shorter
+    string fits in a machine word, banded dynamic programming around the diagonal for longer
+    strings with a cutoff
+    :param max_distance: optional cutoff. If the distance is larger, max_distance + 1 is
+                         returned as soon as that is certain
+    :return: Minimum number of single character insertions, deletions and substitutions
+    """
+    pattern, text = sorted((previous_value, new_value), key=len)
+    if max_distance is not None and len(text) - len(pattern) > max_distance:
+        return max_distance + 1
+    if not pattern:
+        return len(text)
+    if len(pattern) <= WORD_SIZE or max_distance is None:
+        # python ints have no word size limit, so without a cutoff (which the band needs)
+        # the bit-parallel kernel also beats full dynamic programming on long strings
+        return _myers_distance(pattern, text, max_distance)
+    return _banded_distance(pattern, text, max_distance)
+
+
+def _myers_distance(pattern, text, max_distance=None):
+    """
+    Myers' bit-parallel edit distance (Hyyrö's formulation): one column of the DP matrix is
+    kept as bit vectors of +1/-1 vertical differences, updated with a few word operations
+    per character of text. Bits above the pattern length never influence the bits below it
+    (python ints behave as infinite two's complement), so the vectors are not masked
+    """
+    last = 1 << (len(pattern) - 1)
+    peq = {}  # character -> bitmask of its positions in pattern
+    for position, character in enumerate(pattern):
+        peq[character] = peq.get(character, 0) | (1 << position)
+
+    positive, negative, distance = -1, 0, len(pattern)
+    remaining = len(text)
+    for character in text:
+        eq = peq.get(character, 0)
+        xv = eq | negative
+        xh = (((eq & positive) + positive) ^ positive) | eq
+        horizontal_positive = negative | ~(xh | positive)
+        horizontal_negative = positive & xh
+        if horizontal_positive & last:
+            distance += 1
+        elif horizontal_negative & last:
+            distance -= 1
+        horizontal_positive = (horizontal_positive << 1) | 1
+        positive = (horizontal_negative << 1) | ~(xv | horizontal_positive)
+        negative = horizontal_positive & xv
+
+        if max_distance is not None:
+            # the distance drops by at most one per remaining character
+            remaining -= 1
+            if distance - remaining > max_distance:
+                return max_distance + 1
+    return distance
+
+
+def _banded_distance(pattern, text, max_distance=None):
+    """
+    Edit distance by dynamic programming restricted to the diagonal band of width
+    2 * max_distance + 1 (the whole matrix without a cutoff), stopping early once every cell
+    of a row exceeds max_distance
+    """
+    band = len(text) if max_distance is None else max_distance
+    too_far = band + 1
+    previous = [column if column <= band else too_far for column in range(len(text) + 1)]
+    for row in range(1, len(pattern) + 1):
+        current = [too_far] * (len(text) + 1)
+        current[0] = row if row <= band else too_far
+        row_min = current[0]
+        character = pattern[row - 1]
+        for column in range(max(1, row - band), min(len(text), row + band) + 1):
+            value = min(
+                previous[column - 1] + (character != text[column - 1]),
+                current[column - 1] + 1,
+                previous[column] + 1,
+            )
+            current[column] = min(value, too_far)
+            row_min = min(row_min, value)
+        if row_min > band:
+            return too_far
+        previous = current
+    return min(previous[len(text)], too_far)
+
+
 def timestamp_difference(previous_value, new_value):
     """
     Calculate the difference between two timestamps in seconds
@@ -148,6 +384,30 @@ def timestamp_difference(previous_value, new_value):
         return 999999999999
 
 
+def parse_timestamp(value):
+    """
+    Parse a timestamp once into an integer, so that differences between many timestamps
+    can be computed without parsing them again
+    :return: Microseconds since 1970-01-01 (naive, like the timestamp strings), or None if
+             the value is missing
+    """
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(value)  # much faster than strptime
+    except ValueError:
+        parsed = datetime.strptime(value, TIMESTAMP_FORMAT)
+    return epoch_microseconds(parsed)
+
+
+def epoch_microseconds(value):
+    """
+    :return: Microseconds between 1970-01-01 and a naive datetime
+    """
+    delta = value - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
 def age_difference(previous_value, new_value):
     """
     Calculate the difference between two ages in seconds
@@ -179,3 +439,114 @@ def generate_match_score(results, weights=None, return_avg=False):
         return score / denominator
     else:
         return score
+
+
+def check_vocabulary_memory(num_values=100000, max_growth_mb=100):
+    """
+    Adversarial fonts values through match_set: one value with 90k tokens, one just under
+    max_tokens, then num_values distinct two-token values, each compared against the large
+    ones. Peak RSS must stay bounded and the results must equal plain set comparisons
+    :return: Peak RSS growth in MB
+    """
+    import resource
+
+    def peak_mb():
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KB on Linux
+
+    before = peak_mb()
+    huge = ",".join(f"font{number}" for number in range(90000))
+    large = ",".join(f"font{number}" for number in range(TOKEN_VOCABULARY.max_tokens - 10))
+    for number in range(num_values):
+        value = f"font{number},other{number}"
+        for other in [huge, large] if number % 1000 == 0 else [value.replace("other", "o")]:
+            expected = dice_distance(set(other.split(",")), set(value.split(","))) <= 0.5
+            assert match_set(other, value) == expected
+        assert len(TOKEN_VOCABULARY.token_ids) <= TOKEN_VOCABULARY.max_tokens
+        assert TOKEN_VOCABULARY.bytes <= TOKEN_VOCABULARY.max_bytes
+    growth = peak_mb() - before
+    assert growth < max_growth_mb, f"peak RSS grew by {growth:.0f} MB"
+    return growth
+
+
+if __name__ == "__main__":
+    import random
+    import timeit
+    from concurrent.futures import ThreadPoolExecutor
+
+    from synthetic import FONTS
+
+    # first, so that the peak RSS of the benchmarks below doesn't hide its growth
+    growth = check_vocabulary_memory()
+    print(f"check_vocabulary_memory: peak RSS grew by {growth:.1f} MB under adversarial values")
+
+    def split_match_set(previous_value, new_value, threshold=0.5):
+        # match_set before the token vocabulary: split both values into fresh sets every call
+        return dice_distance(set(previous_value.split(",")), set(new_value.split(","))) <= threshold
+
+    rng = random.Random(0)
+    for num_fonts in [25, 100, 150]:
+        pairs = []
+        for _ in range(200):
+            fonts = rng.sample(FONTS, num_fonts)
+            pairs.append(
+                (", ".join(fonts), ", ".join(fonts[: int(num_fonts * rng.uniform(0.3, 1))]))
+            )
+        assert all(match_set(*pair) == split_match_set(*pair) for pair in pairs)
+        # a vocabulary reset mid-stream, and concurrent comparisons, give the same results
+        bounded = TokenVocabulary(max_cached_values=7, max_tokens=num_fonts + 3)
+        for pair in pairs:
+            expected = dice_distance(*[set(value.split(",")) for value in pair])
+            assert bitmap_dice_distance(*bounded.token_set_pair(*pair)) == expected
+            assert len(bounded.token_sets) <= 7 + 1 and len(bounded.token_ids) <= num_fonts + 3
+        with ThreadPoolExecutor(8) as executor:
+            shared = list(executor.map(lambda pair: bounded.token_set_pair(*pair), pairs * 5))
+        assert [bitmap_dice_distance(*sets) for sets in shared] == [
+            bitmap_dice_distance(*TokenVocabulary().token_set_pair(*pair)) for pair in pairs * 5
+        ]
+
+        number = 20
+        before = timeit.timeit(lambda: [split_match_set(*pair) for pair in pairs], number=number)
+        after = timeit.timeit(lambda: [match_set(*pair) for pair in pairs], number=number)
+        # first sighting of both values: tokens are split and interned before the comparison
+        cold = timeit.timeit(
+            lambda: [
+                bitmap_dice_distance(*vocabulary.token_set_pair(a, b))
+                for vocabulary in [TokenVocabulary()]
+                for a, b in pairs
+            ],
+            number=number,
+        )
+        per_call = 1e6 / (number * len(pairs))
+        print(
+            f"{num_fonts:>3} fonts: split sets {before * per_call:.2f} us, "
+            f"vocabulary bitmaps {after * per_call:.2f} us (cold {cold * per_call:.2f} us) "
+            "per comparison"
+        )
+
+    from synthetic import generate_address_pairs
+
+    pairs = generate_address_pairs(2000)
+    differ = [(a, b) for a, b in pairs if edit_distance(a, b) != ndiff_edit_distance(a, b)]
+    assert all(edit_distance(a, b) <= ndiff_edit_distance(a, b) for a, b in pairs)
+    print(f"levenshtein differs from the ndiff approximation on {len(differ)}/{len(pairs)} pairs:")
+    for a, b in differ[:5]:
+        print(f"    {a!r} -> {b!r}: {edit_distance(a, b):.3f} (ndiff {ndiff_edit_distance(a, b):.3f})")
+
+    number = 5
+    per_call = 1e6 / (number * len(pairs))
+    for label, function in [
+        ("ndiff", ndiff_edit_distance),
+        ("levenshtein", edit_distance),
+        ("levenshtein, max_distance=3", lambda a, b: edit_distance(a, b, max_distance=3)),
+    ]:
+        elapsed = timeit.timeit(lambda: [function(a, b) for a, b in pairs], number=number)
+        print(f"address lines, {label}: {elapsed * per_call:.2f} us per comparison")
+    long_pairs = [(a * 4, b * 4) for a, b in pairs[:200]]  # over WORD_SIZE: banded fallback
+    for label, function in [
+        ("ndiff", ndiff_edit_distance),
+        ("levenshtein", edit_distance),
+        ("levenshtein, max_distance=3", lambda a, b: edit_distance(a, b, max_distance=3)),
+    ]:
+        elapsed = timeit.timeit(lambda: [function(a, b) for a, b in long_pairs], number=1)
+        print(f"long lines, {label}: {elapsed * 1e6 / len(long_pairs):.2f} us per comparison")
+
@@ -1,11 +1,89 @@
+from datetime import datetime
+
+import numpy as np
+
 from utils import (
     haversine_distance,
+    haversine_distances,
     timestamp_difference,
+    parse_timestamp,
+    epoch_microseconds,
     exact_match,
     age_difference,
     generate_match_score,
     edit_distance,
+    MISSING_TIME_DIFFERENCE,
 )
+from instrumentation import INSTRUMENTATION
+from score_cache import content_hash
+
+PAYMENT_DETAILS = ["brand", "expMonth", "expYear", "last4", "country"]
+IDENTITY_FIELDS = ["email", "Phone", "First_name", "Last_name", "username"]
+ADDRESS_FIELDS = ["Line1", "Line2", "City", "Country", "Postal_code", "State"]
+
+
+def normalize_address(value):
+    """
+    Lowercase an address field and collapse its whitespace, so that e.g. "1280 21st St" and
+    "1280  21st st" compare equal
+    :return: Normalized string, or None if the value is missing
+    """
+    if not value:
+        return None
+    return " ".join(str(value).lower().split())
+
+
+def weighted_sum(keys, values, weights=None):
+    """
+    utils.generate_match_score for results given as parallel lists of keys and values
+    :return: Weighted sum of the values (sum of their integer values without weights)
+    """
+    if weights:
+        return sum([weights[key] * float(value) for key, value in zip(keys, values)])
+    return sum([int(value) for value in values])
+
+
+class VisitorRecord:
+    """
+    A visitor normalized once for matching: IP observations as arrays with epoch timestamps
+    (microseconds, see utils.parse_timestamp), the payment method as a fingerprint plus a
+    details tuple, identity fields as a tuple and address fields lowercased
+    """
+
+    __slots__ = (
+        "ips",
+        "latitudes",
+        "longitudes",
+        "ip_times",
+        "ip_has_time",
+        "created_at",
+        "payment_fingerprint",
+        "global_unique_fingerprint",
+        "payment_details",
+        "identity",
+        "address",
+    )
+
+    def __init__(self, visitor):
+        ips = visitor["ips"]
+        ip_times = [parse_timestamp(ip["updated_at"]) for ip in ips]
+        self.ips = tuple(ip["ip"] for ip in ips)
+        self.latitudes = np.array([ip["props"]["latitude"] for ip in ips], dtype=np.float64)
+        self.longitudes = np.array([ip["props"]["longitude"] for ip in ips], dtype=np.float64)
+        self.ip_times = np.array([time or 0 for time in ip_times], dtype=np.int64)
+        self.ip_has_time = np.array([time is not None for time in ip_times], dtype=bool)
+        self.created_at = parse_timestamp(visitor["visitors"]["createdAt"])
+
+        payment = visitor["payment_methods"]
+        self.payment_fingerprint = payment.get("fingerprint")
+        self.global_unique_fingerprint = payment.get("global_unique_fingerprint")
+        details = tuple(payment.get(field) for field in PAYMENT_DETAILS)
+        self.payment_details = details if all(details) else None  # None: some detail missing
+
+        users = visitor["visitor_users"]
+        self.identity = tuple(users.get(field) for field in IDENTITY_FIELDS)
+        address = visitor["visitor_addresses"]
+        self.address = tuple(normalize_address(address.get(field)) for field in ADDRESS_FIELDS)
 
 
 class VisitorAttributeCompare:
@@ -14,15 +92,180 @@ class VisitorAttributeCompare:
     identify whether or not they likely belong to the same individual
     """
 
-    def __init__(self, prev_vs=[], new_v=None, weights=None):
+    def __init__(self, prev_vs=[], new_v=None, weights=None, cache=None):
         self.prev_vs = prev_vs  # all previous visitors to compare
         self.new_v = new_v  # new visitor (occurred later)
         self.weights = weights  # optional dictionary indicating weights for similarity attributes
+        self.cache = cache  # optional score_cache.PairCache of pair_components
         self.MAX_PLAUSIBLE_SPEED = 0.35  # passenger jet cruising speed (in km/s) + 20%
+        self._records = None  # normalized VisitorRecords, built on first use
+        self._previous_hashes = None  # content hashes of prev_vs, computed on first use
+        self._parsed = {}  # VisitorRecords of the previous visitors the cache missed
+
+    def time_differences(self, previous_times, previous_present, new_times, new_present):
+        """
+        Vectorized utils.timestamp_difference of microsecond timestamps (broadcast against
+        each other)
+        :return: Array of differences in seconds, MISSING_TIME_DIFFERENCE where either is missing
+        """
+        return np.where(
+            previous_present & new_present,
+            (new_times - previous_times) / 1e6,
+            MISSING_TIME_DIFFERENCE,
+        )
+
+    def records(self):
+        """
+        Normalize the previous and the new visitor once per comparer
+        :return: List of VisitorRecord for prev_vs, VisitorRecord for new_v
+        """
+        if self._records is None:
+            previous = self.previous_records()
+            with INSTRUMENTATION.stage("visitor.parse"):
+                self._records = previous, VisitorRecord(self.new_v)
+        return self._records
+
+    def previous_records(self):
+        """
+        :return: List of VisitorRecord for prev_vs
+        """
+        with INSTRUMENTATION.stage("visitor.parse"):
+            return [VisitorRecord(v) for v in self.prev_vs]
+
+    def ip_columns(self, previous):
+        """
+        Concatenate the IP observations of the previous visitors
+        :param previous: list of VisitorRecord
+        :return: Owner (index in previous), latitudes, longitudes, times and time presence
+                 arrays, one entry per IP observation
+        """
+        owner = np.repeat(np.arange(len(previous)), [len(record.ips) for record in previous])
+        latitudes = np.concatenate([record.latitudes for record in previous] + [np.empty(0)])
+        longitudes = np.concatenate([record.longitudes for record in previous] + [np.empty(0)])
+        ip_times = np.concatenate([record.ip_times for record in previous] + [np.empty(0, int)])
+        ip_has_time = np.concatenate(
+            [record.ip_has_time for record in previous] + [np.empty(0, bool)]
+        )
+        return owner, latitudes, longitudes, ip_times, ip_has_time
+
+    def telemetry_scores(self, previous, new, now, ip_columns=None):
+        """
+        Telemetry score of every previous visitor. Every IP pair of every previous visitor is
+        compared at once: distances, time deltas and distance scores are
+        (previous IPs x new IPs) arrays
+        :param previous: list of VisitorRecord
+        :param new: VisitorRecord of the new visitor
+        :param now: reference clock of the request (microseconds, see utils.epoch_microseconds)
+        :param ip_columns: ip_columns(previous), when already computed
+        :return: Array of telemetry scores, and the IP timing red flag
+        """
+        static_scores, red_flags = self.static_telemetry_scores(previous, new, ip_columns)
+        previous_created, previous_has_created = self.created_columns(previous)
+        age_scores = self.age_scores(previous_created, previous_has_created, new.created_at, now)
+        return static_scores + age_scores, bool(red_flags.any())
+
+    def created_columns(self, previous):
+        """
+        :return: Creation times of the previous visitors (microseconds), and their presence
+        """
+        previous_created = np.array([record.created_at or 0 for record in previous], dtype=np.int64)
+        previous_has_created = np.array([record.created_at is not None for record in previous])
+        return previous_created, previous_has_created
+
+    def static_telemetry_scores(self, previous, new, ip_columns=None):
+        """
+        The part of the telemetry scores that does not depend on the clock: IP match,
+        geographic proximity and creation time proximity (see telemetry_scores)
+        :return: Array of partial telemetry scores, and array of per-visitor IP timing red flags
+        """
+        num_visitors = len(previous)
+        if ip_columns is None:
+            ip_columns = self.ip_columns(previous)
+        owner, latitudes, longitudes, ip_times, ip_has_time = ip_columns
+
+        # IP pairs: one row per previous IP observation, one column per new IP observation
+        distance = haversine_distances(
+            latitudes[:, None], longitudes[:, None], new.latitudes[None, :], new.longitudes[None, :]
+        )
+        INSTRUMENTATION.count("visitor.ip_pairs", distance.size)
+        time_delta = self.time_differences(
+            ip_times[:, None], ip_has_time[:, None], new.ip_times[None, :], new.ip_has_time[None, :]
+        )
+        with np.errstate(divide="ignore", invalid="ignore"):
+            red_flags = (distance > 10) & (distance / time_delta > self.MAX_PLAUSIBLE_SPEED)
+        distance_scores = np.where(distance < 10, 1, np.minimum(1000, distance) / 1000)
+        counted = ~red_flags  # red flagged pairs don't get a distance score
+
+        new_ips = {ip for ip in new.ips if ip}
+        ip_matches = [bool(ip) and ip in new_ips for record in previous for ip in record.ips]
+        ip_match = np.bincount(owner, weights=ip_matches, minlength=num_visitors) > 0
+        score_sums = np.bincount(
+            owner, weights=(distance_scores * counted).sum(axis=1), minlength=num_visitors
+        )
+        score_counts = np.bincount(owner, weights=counted.sum(axis=1), minlength=num_visitors)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            geographic_proximity = np.where(score_counts > 0, 1 - score_sums / score_counts, 0)
+
+        previous_created, previous_has_created = self.created_columns(previous)
+        creation_delta = self.time_differences(
+            previous_created, previous_has_created, new.created_at or 0, new.created_at is not None
+        )
+
+        results = {
+            "ip_match": ip_match,
+            "geographic_proximity": geographic_proximity,
+            "creation_time_proximity": 1 - np.minimum(1, creation_delta / 86400),
+        }
+        weights = self.weights["telemetry"]
+        if weights:
+            match_scores = sum(weights[key] * results[key].astype(np.float64) for key in results)
+        else:
+            match_scores = sum(np.trunc(results[key].astype(np.float64)) for key in results)
+        visitor_red_flags = np.bincount(
+            owner, weights=red_flags.any(axis=1), minlength=num_visitors
+        )
+        return match_scores, visitor_red_flags > 0
+
+    def age_scores(self, previous_created, previous_has_created, new_created, now):
+        """
+        Visitor age proximity score of every previous visitor, the only telemetry score that
+        depends on the clock (utils.age_difference: (age of previous - age of new) / age of
+        previous, clamped)
+        :param new_created: creation time of the new visitor (microseconds), or None
+        :return: Array of weighted age proximity scores
+        """
+        new_has_created = new_created is not None
+        with np.errstate(divide="ignore", invalid="ignore"):
+            age_ratio = ((new_created or 0) - previous_created) / (now - previous_created)
+        age_differences = np.where(
+            previous_has_created & new_has_created,
+            np.maximum(1, age_ratio),
+            MISSING_TIME_DIFFERENCE,
+        )
+        proximity = (1 - age_differences).astype(np.float64)
+        weights = self.weights["telemetry"]
+        if weights:
+            return weights["visitor_age_proximity"] * proximity
+        return np.trunc(proximity)
 
     def match_telemetry(self):
         """
-        Match visitors telemetry fields
+        Match visitors telemetry fields. Equivalent to match_telemetry_scalar (up to floating
+        point rounding), see telemetry_scores
+        :return score: calculated telemetry score based on all attributes
+        :return ip_timing_red_flag: True if IP timing/geographic location values indicate it can't
+                                    be the same person
+        """
+        previous, new = self.records()
+        match_scores, ip_timing_red_flag = self.telemetry_scores(
+            previous, new, epoch_microseconds(datetime.today())
+        )
+        return {"score": float(np.max(match_scores)), "ip_timing_red_flag": ip_timing_red_flag}
+
+    def match_telemetry_scalar(self):
+        """
+        Match visitors telemetry fields, one IP pair at a time (reference implementation
+        for match_telemetry)
         :return score: calculated telemetry score based on all attributes
         :return ip_timing_red_flag: True if IP timing/geographic location values indicate it can't
                                     be the same person
@@ -148,13 +391,238 @@ class VisitorAttributeCompare:
     def estimate_visitor_match(self):
         """
         Return overall match score, return the IP timing red flag as a separate field
-        to be used in downstream logic
+        to be used in downstream logic. Every visitor is normalized once (VisitorRecord), the
+        telemetry scores of all previous visitors are computed at once, and the payment,
+        identity and address scores in a single pass, with one reference clock per request
+        :return score: Overall visitor similarity score based on attributes they entered
+        :return ip_timing_red_flag: True if IP timing/geographic location values indicate it can't
+                                    be the same person
+        """
+        now = epoch_microseconds(datetime.today())
+        if self.cache is not None:
+            return self.cached_score(self.new_v, now)
+        previous, new = self.records()
+        return self.score_visitor(previous, new, now)
+
+    def estimate_visitor_matches(self, new_vs):
+        """
+        Score several new visitors against the same previous visitors: the previous visitors
+        are normalized and their IP observations concatenated once, and every new visitor is
+        scored with the same reference clock
+        :param new_vs: list of new visitors
+        :return: List of estimate_visitor_match results, one per new visitor
+        """
+        now = epoch_microseconds(datetime.today())
+        if self.cache is not None:
+            return [self.cached_score(new_v, now) for new_v in new_vs]
+        previous = self._records[0] if self._records is not None else self.previous_records()
+        ip_columns = self.ip_columns(previous)
+        results = []
+        for new_v in new_vs:
+            with INSTRUMENTATION.stage("visitor.parse"):
+                new = VisitorRecord(new_v)
+            results.append(self.score_visitor(previous, new, now, ip_columns))
+        return results
+
+    def score_visitor(self, previous, new, now, ip_columns=None):
+        """
+        Fused visitor score, see estimate_visitor_match
+        :param previous: list of VisitorRecord
+        :param new: VisitorRecord of the new visitor
+        :param now: reference clock of the request (microseconds, see utils.epoch_microseconds)
+        :param ip_columns: ip_columns(previous), when already computed
+        :return: Dictionary with the score and the IP timing red flag
+        """
+        INSTRUMENTATION.count("visitor.candidates_scored", len(previous))
+        with INSTRUMENTATION.stage("visitor.telemetry"):
+            telemetry_scores, ip_timing_red_flag = self.telemetry_scores(
+                previous, new, now, ip_columns
+            )
+        with INSTRUMENTATION.stage("visitor.payment"):
+            payment_score = self.payment_score(previous, new)
+        with INSTRUMENTATION.stage("visitor.identity"):
+            user_scores = self.identity_scores(previous, new)
+        with INSTRUMENTATION.stage("visitor.address"):
+            address_scores = self.address_scores(previous, new)
+
+        with INSTRUMENTATION.stage("visitor.scoring"):
+            score = (
+                float(np.max(telemetry_scores))
+                + payment_score * self.weights["payment_methods"]
+                + max(user_scores)
+                + max(address_scores)
+            )
+        return {"score": min(100, score), "ip_timing_red_flag": ip_timing_red_flag}
+
+    def payment_score(self, previous, new):
+        """
+        Unweighted payment score, see match_payment: the first pair of globally unique
+        fingerprints decides
+        :return: 0 or 1
+        """
+        return self.decided_payment_score(self.payment_pair_score(prev, new) for prev in previous)
+
+    def payment_pair_score(self, prev, new):
+        """
+        Payment comparison of a single pair, see match_payment
+        :return: 0 or 1 (None if nothing was compared), and whether both visitors have
+                 globally unique fingerprints, in which case this pair decides the payment score
+        """
+        if (
+            new.payment_fingerprint
+            and new.global_unique_fingerprint
+            and prev.payment_fingerprint
+            and prev.global_unique_fingerprint
+        ):
+            return exact_match(prev.payment_fingerprint, new.payment_fingerprint), True
+        scores = []
+        if not (prev.payment_details and prev.payment_details == new.payment_details):
+            scores.append(0)
+        if prev.payment_fingerprint and new.payment_fingerprint:
+            scores.append(exact_match(prev.payment_fingerprint, new.payment_fingerprint))
+        return max(scores, default=None), False
+
+    def decided_payment_score(self, pair_scores):
+        """
+        :param pair_scores: payment_pair_score of the previous visitors, in order
+        :return: Highest pair score up to the first deciding pair
+        """
+        payment_scores = []
+        for score, decides in pair_scores:
+            if score is not None:
+                payment_scores.append(score)
+            if decides:
+                INSTRUMENTATION.count("visitor.payment_early_exit")
+                break
+        return max(payment_scores, default=0)
+
+    def identity_scores(self, previous, new):
+        """
+        :return: Weighted identity score of every previous visitor, see
+                 match_identity_information
+        """
+        return [
+            weighted_sum(
+                IDENTITY_FIELDS,
+                [exact_match(a, b) for a, b in zip(new.identity, prev.identity)],
+                self.weights["visitor_users"],
+            )
+            for prev in previous
+        ]
+
+    def address_scores(self, previous, new):
+        """
+        :return: Weighted address score of every previous visitor, see match_address
+        """
+        address_weights = self.weights["visitor_addresses"]
+        new_line1, new_line2, *new_fields = new.address
+        scores = []
+        for prev in previous:
+            line1, line2, *fields = prev.address
+            scores.append(
+                weighted_sum(
+                    ADDRESS_FIELDS,
+                    [1.0 - edit_distance(line1, new_line1), 1.0 - edit_distance(line2, new_line2)]
+                    + [exact_match(a, b) for a, b in zip(fields, new_fields)],
+                    address_weights,
+                )
+            )
+        return scores
+
+    def pair_keys(self, new_v):
+        """
+        :return: PairCache key of every (previous visitor, new visitor, weights) pair
+        """
+        if self._previous_hashes is None:
+            self._previous_hashes = [content_hash(prev_v) for prev_v in self.prev_vs]
+        new_hash, weights_hash = content_hash(new_v), content_hash(self.weights)
+        return [("visitor", prev, new_hash, weights_hash) for prev in self._previous_hashes]
+
+    def pair_components(self, previous, new):
+        """
+        The parts of score_visitor of every pair that do not depend on the clock, which is
+        what the PairCache holds. The visitor age proximity changes with the reference
+        clock, so only the creation times it is computed from are kept
+        :return: List of (static telemetry score, IP timing red flag, payment_pair_score,
+                 identity score, address score, creation time of the previous visitor,
+                 creation time of the new visitor), one per previous visitor
+        """
+        static_scores, red_flags = self.static_telemetry_scores(previous, new)
+        user_scores = self.identity_scores(previous, new)
+        address_scores = self.address_scores(previous, new)
+        return [
+            (
+                float(static_score),
+                bool(red_flag),
+                self.payment_pair_score(prev, new),
+                user_score,
+                address_score,
+                prev.created_at,
+                new.created_at,
+            )
+            for prev, static_score, red_flag, user_score, address_score in zip(
+                previous, static_scores, red_flags, user_scores, address_scores
+            )
+        ]
+
+    def score_components(self, components, now):
+        """
+        score_visitor from the pair_components of every previous visitor, with the visitor
+        age proximity computed for the reference clock now
+        """
+        static_scores = np.array([component[0] for component in components], dtype=np.float64)
+        previous_created = np.array([component[5] or 0 for component in components], np.int64)
+        previous_has_created = np.array([component[5] is not None for component in components])
+        telemetry_scores = static_scores + self.age_scores(
+            previous_created, previous_has_created, components[0][6], now
+        )
+        payment_score = self.decided_payment_score(component[2] for component in components)
+        score = (
+            float(np.max(telemetry_scores))
+            + payment_score * self.weights["payment_methods"]
+            + max(component[3] for component in components)
+            + max(component[4] for component in components)
+        )
+        ip_timing_red_flag = any(component[1] for component in components)
+        return {"score": min(100, score), "ip_timing_red_flag": ip_timing_red_flag}
+
+    def cached_score(self, new_v, now):
+        """
+        score_visitor through the PairCache: only the previous visitors whose pair with
+        new_v is missing from the cache are normalized and compared
+        """
+        keys = self.pair_keys(new_v)
+        with INSTRUMENTATION.stage("visitor.cache_lookup"):
+            components = self.cache.get_many(keys)
+        misses = [number for number, component in enumerate(components) if component is None]
+        INSTRUMENTATION.count("visitor.candidates_scored", len(misses))
+        if misses:
+            with INSTRUMENTATION.stage("visitor.parse"):
+                previous = [self.previous_record(number) for number in misses]
+                new = VisitorRecord(new_v)
+            for number, component in zip(misses, self.pair_components(previous, new)):
+                components[number] = component
+            self.cache.put_many([(keys[number], components[number]) for number in misses])
+        return self.score_components(components, now)
+
+    def previous_record(self, number):
+        """:return: VisitorRecord of prev_vs[number], normalized at most once per comparer"""
+        if self._records is not None:
+            return self._records[0][number]
+        if number not in self._parsed:
+            self._parsed[number] = VisitorRecord(self.prev_vs[number])
+        return self._parsed[number]
+
+    def estimate_visitor_match_scalar(self):
+        """
+        Return overall match score, computing every sub-score in its own pass over the
+        previous visitors (reference implementation for estimate_visitor_match)
         :return score: Overall visitor similarity score based on attributes they entered
         :return ip_timing_red_flag: True if IP timing/geographic location values indicate it can't
                                     be the same person
         """
         all_results = {
-            "telemetry": self.match_telemetry(),
+            "telemetry": self.match_telemetry_scalar(),
             "payment_methods": self.match_payment(),
             "visitor_users": self.match_identity_information(),
             "visitor_addresses": self.match_address(),
@@ -170,3 +638,157 @@ class VisitorAttributeCompare:
             "score": min(100, score),
             "ip_timing_red_flag": all_results["telemetry"]["ip_timing_red_flag"],
         }
+
+
+def check_telemetry(prev_vs, new_v, weights):
+    """
+    Verify that the vectorized match_telemetry agrees with match_telemetry_scalar
+    :return: Number of IP pairs compared
+    """
+    comparer = VisitorAttributeCompare(prev_vs, new_v, weights)
+    expected, actual = comparer.match_telemetry_scalar(), comparer.match_telemetry()
+    assert expected["ip_timing_red_flag"] == actual["ip_timing_red_flag"]
+    assert np.isclose(expected["score"], actual["score"], rtol=1e-9, atol=1e-9), (expected, actual)
+    return sum(len(prev_v["ips"]) for prev_v in prev_vs) * len(new_v["ips"])
+
+
+def check_visitor_match(prev_vs, new_v, weights):
+    """
+    Verify that the fused estimate_visitor_match agrees with estimate_visitor_match_scalar.
+    Addresses are normalized (normalize_address) up front for the scalar path, since the fused
+    path compares them case-insensitively
+    """
+
+    def normalized(visitor):
+        address = {
+            key: normalize_address(value) for key, value in visitor["visitor_addresses"].items()
+        }
+        return dict(visitor, visitor_addresses=address)
+
+    expected = VisitorAttributeCompare(
+        [normalized(v) for v in prev_vs], normalized(new_v), weights
+    ).estimate_visitor_match_scalar()
+    actual = VisitorAttributeCompare(prev_vs, new_v, weights).estimate_visitor_match()
+    assert expected["ip_timing_red_flag"] == actual["ip_timing_red_flag"]
+    assert np.isclose(expected["score"], actual["score"], rtol=1e-9, atol=1e-9), (expected, actual)
+
+
+def check_scoring_changes():
+    """
+    Pin the cases where the fused and vectorized scoring deliberately differ from the scalar
+    reference (match_*_scalar / match_*), which either scored them differently or raised:
+    - address fields are lowercased, whitespace runs collapsed and the ends stripped, and a
+      whitespace-only field counts as missing
+    - a far apart IP pair with a zero time delta is red flagged instead of dividing by zero
+    - a visitor whose IP pairs are all red flagged, or that has no IPs, gets a geographic
+      proximity (and IP match) of 0 instead of raising
+    - a payment that no rule applies to (same complete card details, no fingerprints) scores 0
+      instead of raising
+    """
+    import copy
+
+    from synthetic import generate_visitor_event
+
+    event = generate_visitor_event(1, 1, seed=0)
+    weights = event["weights"]
+    prev_v = copy.deepcopy(event["new_visitor"])
+    prev_v["visitor_addresses"].update(Line1="1280 21st St", Line2="Apt 500", City="Washington")
+
+    def fused(new_v, previous=None):
+        comparer = VisitorAttributeCompare([previous or prev_v], new_v, weights)
+        return (comparer, *comparer.records())
+
+    new_v = copy.deepcopy(prev_v)
+    new_v["visitor_addresses"].update(Line1=" 1280  21ST st ", Line2="APT 500", City="washington")
+    comparer, previous, new = fused(new_v)
+    assert comparer.address_scores(previous, new) == [sum(weights["visitor_addresses"].values())]
+    assert comparer.match_address() < comparer.address_scores(previous, new)[0]
+    blank = copy.deepcopy(prev_v)
+    blank["visitor_addresses"]["City"] = "  "
+    comparer, previous, new = fused(blank, blank)
+    assert new.address[ADDRESS_FIELDS.index("City")] == ""  # falsy: compared as missing
+    assert comparer.match_address() - comparer.address_scores(previous, new)[0] == (
+        weights["visitor_addresses"]["City"]
+    )
+
+    far = copy.deepcopy(prev_v)
+    far["ips"][0]["props"] = {"latitude": 0.0, "longitude": 0.0}  # same updated_at
+    comparer, previous, new = fused(far)
+    static_scores, red_flags = comparer.static_telemetry_scores(previous, new)
+    assert red_flags.tolist() == [True] and comparer.match_telemetry()["ip_timing_red_flag"]
+    only_geographic = dict(weights, telemetry=dict.fromkeys(weights["telemetry"], 0))
+    only_geographic["telemetry"]["geographic_proximity"] = 1
+
+    def geographic_proximity(new_v):
+        comparer = VisitorAttributeCompare([prev_v], new_v, only_geographic)
+        return comparer.static_telemetry_scores(*comparer.records())[0].tolist()
+
+    assert geographic_proximity(far) == [0.0]
+    try:
+        comparer.match_telemetry_scalar()
+        raise AssertionError("the scalar reference no longer raises on a zero time delta")
+    except ZeroDivisionError:
+        pass
+
+    no_ips = dict(copy.deepcopy(prev_v), ips=[])
+    comparer, previous, new = fused(no_ips)
+    assert geographic_proximity(no_ips) == [0.0]
+    assert comparer.estimate_visitor_match()["ip_timing_red_flag"] is False
+    try:
+        comparer.match_telemetry_scalar()
+        raise AssertionError("the scalar reference no longer raises without IP pairs")
+    except ValueError:
+        pass
+
+    unfingerprinted = copy.deepcopy(prev_v)
+    unfingerprinted["payment_methods"].update(fingerprint=None, global_unique_fingerprint=0)
+    comparer, previous, new = fused(unfingerprinted, unfingerprinted)
+    assert comparer.payment_score(previous, new) == 0
+    try:
+        comparer.match_payment()
+        raise AssertionError("the scalar reference no longer raises without a payment rule")
+    except ValueError:
+        pass
+
+
+if __name__ == "__main__":
+    import timeit
+
+    from synthetic import generate_visitor_event
+
+    pairs, red_flags = 0, 0
+    for seed in range(300):
+        event = generate_visitor_event(
+            1 + seed % 10, 1 + seed % 5, seed=seed, num_new_ips=1 + seed % 3
+        )
+        args = event["previous_visitors"], event["new_visitor"], event["weights"]
+        try:
+            pairs += check_telemetry(*args)
+            check_visitor_match(*args)
+        except (ZeroDivisionError, ValueError):
+            # the scalar path raises on a zero time delta or when no payment score applies
+            continue
+        red_flags += VisitorAttributeCompare(*args).match_telemetry()["ip_timing_red_flag"]
+    print(f"equivalence: {pairs} IP pairs checked ({red_flags} red flagged events)")
+    check_scoring_changes()
+    print("check_scoring_changes: address normalization and non-raising edge cases pinned")
+
+    for num_visitors, num_ips in [(1, 2), (10, 5), (50, 10), (100, 20), (200, 50)]:
+        event = generate_visitor_event(num_visitors, num_ips, seed=0)
+        args = event["previous_visitors"], event["new_visitor"], event["weights"]
+        comparer = VisitorAttributeCompare(*args)
+        number = max(1, 2000 // (num_visitors * num_ips))
+        scalar = timeit.timeit(comparer.match_telemetry_scalar, number=number) / number
+        vectorized = timeit.timeit(comparer.match_telemetry, number=number) / number
+        visitor_scalar = timeit.timeit(
+            lambda: VisitorAttributeCompare(*args).estimate_visitor_match_scalar(), number=number
+        )
+        visitor_fused = timeit.timeit(
+            lambda: VisitorAttributeCompare(*args).estimate_visitor_match(), number=number
+        )
+        print(
+            f"{num_visitors:>3} visitors, {num_visitors * num_ips * num_ips:>6} IP pairs: "
+            f"telemetry scalar {scalar * 1000:.2f} ms, vectorized {vectorized * 1000:.2f} ms; "
+            f"visitor match scalar {visitor_scalar / number * 1000:.2f} ms, "
+            f"fused {visitor_fused / number * 1000:.2f} ms"
+        )
@@ -1,15 +1,68 @@
+import os
+
 from visitor_attribute_compare import VisitorAttributeCompare
+from instrumentation import INSTRUMENTATION
+from score_cache import PAIR_CACHE
+
+NO_CANDIDATES = {"score": 0, "ip_timing_red_flag": False}
+_indexes = {}  # read-only IdentityIndex per path, kept across warm invocations
+
+
+def match_body(results):
+    return {"match_score": results["score"], "ip_timing_red_flag": results["ip_timing_red_flag"]}
+
+
+def identity_index():
+    """
+    The identity index at IDENTITY_INDEX_PATH, opened read-only once per warm container
+    """
+    from identity_index import IdentityIndex
+
+    path = os.environ["IDENTITY_INDEX_PATH"]
+    if path not in _indexes:
+        _indexes[path] = IdentityIndex(path, read_only=True)
+    return _indexes[path]
+
+
+def indexed_candidates(new_visitor, max_candidates=None):
+    """
+    No history shipped with the event: look the candidates up in the identity index
+    """
+    with INSTRUMENTATION.stage("visitor.candidate_lookup"):
+        return identity_index().candidates(new_visitor, max_candidates)
 
 
 def lambda_handler(event, context):
+    with INSTRUMENTATION.request("visitor_match"):
+        return match_event(event)
+
+
+def match_event(event):
     weights = event.get("weights") or None
-    comparer = VisitorAttributeCompare(event["previous_visitors"], event["new_visitor"], weights)
+    previous_visitors = event.get("previous_visitors")
+
+    if "new_visitors" in event:
+        # batch mode: every new visitor against the same previous visitors
+        if previous_visitors is not None:
+            comparer = VisitorAttributeCompare(previous_visitors, weights=weights, cache=PAIR_CACHE)
+            matches = comparer.estimate_visitor_matches(event["new_visitors"])
+        else:
+            matches = []
+            for new_visitor in event["new_visitors"]:
+                candidates = indexed_candidates(new_visitor, event.get("max_candidates"))
+                comparer = VisitorAttributeCompare(candidates, new_visitor, weights, PAIR_CACHE)
+                matches.append(comparer.estimate_visitor_match() if candidates else NO_CANDIDATES)
+        return {"statusCode": 200, "body": {"results": [match_body(match) for match in matches]}}
+
+    if previous_visitors is None:
+        previous_visitors = indexed_candidates(event["new_visitor"], event.get("max_candidates"))
+        if not previous_visitors:
+            return {"statusCode": 200, "body": match_body(NO_CANDIDATES)}
+
+    comparer = VisitorAttributeCompare(previous_visitors, event["new_visitor"], weights, PAIR_CACHE)
     results = comparer.estimate_visitor_match()
 
     return {
         "statusCode": 200,
-        "body": {
-            "match_score": results["score"],
-            "ip_timing_red_flag": results["ip_timing_red_flag"],
-        },
+        "body": match_body(results),
     }